@@ -0,0 +1,48 @@
+"""
+Scan throughput of a ratings like table for each supported page size.
+
+    python benchmark.py [n_records]
+
+For every page size the same records are written into a new table in a temporary directory, then the table is
+scanned with FileScan and the time, number of pages and rows per second are printed.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from data_layout import DataBase, PAGE_SIZES
+from executor import FileScan, Insert, Q, run
+
+SCHEMA = ('int','int','float','int')
+
+
+def create_ratings(path:str,n_records:int,page_size:int):
+    db = DataBase(path,'bench','ratings',SCHEMA,page_size=page_size)
+    records = [(i % 138493,(i * 7919) % 27278,float(i % 10) / 2,1100000000 + i) for i in range(n_records)]
+    for _ in run(Q(Insert(db,records))):
+        pass
+    db.db.close()
+    db.db = None
+
+
+def scan_throughput(path:str) -> dict:
+    scan = FileScan(path,'bench','ratings',SCHEMA)
+    start = time.perf_counter()
+    n_rows = sum(1 for _ in run(Q(scan)))
+    elapsed = time.perf_counter() - start
+    return {'rows': n_rows,'pages': scan.pages_read,'seconds': elapsed,'rows_per_second': n_rows / elapsed}
+
+
+def main(n_records:int):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'page size':>10} {'pages':>8} {'seconds':>9} {'rows/s':>12}")
+        for page_size in PAGE_SIZES:
+            path = os.path.join(directory,f"ratings_{page_size}.db")
+            create_ratings(path,n_records,page_size)
+            result = scan_throughput(path)
+            print(f"{page_size:>10} {result['pages']:>8} {result['seconds']:>9.3f} {result['rows_per_second']:>12.0f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
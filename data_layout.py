@@ -3,17 +3,118 @@ from functools import reduce
 from io import BytesIO
 import os
 import struct
+import threading
 from typing import List
 
-PAGE_SIZE = 4096
+from transactions import FROZEN_XID, INVALID_XID, MVCC_COLUMNS, TransactionManager, WriteConflict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PAGE_SIZE = 4096 # default page size of new tables
+PAGE_SIZES = (4096,8192,16384,32768,65536)
+FIXED_WIDTH = {'int': 4, 'float': 4, 'double': 8} # bytes of the fixed width column types
 DB_HEADER_SIZE = 400
+PAGE_STATIC_HEADER_SIZE = 20
+HEADER_FLAG_MVCC = 1
+OVERFLOW_HEADER = struct.Struct("<ii") # next page in the chain and bytes used in the overflow page
+TEXT_INLINE = 0
+TEXT_OVERFLOW = 1
+RECORD_FORMAT_V1 = 1 # columns one after the other, str and text values prefixed by their length
+RECORD_FORMAT_V2 = 2 # null bitmap, fixed width columns at fixed offsets and an offset table for str and text
+RECORD_FORMATS = (RECORD_FORMAT_V1,RECORD_FORMAT_V2)
+FIXED_CODES = {'int': 'i', 'float': 'f', 'double': 'd'}
+WRITE_BUFFER_SIZE = 1 << 20 # bytes of full pages kept in memory to be written together
+
+
+class OverflowRef:
+    """
+        Reference from a record to a text value stored in overflow pages.
+    """
+    def __init__(self,page_no:int,length:int):
+        self.page_no = page_no
+        self.length = length
+
+    def __eq__(self,other):
+        return isinstance(other,OverflowRef) and (self.page_no,self.length) == (other.page_no,other.length)
+
+    def __repr__(self):
+        return f"OverflowRef({self.page_no},{self.length})"
+
+
+class RecordSchema(tuple):
+    """
+        Column types of the records stored in a table together with the record format of the table, the
+        schema of DBHeader is a RecordSchema so the pages are encoded and decoded in the format of the header.
+        For the fixed offset format the position of every column in the record is computed once:
+
+        - null bitmap, one bit per column
+        - int, float and double columns at fixed offsets, zero when the value is null
+        - end offset of every str and text value (2 bytes each, from the start of the record)
+        - str values and text values, a text value starts with its kind byte as in the first format
+    """
+    def __new__(cls,dtypes,record_format:int = RECORD_FORMAT_V1):
+        if record_format not in RECORD_FORMATS:
+            raise ValueError(f"record format must be one of {RECORD_FORMATS}")
+        schema = super().__new__(cls,dtypes)
+        schema.record_format = record_format
+        schema.fixed_columns = [i for i,dtype in enumerate(schema) if dtype in FIXED_WIDTH]
+        schema.var_columns = [i for i,dtype in enumerate(schema) if dtype not in FIXED_WIDTH]
+        schema.null_bytes = (len(schema) + 7) // 8
+        schema.fixed_format = struct.Struct('<' + ''.join(FIXED_CODES[schema[i]] for i in schema.fixed_columns))
+        schema.field_formats = {i: struct.Struct('<' + FIXED_CODES[schema[i]]) for i in schema.fixed_columns}
+        schema.offsets = dict()
+        offset = schema.null_bytes
+        for i in schema.fixed_columns:
+            schema.offsets[i] = offset
+            offset += FIXED_WIDTH[schema[i]]
+        # the offset of a str or text column is its entry in the offset table
+        for i in schema.var_columns:
+            schema.offsets[i] = offset
+            offset += 2
+        schema.var_start = offset
+        return schema
+
 
 class DataBase:
-    def __init__(self,db_path,db_name,table_name,schema):
+    """
+        Table file with pages of page_size bytes, the page size of a table is chosen when it is created and kept
+        in the header. Values of text columns that do not fit in a fraction of the page are stored in chains of
+        overflow pages in a second file next to the table (path + '.ovf') and the record keeps a reference.
+        New tables use the record format given by record_format (see RecordSchema), RECORD_FORMAT_V2 reads any
+        column of a record without parsing the columns before it and stores nulls and empty strings apart.
+        With mvcc=True a new table stores the xmin and xmax of every record in two hidden columns
+        in front of the schema columns (see transactions.py), tables opened from disk keep the mode they were
+        created with. Pages are read and written with positional reads and writes so several threads can use
+        the same DataBase, the writers are serialized with a lock.
+    """
+    def __init__(self,db_path,db_name,table_name,schema,mvcc = False,page_size:int = PAGE_SIZE,record_format:int = RECORD_FORMAT_V1):
+        if page_size not in PAGE_SIZES:
+            raise ValueError(f"page size must be one of {PAGE_SIZES}")
+        if record_format not in RECORD_FORMATS:
+            raise ValueError(f"record format must be one of {RECORD_FORMATS}")
         self.header = DBHeader(db_name,table_name,schema)
+        self.header.mvcc = mvcc
+        self.header.page_size = page_size
+        self.header.record_format = record_format
+        self.schema = tuple(schema)
+        self.overflow = None
         self.pages:list[DBPage] = list()
         self.db_path = db_path
+        self.last_sort_key = None
+        self.listeners = list()
+        self.lock = threading.RLock()
         self.db = self.db_init()
+        self.page_size = self.header.page_size
+        self.text_columns = [i for i,dtype in enumerate(self.schema) if dtype == 'text']
+        self.mvcc = self.header.mvcc
+        self.hidden_columns = len(MVCC_COLUMNS) if self.mvcc else 0
+        if self.mvcc:
+            self.header.schema = MVCC_COLUMNS + self.schema
+            self.transactions = TransactionManager.for_table(db_path,self.header.next_xid)
+        self.header.schema = RecordSchema(self.header.schema,self.header.record_format)
 
     def persist(self) -> bool:
         """
@@ -39,10 +140,10 @@ class DataBase:
         """
         try:
             #print("current memory position {}".format(self.db.tell()))
-            page_bytes = self.db.read(PAGE_SIZE)
+            page_bytes = self.db.read(self.page_size)
             if len(page_bytes) == 0:
                 return False
-            self.pages.append(DBPage())
+            self.pages.append(DBPage(page_size=self.page_size))
             self.last_page().decode(page_bytes,self.header.schema)
         except:
             return False
@@ -50,34 +151,275 @@ class DataBase:
     
     def reset_page_read(self):
         self.db.seek(self.header.start_offset)
+
+    def page_offset(self,page_no:int) -> int:
+        return DB_HEADER_SIZE + self.page_size * page_no
+
+    def page_count(self) -> int:
+        self.db.flush()
+        file_size = os.fstat(self.db.fileno()).st_size
+        return max(file_size - DB_HEADER_SIZE,0) // self.page_size
+
+    def read_pages(self,page_no:int,n_pages:int) -> list:
+        """
+            Read up to n_pages consecutive pages starting from page_no with a single read.
+        """
+        page_size = self.page_size
+        pages_bytes = os.pread(self.db.fileno(),page_size * n_pages,self.page_offset(page_no))
+        return [pages_bytes[i:i+page_size] for i in range(0,len(pages_bytes) - page_size + 1,page_size)]
+
+    def read_page(self,page_no:int):
+        """
+            Read the raw bytes of the given page number without decoding them, it returns None when the page
+            does not exists.
+        """
+        page_bytes = os.pread(self.db.fileno(),self.page_size,self.page_offset(page_no))
+        if len(page_bytes) < self.page_size:
+            return None
+        return page_bytes
+
+    def build_zone_map(self) -> "ZoneMap":
+        """
+            Scan the whole table and store the min and max value of each numeric column per page in a
+            file next to the table, the scans use it to skip pages that can not match a predicate.
+        """
+        zone_map = ZoneMap(self.db_path,self.schema)
+        page_no = 0
+        while True:
+            page_bytes = self.read_page(page_no)
+            if page_bytes is None:
+                break
+            page = DBPage()
+            page.decode(page_bytes,self.header.schema)
+            zone_map.add_page([record.record[self.hidden_columns:] for record in page.records])
+            page_no += 1
+        zone_map.save()
+        return zone_map
         
     
     def write(self):
         """
             Write all the new pages to disk, it set the starting offset based on the current end offser which
             is updated every time we add a new page in the add_record function, the page size and the 
-            number of pages that will be writen.
-        """
-        start_page_offset = self.header.end_offset - PAGE_SIZE * len(self.pages)
-        _, db_pages = self.encode()
-        print("page to write: {}".format(db_pages))
-        self.db.seek(start_page_offset)
-        self.db.write(db_pages)
-
-    def add_record(self,record:tuple):
-        page = self.last_page()
-        record = PageRecord(record)
-        if not self.has_free_space(page,record=record):
-            self.write()
-            self.pages.pop()
-            self.pages.append(DBPage())
+            number of pages that will be writen. The header is written as well.
+        """
+        with self.lock:
+            start_page_offset = self.header.end_offset - self.page_size * len(self.pages)
+            db_header, db_pages = self.encode()
+            print("page to write: {}".format(db_pages))
+            self.db.flush()
+            os.pwrite(self.db.fileno(),db_pages,start_page_offset)
+            # keep the header on disk in sync so the offsets are right when the table is opened again
+            os.pwrite(self.db.fileno(),db_header,0)
+            # every page but the last one is full and written, only the last one can still change
+            del self.pages[:-1]
+
+    def write_buffer_pages(self) -> int:
+        """
+            Number of full pages kept in memory before they are written with a single write. Listeners and mvcc
+            undo locate the records of every page but the last one in the file, for them each page is written
+            as soon as it is full.
+        """
+        if self.mvcc or len(self.listeners) > 0:
+            return 1
+        return max(WRITE_BUFFER_SIZE // self.page_size,1)
+
+    def add_record(self,record:tuple,transaction = None):
+        """
+            Append a record to the table. On mvcc tables the record is stamped with the id of the given
+            transaction, or as frozen (visible to everyone once written) when there is no transaction.
+        """
+        with self.lock:
+            values = record
+            if self.mvcc:
+                xmin = transaction.xid if transaction is not None else FROZEN_XID
+                record = (xmin,INVALID_XID,*record)
+                self.header.next_xid = max(self.header.next_xid,xmin + 1)
+            if len(self.text_columns) > 0:
+                record = self.store_long_values(record)
             page = self.last_page()
-            self.header.end_offset = self.header.end_offset + PAGE_SIZE
-            
-        page.add_record(record,self.header.schema)
-        self.header.table_size = self.header.byte_format.size + PAGE_SIZE * len(self.pages)
+            record = PageRecord(record)
+            if not self.has_free_space(page,record=record):
+                if len(self.pages) >= self.write_buffer_pages():
+                    self.write()
+                    self.pages.pop()
+                self.pages.append(DBPage(page_size=self.page_size))
+                page = self.last_page()
+                self.header.end_offset = self.header.end_offset + self.page_size
+
+            if self.header.sort_col is not None:
+                self.check_sort_order(page,values)
+            page.add_record(record,self.header.schema)
+            self.header.table_size = self.header.byte_format.size + self.page_size * len(self.pages)
+            if transaction is not None and self.mvcc:
+                transaction.record_write(self,self.last_page_no(),len(page.records) - 1,0)
+            for listener in self.listeners:
+                listener.record_added(values)
+
+    def commit(self):
+        """
+            Write the pending pages and let the listeners know the records added so far are durable.
+        """
+        self.write()
+        for listener in self.listeners:
+            listener.committed()
+
+    def rollback(self):
+        """
+            Write the pages after the changes of an aborted transaction have been undone and let the
+            listeners drop the records they have not seen committed.
+        """
+        self.write()
+        for listener in self.listeners:
+            if hasattr(listener,'rolled_back'):
+                listener.rolled_back()
+
+    def last_page_no(self) -> int:
+        return (self.header.end_offset - DB_HEADER_SIZE) // self.page_size - 1
+
+    def inline_limit(self) -> int:
+        """
+            Longest text value in bytes stored inside the record, longer ones go to overflow pages.
+        """
+        return self.page_size // 8
+
+    def store_long_values(self,record:tuple) -> tuple:
+        values = list(record)
+        for i in self.text_columns:
+            i += self.hidden_columns
+            value = values[i]
+            if isinstance(value,str):
+                data = value.encode('utf-8')
+                if len(data) > self.inline_limit():
+                    values[i] = OverflowRef(self.write_overflow(data),len(data))
+        return tuple(values)
+
+    def overflow_file(self):
+        if self.overflow is None:
+            path = self.db_path + '.ovf'
+            self.overflow = open(path,mode='r+b' if os.path.isfile(path) else 'w+b')
+        return self.overflow
+
+    def write_overflow(self,data:bytes) -> int:
+        """
+            Append the value to the overflow file as a chain of pages, each page starts with the number of the
+            next page (-1 for the last one) and the number of bytes it holds. Returns the first page number.
+        """
+        fd = self.overflow_file().fileno()
+        capacity = self.page_size - OVERFLOW_HEADER.size
+        n_pages = max((len(data) + capacity - 1) // capacity,1)
+        first_page = os.fstat(fd).st_size // self.page_size
+        chain = bytearray()
+        for i in range(n_pages):
+            chunk = data[i*capacity:(i+1)*capacity]
+            next_page = first_page + i + 1 if i < n_pages - 1 else -1
+            page = bytearray(self.page_size)
+            page[0:OVERFLOW_HEADER.size] = OVERFLOW_HEADER.pack(next_page,len(chunk))
+            page[OVERFLOW_HEADER.size:OVERFLOW_HEADER.size+len(chunk)] = chunk
+            chain.extend(page)
+        os.pwrite(fd,chain,first_page * self.page_size)
+        return first_page
+
+    def read_overflow(self,ref:"OverflowRef") -> str:
+        fd = self.overflow_file().fileno()
+        data = bytearray()
+        page_no = ref.page_no
+        while page_no >= 0 and len(data) < ref.length:
+            page = os.pread(fd,self.page_size,page_no * self.page_size)
+            page_no,size = OVERFLOW_HEADER.unpack_from(page)
+            data.extend(page[OVERFLOW_HEADER.size:OVERFLOW_HEADER.size+size])
+        return bytes(data).decode('utf-8')
+
+    def resolve_overflow(self,records:list) -> list:
+        """
+            Replace the overflow references of the decoded records with their values.
+        """
+        if len(self.text_columns) == 0:
+            return records
+        columns = [i + self.hidden_columns for i in self.text_columns]
+        result = []
+        for record in records:
+            if any(isinstance(record[i],OverflowRef) for i in columns):
+                record = tuple(self.read_overflow(v) if isinstance(v,OverflowRef) else v for v in record)
+            result.append(record)
+        return result
+
+    def set_record_field(self,page_no:int,slot:int,field:int,value:int):
+        """
+            Overwrite one of the hidden int columns (0 xmin, 1 xmax) of a record in place, in the page kept in
+            memory when it is the last page or directly in the file.
+        """
+        with self.lock:
+            if page_no == self.last_page_no() and len(self.pages) > 0:
+                page_record = self.pages[-1].records[slot]
+                values = list(page_record.record)
+                values[field] = value
+                page_record.record = tuple(values)
+                return
+            pointer = PAGE_STATIC_HEADER_SIZE + 8 * slot
+            page_bytes = os.pread(self.db.fileno(),pointer + 8,self.page_offset(page_no))
+            end_offset,size = struct.unpack('<ii',page_bytes[pointer:pointer+8])
+            schema = self.header.schema
+            field_offset = schema.offsets[field] if schema.record_format == RECORD_FORMAT_V2 else 4 * field
+            os.pwrite(self.db.fileno(),struct.pack('<i',value),self.page_offset(page_no) + end_offset - size + field_offset)
+
+    def visible_records(self,page:"DBPage",snapshot) -> list:
+        """
+            Records of a decoded page without the hidden columns, on mvcc tables only the ones visible in the
+            snapshot.
+        """
+        if not self.mvcc:
+            return self.resolve_overflow([record.record for record in page.records])
+        hidden = self.hidden_columns
+        records = [record.record for record in page.records if snapshot.is_visible(record.record[0],record.record[1])]
+        return [record[hidden:] for record in self.resolve_overflow(records)]
+
+    def delete(self,predicate,transaction) -> int:
+        """
+            Delete the records visible to the transaction that satisfy the predicate by setting their xmax.
+            A record deleted by a concurrent transaction raises WriteConflict. Returns the deleted records.
+        """
+        if not self.mvcc:
+            raise NotImplementedError("records can only be deleted from mvcc tables")
+        self.write()
+        self.header.next_xid = max(self.header.next_xid,transaction.xid + 1)
+        deleted = 0
+        snapshot = transaction.snapshot
+        for page_no in range(self.page_count()):
+            page = DBPage()
+            page.decode(self.read_page(page_no),self.header.schema)
+            for slot,record in enumerate(page.records):
+                xmin,xmax,values = record.record[0],record.record[1],record.record[self.hidden_columns:]
+                if not snapshot.sees(xmin) or xmin == INVALID_XID or not predicate(values):
+                    continue
+                if xmax != INVALID_XID and snapshot.sees(xmax):
+                    continue
+                if xmax != INVALID_XID:
+                    raise WriteConflict(f"record {values} was deleted by the concurrent transaction {xmax}")
+                self.set_record_field(page_no,slot,1,transaction.xid)
+                transaction.record_write(self,page_no,slot,1)
+                deleted += 1
+        return deleted
+
+    def add_listener(self,listener):
+        """
+            Register an object to be notified of the changes to the table, like a materialized view. It must
+            implement record_added(record) and committed().
+        """
+        self.listeners.append(listener)
         
 
+    def check_sort_order(self,page:"DBPage",record:tuple):
+        """
+            Clear the sort column of the header when the new record breaks the order of the clustered table.
+        """
+        sort_col = self.header.sort_col
+        if len(page.records) > 0:
+            self.last_sort_key = page.records[-1].record[self.hidden_columns + sort_col]
+        if self.last_sort_key is not None and record[sort_col] < self.last_sort_key:
+            self.header.sort_col = None
+        self.last_sort_key = record[sort_col]
+
     def combine_pages(self,x,y,schema) -> bytearray:
    
         if isinstance(x,DBPage) and isinstance(y,DBPage):
@@ -109,7 +451,7 @@ class DataBase:
         i = 0
         while i < n_pages:
             page = next(iter_pager)
-            page.decode(page_bytes[PAGE_SIZE*i:PAGE_SIZE*(i+1)],self.header.schema)
+            page.decode(page_bytes[self.page_size*i:self.page_size*(i+1)],self.header.schema)
             i+=1
             
         return (self.header,self.pages)
@@ -122,7 +464,8 @@ class DataBase:
             f.write(self.db.read())
 
     def has_free_space(self,page:"DBPage",record:"PageRecord") -> bool:
-        return page.header.end_offset - len(record.encode(self.header.schema)) > page.header.start_offset + 8        
+        # the record and its 8 bytes pointer must fit between the pointers and the records already in the page
+        return page.header.end_offset - len(record.encode(self.header.schema)) >= page.header.start_offset + 8
 
     def last_page(self) -> "DBPage":
         """
@@ -133,9 +476,8 @@ class DataBase:
         if n > 0:
            last = n-1
         else:
-            self.db.seek( self.header.end_offset - PAGE_SIZE if self.header.end_offset > 0 else 0)
-            page_bytes = self.db.read(PAGE_SIZE)
-            page = DBPage()
+            page_bytes = os.pread(self.db.fileno(),self.page_size,self.header.end_offset - self.page_size if self.header.end_offset > 0 else 0)
+            page = DBPage(page_size=self.page_size)
             page.decode(page_bytes,self.header.schema)
             self.pages.append(page)
             last = 0
@@ -154,8 +496,8 @@ class DataBase:
            self.header.decode(db_header_bytes)
         else:
            db = open(self.db_path,mode='w+b')
-           self.pages.append(DBPage())
-           self.header.end_offset = self.header.end_offset + PAGE_SIZE
+           self.pages.append(DBPage(page_size=self.header.page_size))
+           self.header.end_offset = self.header.end_offset + self.header.page_size
         return db
 
         
@@ -163,6 +505,8 @@ class DataBase:
     def __del__(self):
         if self.db is not None:
             self.db.close()    
+        if getattr(self,'overflow',None) is not None:
+            self.overflow.close()
 
 class DBHeader:
 
@@ -171,7 +515,14 @@ class DBHeader:
         self.table_name = table_name
         self.schema =  schema #this adds an internal id of type int to the schema
         self.table_size = table_size
-        self.byte_format = struct.Struct("<64s64s256siiq")
+        self.sort_col = None # column the records are physically sorted on, set when the table is clustered
+        self.mvcc = False # records carry the hidden xmin and xmax columns
+        self.next_xid = FROZEN_XID + 1 # next transaction id of mvcc tables
+        self.page_size = PAGE_SIZE
+        self.record_format = RECORD_FORMAT_V1
+        # the last 64 bytes of the original 256 bytes schema field hold the table properties, the sort column is
+        # stored plus one so the zero padding of the files written before means not sorted
+        self.byte_format = struct.Struct("<64s64s192siiiii44siiq")
         self.start_offset = self.byte_format.size # start offset of the first page created, this should help to read records
         self.end_offset = self.byte_format.size # end offset of the last page created, this should help to append new pages when the existing ones are full.
         #should we include total number of pages?
@@ -183,7 +534,10 @@ class DBHeader:
         start_offset = self.__get_start_offset()
         end_offset = self.__get_end_offset()
         table_size = self.__get_table_size()
-        result = self.byte_format.pack(db_name,table_name,schema,table_size,start_offset,end_offset)
+        sort_col = self.sort_col + 1 if self.sort_col is not None else 0
+        flags = HEADER_FLAG_MVCC if self.mvcc else 0
+        result = self.byte_format.pack(db_name,table_name,schema,sort_col,flags,self.next_xid,self.page_size,self.record_format,b'',
+                                       table_size,start_offset,end_offset)
         return result
     
     def decode(self,header:bytes):
@@ -193,6 +547,12 @@ class DBHeader:
             - byte 0 database name
             - byte 64 table name
             - byte 128 schema
+            - byte 320 sort column plus one, zero when the table is not sorted
+            - byte 324 flags, bit 0 set for mvcc tables
+            - byte 328 next transaction id
+            - byte 332 page size, zero for the tables created before it was configurable which use 4096
+            - byte 336 record format, zero for the tables created before it was configurable which use the first one
+            - byte 340 reserved
             - byte 384 table size
             - byte 388 start offset
             - byte 392 end offset
@@ -200,6 +560,13 @@ class DBHeader:
         self.db_name = header[0:64].decode('utf-8')
         self.table_name = header[64:128].decode('utf-8')
         #self.schema = tuple(header[128:384].decode('utf-8').split(','))
+        sort_col = int.from_bytes(header[320:324],'little')
+        self.sort_col = sort_col - 1 if sort_col > 0 else None
+        flags = int.from_bytes(header[324:328],'little')
+        self.mvcc = bool(flags & HEADER_FLAG_MVCC)
+        self.next_xid = max(int.from_bytes(header[328:332],'little'),FROZEN_XID + 1)
+        self.page_size = int.from_bytes(header[332:336],'little') or PAGE_SIZE
+        self.record_format = int.from_bytes(header[336:340],'little') or RECORD_FORMAT_V1
         self.table_size = int.from_bytes(header[384:388],'little')
         self.start_offset = int.from_bytes(header[388:392],'little')
         self.end_offset = int.from_bytes(header[392:DB_HEADER_SIZE],'little')
@@ -308,7 +675,10 @@ class PageRecord:
             this implies that an empty str may be considered null.
 
             In order to remove complexity from parsing we assume the recors columns are in the same order as the schema.
+            When the schema is a RecordSchema of the fixed offset format the record is encoded in that format.
         """
+        if getattr(schema,'record_format',RECORD_FORMAT_V1) == RECORD_FORMAT_V2:
+            return self.encode_fixed_offsets(schema)
         result_record = bytearray()
         n = len(self.record)
         i = 0
@@ -321,6 +691,18 @@ class PageRecord:
             elif dtype == 'float':
                 cur_col = self.record[i]
                 result_record.extend(struct.pack('f',float(cur_col)))
+            elif dtype == 'double':
+                cur_col = self.record[i]
+                result_record.extend(struct.pack('d',float(cur_col)))
+            elif dtype == 'text':
+                # one byte kind and the length, followed by the value or by the first overflow page
+                cur_col = self.record[i]
+                if isinstance(cur_col,OverflowRef):
+                    result_record.extend(struct.pack('<Bii',TEXT_OVERFLOW,cur_col.length,cur_col.page_no))
+                else:
+                    content = cur_col.encode('utf-8')
+                    result_record.extend(struct.pack('<Bi',TEXT_INLINE,len(content)))
+                    result_record.extend(content)
             elif dtype == 'str':
                 cur_col = self.record[i]
                 col_size = len(cur_col.encode('utf-8'))
@@ -334,16 +716,46 @@ class PageRecord:
             i+=1
         return result_record
     
+    def encode_fixed_offsets(self,schema:RecordSchema) -> bytearray:
+        nulls = 0
+        fixed_values = []
+        for i in schema.fixed_columns:
+            value = self.record[i]
+            if value is None:
+                nulls |= 1 << i
+                value = 0
+            fixed_values.append(int(value) if schema[i] == 'int' else float(value))
+        var_values = bytearray()
+        end_offsets = []
+        for i in schema.var_columns:
+            value = self.record[i]
+            if value is None:
+                nulls |= 1 << i
+            elif isinstance(value,OverflowRef):
+                var_values.extend(struct.pack('<Bii',TEXT_OVERFLOW,value.length,value.page_no))
+            elif schema[i] == 'text':
+                var_values.append(TEXT_INLINE)
+                var_values.extend(value.encode('utf-8'))
+            else:
+                var_values.extend(value.encode('utf-8'))
+            end_offsets.append(schema.var_start + len(var_values))
+        result_record = bytearray(nulls.to_bytes(schema.null_bytes,'little'))
+        result_record.extend(schema.fixed_format.pack(*fixed_values))
+        result_record.extend(struct.pack(f"<{len(end_offsets)}H",*end_offsets))
+        result_record.extend(var_values)
+        return result_record
+
     def set_internal_id(self,id:int):
         self.record = (id,*self.record)
 
 
 class DBPage:
-    def __init__(self,header:PageHeader = None,records:List[PageRecord] = None):
+    def __init__(self,header:PageHeader = None,records:List[PageRecord] = None,page_size:int = PAGE_SIZE):
         self.static_header_format = struct.Struct("<iiiii")
+        self.page_size = page_size
         if header is None:
             start_offset = self.static_header_format.size
-            end_offset = PAGE_SIZE
+            end_offset = page_size
             self.header = PageHeader(0,0,start_offset,end_offset,[],self.static_header_format)
             self.records = []
         else:
@@ -355,7 +767,7 @@ class DBPage:
             This function uses the DBPage object content(header and records) and convert them into byte format,
             so it can eventually be used to persist on disk. It returns the page in bytes.
         """
-        page = bytearray(PAGE_SIZE)
+        page = bytearray(self.page_size)
         if self.records is None:
             encoded_header = self.header.encode()
             header_size = len(encoded_header)
@@ -372,10 +784,11 @@ class DBPage:
     
         return page
     
-    def decode(self,page_bytes:bytes,schema:tuple):
+    def decode(self,page_bytes:bytes,schema:tuple,columns:set = None):
         """
             This function takes a page in byte format as input and parse it to human redeable format.
-            It uses the record pointers in the header of the page to reading each row.
+            It uses the record pointers in the header of the page to reading each row. If columns is provided
+            only those columns are decoded and the rest are returned as None.
         """
         start_offset = int.from_bytes(page_bytes[12:16],"little")
         page_header = page_bytes[0:start_offset]
@@ -386,48 +799,110 @@ class DBPage:
             #print("record_size: {}, start_offset: {}".format(record_size,start_offset))
             record_bytes = page_bytes[start_offset:start_offset+record_size]
             #print("record: {}".format(record_bytes))
-            record = self.decode_record(record_bytes,schema)
+            record = self.decode_record(record_bytes,schema,columns)
             self.records.append(PageRecord(record))
     
     
-    def decode_record(self, record:bytes,schema:tuple) -> tuple:
+    def decode_record(self, record:bytes,schema:tuple,columns:set = None) -> tuple:
         """
             First four bytes represent the column size.
             The next bytes from the end of the column size to the column size represent the content of the current column.
             We assume record columns has the same order as the schema so we use it to parse the types.
+            Columns not included in the columns set are skipped without decoding their content.
+            Records of the fixed offset format are read one column at a time with decode_field.
         """
+        if getattr(schema,'record_format',RECORD_FORMAT_V1) == RECORD_FORMAT_V2:
+            return tuple(self.decode_field(record,schema,i) if columns is None or i in columns else None for i in range(len(schema)))
         total_columns = len(schema)
         i = 0
         decode_record = []
         start_index =  i
         while i < total_columns:
             dtype =  schema[i]            
+            skip = columns is not None and i not in columns
             
             if dtype == 'int':
                 end_index = start_index+4
                 col_content = record[start_index:end_index]
-                value = int.from_bytes(col_content,'little')
+                value = None if skip else int.from_bytes(col_content,'little')
                 decode_record.append(value)
                 start_index = end_index
             elif dtype == 'float':
                 end_index = start_index+4
                 col_content = record[start_index:end_index]
-                value = struct.unpack('f',col_content)[0]
+                value = None if skip else struct.unpack('f',col_content)[0]
+                decode_record.append(value)
+                start_index = end_index
+            elif dtype == 'double':
+                end_index = start_index+8
+                col_content = record[start_index:end_index]
+                value = None if skip else struct.unpack('d',col_content)[0]
                 decode_record.append(value)
                 start_index = end_index
             elif dtype == 'str':
                 end_index = start_index+1
                 col_size = int.from_bytes(record[start_index:end_index],'little')
                 col_content = record[end_index:end_index+col_size]
-                value = col_content.decode('utf8')
+                value = None if skip else col_content.decode('utf8')
                 decode_record.append(value)
                 start_index = end_index+col_size
+            elif dtype == 'text':
+                kind,col_size = struct.unpack_from('<Bi',record,start_index)
+                end_index = start_index+5
+                if kind == TEXT_OVERFLOW:
+                    page_no = struct.unpack_from('<i',record,end_index)[0]
+                    value = None if skip else OverflowRef(page_no,col_size)
+                    start_index = end_index+4
+                else:
+                    value = None if skip else record[end_index:end_index+col_size].decode('utf8')
+                    start_index = end_index+col_size
+                decode_record.append(value)
             else:
                 raise('dtype {} is not supported by the enconding algorithm',dtype)
             i+=1
             
         return tuple(decode_record)
 
+    def decode_field(self,record:bytes,schema:RecordSchema,col:int):
+        """
+            Value of one column of a record in the fixed offset format, read at the offset of the column.
+        """
+        if record[col >> 3] >> (col & 7) & 1:
+            return None
+        offset = schema.offsets[col]
+        if col in schema.field_formats:
+            return schema.field_formats[col].unpack_from(record,offset)[0]
+        start = schema.var_start if col == schema.var_columns[0] else int.from_bytes(record[offset-2:offset],'little')
+        end = int.from_bytes(record[offset:offset+2],'little')
+        if schema[col] == 'text':
+            if record[start] == TEXT_OVERFLOW:
+                length,page_no = struct.unpack_from('<ii',record,start+1)
+                return OverflowRef(page_no,length)
+            start += 1
+        return bytes(record[start:end]).decode('utf8')
+
+    def decode_columns(self,page_bytes:bytes,schema:tuple,columns:list) -> dict:
+        """
+            Decode the given columns of every record in the page as numpy arrays. When the schema only has fixed
+            width columns (int, float, double) every record has the same size and the records are stored one next to the other from the
+            end of the page, so the whole block is decoded at once with a numpy structured dtype. Otherwise the
+            records are decoded one by one and the arrays are built from them.
+        """
+        n_records = int.from_bytes(page_bytes[8:12],'little')
+        if n_records == 0:
+            return {i: np.empty(0,dtype=numpy_dtype(schema[i])) for i in columns}
+        if all(dtype in FIXED_WIDTH for dtype in schema) and getattr(schema,'record_format',RECORD_FORMAT_V1) == RECORD_FORMAT_V1:
+            record_size = sum(FIXED_WIDTH[dtype] for dtype in schema)
+            last_pointer = 20 + 8 * (n_records - 1)
+            end_offset = int.from_bytes(page_bytes[last_pointer:last_pointer+4],'little')
+            block_start = len(page_bytes) - record_size * n_records
+            if end_offset - record_size == block_start:
+                dtype = np.dtype([(f"c{i}",numpy_dtype(d)) for i,d in enumerate(schema)])
+                block = np.frombuffer(page_bytes,dtype=dtype,count=n_records,offset=block_start)[::-1]
+                return {i: block[f"c{i}"] for i in columns}
+        self.decode(page_bytes,schema,set(columns))
+        return {i: np.array([record.record[i] for record in self.records],dtype=numpy_dtype(schema[i])) for i in columns}
+
     def add_record(self,record:PageRecord,schema:tuple):
         """
             This function adds the row into the list of existing rows in the page. 
@@ -448,6 +923,68 @@ class DBPage:
         self.header.update(max_id=id,start_offset=start_offset,end_offset=end_offset)
 
 
+def numpy_dtype(dtype:str):
+    return {'int': '<i4', 'float': '<f4', 'double': '<f8'}.get(dtype,object)
+
+
+class ZoneMap:
+    """
+        Min and max value of every int, float and double column for each page of a table. It is stored in a file next
+        to the table together with the size and modification time of the table file, if the table changes
+        after the zone map was built the zone map is considered stale and it is not used.
+    """
+    def __init__(self,db_path:str,schema:tuple):
+        self.db_path = db_path
+        self.path = db_path + '.zm'
+        self.schema = schema
+        self.numeric_columns = [i for i,dtype in enumerate(schema) if dtype in FIXED_WIDTH]
+        self.zones:list[dict] = list()
+        self.byte_format = struct.Struct('<' + 'dd' * len(self.numeric_columns))
+
+    def add_page(self,records:list):
+        zone = dict()
+        for i in self.numeric_columns:
+            values = [record[i] for record in records if record[i] is not None]
+            zone[i] = (min(values),max(values)) if len(values) > 0 else (float('inf'),float('-inf'))
+        self.zones.append(zone)
+
+    def page_zone(self,page_no:int) -> dict:
+        if page_no < len(self.zones):
+            return self.zones[page_no]
+        return dict()
+
+    def table_signature(self) -> tuple:
+        stat = os.stat(self.db_path)
+        return (stat.st_size,stat.st_mtime_ns)
+
+    def save(self):
+        size,mtime = self.table_signature()
+        with open(self.path,'wb') as f:
+            f.write(struct.pack('<qqi',size,mtime,len(self.zones)))
+            for zone in self.zones:
+                f.write(self.byte_format.pack(*[bound for i in self.numeric_columns for bound in zone[i]]))
+
+    @classmethod
+    def load(cls,db_path:str,schema:tuple):
+        """
+            Load the zone map of the table, it returns None when there is no zone map or it is stale.
+        """
+        zone_map = cls(db_path,schema)
+        if not os.path.isfile(zone_map.path):
+            return None
+        with open(zone_map.path,'rb') as f:
+            content = f.read()
+        size,mtime,n_pages = struct.unpack('<qqi',content[0:20])
+        if (size,mtime) != zone_map.table_signature():
+            return None
+        offset = 20
+        for _ in range(n_pages):
+            bounds = zone_map.byte_format.unpack(content[offset:offset+zone_map.byte_format.size])
+            offset += zone_map.byte_format.size
+            zone_map.zones.append({col:(bounds[2*j],bounds[2*j+1]) for j,col in enumerate(zone_map.numeric_columns)})
+        return zone_map
+
+
 def get_next_tuple(reader) -> tuple:
         try:
             return tuple(next(reader))
@@ -0,0 +1,416 @@
+"""
+Sharded execution over several worker nodes. Every worker owns some table files (shards) and runs query
+fragments over them: a scan with the pushed down predicate, optionally a hash join with rows broadcast by the
+coordinator and a partial aggregate. The coordinator sends the same fragment to every worker over TCP, reads
+the streamed rows of all the workers in parallel and merges the partial aggregates.
+
+    python distributed.py 127.0.0.1:9001 ratings=ratings_0.db,ratings_1.db
+
+    coordinator = Coordinator([('127.0.0.1',9001),('127.0.0.1',9002)])
+    q = coordinator.distribute(Q(Aggregation(Col(1),Col(2),'avg'),Selection(Col(2) > 3.0),coordinator.table('ratings',schema)))
+
+distribute() rewrites the tree built with Q(...): the Selection, Aggregation and HashJoin nodes right above a
+sharded table are moved into its fragment when their predicates and keys are expressions, everything else runs
+in the coordinator. Messages are JSON lines, the fragment expressions are sent with Expr.to_dict.
+"""
+import json
+import multiprocessing
+import socket
+import socketserver
+import sys
+import threading
+
+from executor import CHILD_ATTRIBUTES, Q, run, Aggregation, Exchange, FileScan, HashJoin, MemoryScan, Selection
+from expressions import Expr, And, Col, expr_from_dict
+
+PARTIAL_FUNCTIONS = ('sum','count','avg','min','max')
+
+
+class RemoteError(Exception):
+    pass
+
+
+def merge_state(states:dict,key,value):
+    """
+    Add a value to the (sum, count, min, max) state of its group.
+    """
+    state = states.get(key)
+    if state is None:
+        state = states[key] = [0,0,None,None]
+    if value is None:
+        return
+    state[0] += value
+    state[1] += 1
+    state[2] = value if state[2] is None or value < state[2] else state[2]
+    state[3] = value if state[3] is None or value > state[3] else state[3]
+
+
+def merge_states(states:dict,key,state:tuple):
+    total,count,low,high = state
+    current = states.get(key)
+    if current is None:
+        states[key] = [total,count,low,high]
+        return
+    current[0] += total
+    current[1] += count
+    current[2] = low if current[2] is None or (low is not None and low < current[2]) else current[2]
+    current[3] = high if current[3] is None or (high is not None and high > current[3]) else current[3]
+
+
+def final_value(func_name:str,state:list):
+    total,count,low,high = state
+    if func_name == 'sum':
+        return total
+    elif func_name == 'count':
+        return count
+    elif func_name == 'avg':
+        return round(total / count,2) if count > 0 else None
+    return low if func_name == 'min' else high
+
+
+class ShardWorker:
+    """
+    TCP server running the fragments sent by a coordinator over the shards of this node, `shards` maps a
+    table name to the list of its table files stored here.
+    """
+    batch_size = 1024
+
+    def __init__(self,shards:dict,host:str = '127.0.0.1',port:int = 0):
+        self.shards = {table: list(paths) for table,paths in shards.items()}
+        self.server = socketserver.ThreadingTCPServer((host,port),FragmentHandler)
+        self.server.daemon_threads = True
+        self.server.worker = self
+        self.thread = None
+
+    @property
+    def address(self) -> tuple:
+        return self.server.server_address[:2]
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def execute(self,fragment:dict,stats:dict):
+        """
+        Run the fragment over every shard of the table, yielding the rows in batches. With an aggregate the
+        (group, sum, count, min, max) state of every group is returned once all the shards have been read.
+        """
+        paths = self.shards.get(fragment['table'])
+        if paths is None:
+            raise KeyError(f"this worker has no shard of the table {fragment['table']}")
+        schema = tuple(fragment['schema'])
+        predicate = expr_from_dict(fragment['predicate']) if fragment['predicate'] is not None else None
+        params = tuple(fragment['params'])
+        join = fragment['join']
+        aggregate = fragment['aggregate']
+        if aggregate is not None:
+            group_col = expr_from_dict(aggregate['group']).compile()
+            col = expr_from_dict(aggregate['value']).compile()
+        states = dict()
+        batch = []
+        for path in paths:
+            scan = FileScan(path,fragment['db_name'],fragment['table'],schema,predicate=predicate,params=params)
+            q = Q(scan)
+            if join is not None:
+                q = Q(HashJoin(Q(MemoryScan([tuple(row) for row in join['rows']])),q,expr_from_dict(join['left_key']),expr_from_dict(join['right_key'])))
+            for row in run(q):
+                if aggregate is not None:
+                    merge_state(states,group_col(row),col(row))
+                    continue
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+            stats['pages_read'] += scan.pages_read
+        if aggregate is not None:
+            batch = [(key,*state) for key,state in states.items()]
+        for i in range(0,len(batch),self.batch_size):
+            yield batch[i:i+self.batch_size]
+
+
+class FragmentHandler(socketserver.StreamRequestHandler):
+
+    def send(self,message:dict):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+
+    def handle(self):
+        stats = {'pages_read': 0}
+        try:
+            fragment = json.loads(self.rfile.readline())
+            for batch in self.server.worker.execute(fragment,stats):
+                self.send({'rows': batch})
+        except Exception as e:
+            self.send({'error': f"{type(e).__name__}: {e}"})
+            return
+        self.send({'done': True,**stats})
+
+
+def serve_worker(shards:dict,host:str = '127.0.0.1',port:int = 0,connection = None):
+    worker = ShardWorker(shards,host,port)
+    if connection is not None:
+        connection.send(worker.address)
+        connection.close()
+    worker.serve_forever()
+
+
+def spawn_worker(shards:dict,host:str = '127.0.0.1'):
+    """
+    Start a worker in a new process listening on a free port, returns the process and the worker address.
+    """
+    context = multiprocessing.get_context('fork')
+    parent,child = context.Pipe()
+    process = context.Process(target=serve_worker,args=(shards,host,0,child),daemon=True)
+    process.start()
+    address = tuple(parent.recv())
+    return process,address
+
+
+class FragmentStream(object):
+    """
+    Send a fragment to one worker and return the rows it streams back.
+    """
+    def __init__(self,address:tuple,fragment:dict):
+        self.address = address
+        self.fragment = fragment
+        self.file = None
+        self.rows = []
+        self.slot = 0
+        self.done = False
+        self.pages_read = 0
+
+    def connect(self):
+        connection = socket.create_connection(self.address)
+        connection.sendall((json.dumps(self.fragment) + '\n').encode('utf-8'))
+        self.file = connection.makefile('r',encoding='utf-8')
+        connection.close()
+
+    def next(self):
+        if self.has_next():
+            row = self.rows[self.slot]
+            self.slot += 1
+            return row
+        return None
+
+    def has_next(self):
+        while self.slot >= len(self.rows):
+            if self.done:
+                return False
+            if self.file is None:
+                self.connect()
+            line = self.file.readline()
+            if line == '':
+                self.close()
+                raise RemoteError(f"the worker {self.address} closed the connection")
+            message = json.loads(line)
+            if 'error' in message:
+                self.close()
+                raise RemoteError(f"the worker {self.address} failed: {message['error']}")
+            elif 'done' in message:
+                self.pages_read = message['pages_read']
+                self.done = True
+                self.close()
+            else:
+                self.rows = [tuple(row) for row in message['rows']]
+                self.slot = 0
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def reset(self):
+        self.close()
+        self.rows = []
+        self.slot = 0
+        self.done = False
+
+
+class RemoteScan(object):
+    """
+    Scan of a table sharded over the workers of a coordinator. The fragment runs on every worker and their rows
+    are read in parallel through a gather Exchange. With an aggregate the partial states of the workers are
+    merged and the (group, value) rows are returned, in no particular order.
+    """
+    def __init__(self,coordinator:"Coordinator",table:str,schema:tuple,db_name:str = 'mydb'):
+        self.coordinator = coordinator
+        self.table = table
+        self.schema = tuple(schema)
+        self.db_name = db_name
+        self.predicate = None
+        self.params = ()
+        self.join = None
+        self.aggregate = None
+        self.streams = []
+        self.exchange = None
+        self.results = None
+
+    def add_predicate(self,predicate:Expr,params:tuple = ()) -> bool:
+        if self.join is not None or self.aggregate is not None or (len(self.params) > 0 and len(params) > 0 and tuple(params) != self.params):
+            return False
+        self.predicate = predicate if self.predicate is None else And(self.predicate,predicate)
+        self.params = tuple(params) or self.params
+        return True
+
+    def add_join(self,build_node,left_key:Expr,right_key:Expr) -> bool:
+        """
+        Join the shard rows with the rows of build_node, that are collected by the coordinator and sent to every
+        worker. The output is (*build row, *shard row) as in HashJoin.
+        """
+        if self.join is not None or self.aggregate is not None:
+            return False
+        self.join = (build_node,left_key,right_key)
+        return True
+
+    def add_aggregate(self,group_col:Expr,col:Expr,func_name:str) -> bool:
+        if self.aggregate is not None or func_name.lower() not in PARTIAL_FUNCTIONS:
+            return False
+        self.aggregate = (group_col,col,func_name.lower())
+        return True
+
+    def fragment(self) -> dict:
+        join = None
+        if self.join is not None:
+            build_node,left_key,right_key = self.join
+            join = {'rows': [list(row) for row in run(build_node)],'left_key': left_key.to_dict(),'right_key': right_key.to_dict()}
+        aggregate = None
+        if self.aggregate is not None:
+            group_col,col,func_name = self.aggregate
+            aggregate = {'group': group_col.to_dict(),'value': col.to_dict(),'func': func_name}
+        return {'table': self.table,'db_name': self.db_name,'schema': list(self.schema),
+                'predicate': self.predicate.to_dict() if self.predicate is not None else None,
+                'params': list(self.params),'join': join,'aggregate': aggregate}
+
+    def start(self):
+        if self.exchange is not None:
+            return
+        fragment = self.fragment()
+        self.streams = [FragmentStream(address,fragment) for address in self.coordinator.workers]
+        self.exchange = Exchange(inputs=self.streams)
+        if self.aggregate is not None:
+            states = dict()
+            for key,*state in run(self.exchange):
+                merge_states(states,key,state)
+            self.results = [(key,final_value(self.aggregate[2],state)) for key,state in states.items()]
+            self.results.reverse()
+
+    def next(self):
+        self.start()
+        if self.results is not None:
+            return self.results.pop() if len(self.results) > 0 else None
+        return self.exchange.next()
+
+    def has_next(self):
+        self.start()
+        if self.results is not None:
+            return len(self.results) > 0
+        return self.exchange.has_next()
+
+    def reset(self):
+        if self.exchange is not None:
+            self.exchange.close()
+        self.exchange = None
+        self.results = None
+
+    def explain_metrics(self) -> dict:
+        return {'table': self.table,'workers': len(self.coordinator.workers),
+                'pages_read': sum(stream.pages_read for stream in self.streams)}
+
+
+class Coordinator:
+
+    def __init__(self,workers:list):
+        self.workers = [tuple(address) for address in workers]
+
+    def table(self,name:str,schema:tuple,db_name:str = 'mydb') -> RemoteScan:
+        return RemoteScan(self,name,schema,db_name)
+
+    def distribute(self,node):
+        """
+        Move the operators right above the sharded tables of the tree into their fragments, returns the new
+        root. Only expressions can be sent to the workers, operators built with functions stay in the coordinator.
+        """
+        for attr in CHILD_ATTRIBUTES:
+            child = getattr(node,attr,None)
+            if child is not None:
+                setattr(node,attr,self.distribute(child))
+        if isinstance(node,Selection) and isinstance(node.child,RemoteScan) and node.expr is not None:
+            if node.child.add_predicate(node.expr,node.params):
+                return node.child
+        elif isinstance(node,Aggregation) and isinstance(node.child,RemoteScan) and node.group_expr is not None \
+                and node.col_expr is not None and not node.emit_state and not node.merge_states:
+            if node.child.add_aggregate(node.group_expr,node.col_expr,node.func_name):
+                return node.child
+        elif isinstance(node,HashJoin) and isinstance(node.right_node,RemoteScan) and not isinstance(node.left_node,RemoteScan) \
+                and node.left_key_expr is not None and node.right_key_expr is not None:
+            if node.right_node.add_join(node.left_node,node.left_key_expr,node.right_key_expr):
+                return node.right_node
+        return node
+
+
+class TestDistributed:
+    schema = ('int','int','float','int')
+    ratings = [(i % 300,(i * 7919) % 200,float(i % 10) / 2,1000000000 + i) for i in range(6000)]
+
+    def start_workers(self,tmp_path,n_workers:int = 3) -> list:
+        from views import create_ratings
+        processes = []
+        for worker in range(n_workers):
+            path = str(tmp_path / f"ratings_{worker}.db")
+            db = create_ratings(path,[x for x in self.ratings if x[0] % n_workers == worker])
+            db.db.close()
+            db.db = None
+            processes.append(spawn_worker({'ratings': [path]}))
+        return processes
+
+    def test_scan_aggregate_and_join(self,tmp_path):
+        processes = self.start_workers(tmp_path)
+        try:
+            coordinator = Coordinator([address for _,address in processes])
+            q = coordinator.distribute(Q(Selection(Col(2) >= 4.0),coordinator.table('ratings',self.schema)))
+            assert isinstance(q,RemoteScan)
+            assert sorted(run(q)) == sorted(x for x in self.ratings if x[2] >= 4.0)
+            assert q.explain_metrics()['pages_read'] > 0
+
+            q = coordinator.distribute(Q(Aggregation(Col(1),Col(2),'avg'),Selection(Col(0) < 100),coordinator.table('ratings',self.schema)))
+            expected = run(Q(Aggregation(lambda x: x[1],lambda x: x[2],'avg'),MemoryScan([x for x in self.ratings if x[0] < 100])))
+            assert sorted(run(q)) == sorted(expected)
+
+            movies = [(i,f"Movie {i}") for i in range(0,200,10)]
+            q = coordinator.distribute(Q(Aggregation(Col(1),Col(2),'count'),HashJoin(Q(MemoryScan(movies)),Q(coordinator.table('ratings',self.schema)),Col(0),Col(1))))
+            assert isinstance(q,RemoteScan) and q.join is not None
+            expected = {name: sum(1 for x in self.ratings if x[1] == movie) for movie,name in movies}
+            assert dict(run(q)) == expected
+        finally:
+            for process,_ in processes:
+                process.terminate()
+
+    def test_worker_errors_reach_the_coordinator(self,tmp_path):
+        processes = self.start_workers(tmp_path,1)
+        try:
+            coordinator = Coordinator([address for _,address in processes])
+            try:
+                tuple(run(coordinator.table('movies',('int','str','str'))))
+                assert False, "expected a RemoteError"
+            except RemoteError as e:
+                assert 'movies' in str(e)
+        finally:
+            for process,_ in processes:
+                process.terminate()
+
+
+if __name__ == '__main__':
+    host,_,port = sys.argv[1].rpartition(':')
+    shards = dict()
+    for argument in sys.argv[2:]:
+        table,paths = argument.split('=',1)
+        shards[table] = paths.split(',')
+    print(f"serving {', '.join(shards)} on {host or '127.0.0.1'}:{port}")
+    serve_worker(shards,host or '127.0.0.1',int(port))
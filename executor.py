@@ -1,17 +1,40 @@
-from data_layout import DataBase
-from collections import defaultdict
+from data_layout import DataBase, DBPage, ZoneMap, RECORD_FORMAT_V2
+from expressions import Expr, Col, Const, Param, bind, compile_projection, compile_batch_projection, constant_value
+from sketches import HyperLogLog, TDigest
+from transactions import TransactionManager, WriteConflict
+from collections import defaultdict, deque
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class MergeJoin(object):
     def __init__(self,left_node,right_node,left_key,right_key):
         self.left_node = left_node
         self.right_node = right_node
-        self.left_key = left_key
-        self.right_key = right_key
+        self.left_key_expr = left_key if isinstance(left_key,Expr) else None
+        self.left_key = left_key.compile() if isinstance(left_key,Expr) else left_key
+        self.right_key = right_key.compile() if isinstance(right_key,Expr) else right_key
         self.rows_buffer = []
         self.leading_value = None
         self.non_leading_value = None
         self.previous_leading_v = None
         self.buff_idx = 0 
+        self.memory = None
 
     def next(self) -> tuple:
         """
@@ -33,6 +56,8 @@ class MergeJoin(object):
                 if self.previous_leading_v is not None and self.left_key(self.previous_leading_v) != self.left_key(self.leading_value):
                     self.rows_buffer.clear()
                     self.buff_idx = 0
+                    if self.memory is not None:
+                        self.memory.release(self)
             
         
             if self.leading_value is None or self.non_leading_value is None:
@@ -53,6 +78,8 @@ class MergeJoin(object):
             if self.left_key(self.leading_value) == self.right_key(self.non_leading_value):
                 #If values are matching we should append new non-leading records to the buffer
                 self.rows_buffer.append(self.non_leading_value)
+                if self.memory is not None:
+                    self.memory.grow(self,record_size(self.non_leading_value))
                 result = (*self.leading_value,*self.non_leading_value)
                 self.non_leading_value = None
             
@@ -67,23 +94,132 @@ class MergeJoin(object):
 
 
     def has_next(self) -> bool:
-        return self.left_node.has_next() and self.right_node.has_next()
+        if self.left_node.has_next() and self.right_node.has_next():
+            return True
+        if self.memory is not None:
+            self.memory.release(self)
+        return False
     
     def reset(self):
         self.left_node.child.reset()
         self.right_node.child.reset()
         self.leading_value = None
         self.non_leading_value = None
+        self.rows_buffer.clear()
+        if self.memory is not None:
+            self.memory.release(self)
+
+    def ordering(self):
+        # the output keeps the order of the left input and the left columns come first
+        return self.left_key_expr.index if isinstance(self.left_key_expr,Col) else None
+
+class BloomFilter(object):
+    """
+    Set membership with false positives but no false negatives, sized for n_items keys and the given false
+    positive rate. The bit positions are derived from two hashes of the key (Kirsch-Mitzenmacher).
+    """
+    def __init__(self,n_items:int,false_positive_rate:float = 0.01):
+        n_items = max(n_items,1)
+        self.n_bits = max(int(-n_items * math.log(false_positive_rate) / (math.log(2) ** 2)),64)
+        self.n_hashes = max(int(round(-math.log2(false_positive_rate))),1)
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def add(self,key):
+        h1 = hash(key)
+        h2 = hash((key,0x5bd1e995)) | 1
+        for i in range(self.n_hashes):
+            position = (h1 + i * h2) % self.n_bits
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self,key) -> bool:
+        h1 = hash(key)
+        h2 = hash((key,0x5bd1e995)) | 1
+        bits = self.bits
+        for i in range(self.n_hashes):
+            position = (h1 + i * h2) % self.n_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class RuntimeFilter(object):
+    """
+    Filter built at runtime from the keys of the HashJoin build side and pushed into the probe side, so rows
+    that can not join are dropped before they are fully decoded or flow up the tree. It checks the min/max range
+    when all the keys are int and then a bloom filter. Once enough keys have been checked, if the filter lets
+    almost everything pass it disables itself to stop paying for the checks.
+    """
+    min_checks = 10000
+    max_selectivity = 0.95
+
+    def __init__(self,keys,false_positive_rate:float = 0.01):
+        keys = list(keys)
+        self.bloom = BloomFilter(len(keys),false_positive_rate)
+        for key in keys:
+            self.bloom.add(key)
+        int_keys = len(keys) > 0 and all(type(key) is int for key in keys)
+        self.low = min(keys) if int_keys else None
+        self.high = max(keys) if int_keys else None
+        self.checked = 0
+        self.passed = 0
+        self.enabled = True
+
+    def might_contain(self,key) -> bool:
+        self.checked += 1
+        if self.low is not None and type(key) is int and (key < self.low or key > self.high):
+            return False
+        if key in self.bloom:
+            self.passed += 1
+            return True
+        return False
+
+    def filter(self,rows:list,key) -> list:
+        if not self.enabled:
+            return rows
+        rows = [row for row in rows if self.might_contain(key(row))]
+        if self.checked >= self.min_checks and self.selectivity() > self.max_selectivity:
+            self.enabled = False
+        return rows
+
+    def selectivity(self) -> float:
+        return self.passed / self.checked if self.checked > 0 else 1.0
+
+    def stats(self) -> dict:
+        return {'checked': self.checked, 'passed': self.passed, 'selectivity': round(self.selectivity(),4), 'enabled': self.enabled}
+
+
+def runtime_filter_target(node):
+    """
+    Find the deepest node below `node` that can apply a runtime filter, only descending through operators
+    that keep the rows unchanged so the join key function still applies to them.
+    """
+    node = node.node if isinstance(node,InstrumentedNode) else node
+    if isinstance(node,(Selection,Sort)) and getattr(node,'child',None) is not None:
+        target = runtime_filter_target(node.child)
+        if target is not None:
+            return target
+    return node if hasattr(node,'add_runtime_filter') else None
+
 
 class HashJoin(object):
-    def __init__(self,left_node,right_node,left_key,right_key):
+    """
+    Keys can be functions or expressions. After the build phase a runtime filter with the build keys is pushed
+    into the right side, pass runtime_filter=False to disable it.
+    """
+    def __init__(self,left_node,right_node,left_key,right_key,runtime_filter=True):
         self.left_node = left_node
         self.right_node = right_node
-        self.left_key = left_key
-        self.right_key = right_key
+        self.left_key = left_key.compile() if isinstance(left_key,Expr) else left_key
+        self.right_key = right_key.compile() if isinstance(right_key,Expr) else right_key
+        self.left_key_expr = left_key if isinstance(left_key,Expr) else None
+        self.right_key_expr = right_key if isinstance(right_key,Expr) else None
         self.hash_table = defaultdict(list)
         self.left_list = []
+        self.left_idx = 0
         self.current_right_v = None
+        self.memory = None
+        self.use_runtime_filter = runtime_filter
+        self.runtime_filter = None
 
     def next(self) -> tuple:
         """
@@ -96,102 +232,1040 @@ class HashJoin(object):
                 left_v = self.left_node.next()
                 left_k = self.left_key(left_v)
                 self.hash_table[left_k].append(left_v)
+                if self.memory is not None:
+                    self.memory.grow(self,record_size(left_v))
+            target = runtime_filter_target(self.right_node) if self.use_runtime_filter else None
+            if target is not None and self.runtime_filter is None and len(self.hash_table) > 0:
+                self.runtime_filter = RuntimeFilter(self.hash_table.keys())
+                target.add_runtime_filter(self.right_key_expr if self.right_key_expr is not None else self.right_key,self.runtime_filter)
         else:
-            if self.left_list is not None and len(self.left_list) > 0:
-                left_v = self.left_list.pop(0)
+            if self.left_idx < len(self.left_list):
+                left_v = self.left_list[self.left_idx]
+                self.left_idx += 1
                 result = (*left_v,*self.current_right_v)
                 return result
             elif self.right_node.has_next():
                 right_v = self.right_node.next()
+                if right_v is None:
+                    return None
                 right_k = self.right_key(right_v)
-                self.left_list = self.hash_table.get(right_k,None)
-                if self.left_list == None:
+                left_list = self.hash_table.get(right_k,None)
+                if left_list == None:
                     return None
+                self.left_list = left_list
                 self.current_right_v = right_v
-                left_v = self.left_list.pop(0)
-                print(self.left_list)
-                return (*left_v,*right_v)
+                self.left_idx = 1
+                return (*left_list[0],*right_v)
         
         return None
             
         
 
     def has_next(self) -> bool:
-        return self.left_node.has_next() or (self.right_node.has_next() and len(self.hash_table) > 0) or len(self.left_list) > 0   
+        if self.left_node.has_next() or (self.right_node.has_next() and len(self.hash_table) > 0) or self.left_idx < len(self.left_list):
+            return True
+        if self.memory is not None:
+            self.memory.release(self)
+        return False
 
 
     def reset(self):
         self.left_node.child.reset()
         self.right_node.child.reset()
         self.hash_table = defaultdict(list)
+        if self.memory is not None:
+            self.memory.release(self)
+
+    def explain_metrics(self) -> dict:
+        metrics = {'hash_table_size': len(self.hash_table)}
+        if self.runtime_filter is not None:
+            metrics['runtime_filter'] = self.runtime_filter.stats()
+        return metrics
+
+
+class SemiJoin(object):
+    """
+    Return the rows of the left node that have at least one row with the same key in the right node, each row
+    once and without the right columns. With method='hash' only the set of the right keys is kept and a runtime
+    filter with them is pushed into the left side, with method='merge' both inputs must come sorted on their
+    keys and the right rows are read along the left ones without being kept. Null keys never match.
+    """
+    methods = ('hash','merge')
+    anti = False
+
+    def __init__(self,left_node,right_node,left_key,right_key,method = 'hash',runtime_filter = True):
+        if method not in self.methods:
+            raise ValueError(f"unknown join method {method}, expected one of {self.methods}")
+        self.left_node = left_node
+        self.right_node = right_node
+        self.left_key = left_key.compile() if isinstance(left_key,Expr) else left_key
+        self.right_key = right_key.compile() if isinstance(right_key,Expr) else right_key
+        self.left_key_expr = left_key if isinstance(left_key,Expr) else None
+        self.method = method
+        self.keys = None
+        self.build_nulls = False
+        self.current_right_key = None
+        self.memory = None
+        self.use_runtime_filter = runtime_filter and not self.anti
+        self.runtime_filter = None
+        self.rows_emitted = 0
+
+    def build(self):
+        self.keys = set()
+        while self.right_node.has_next():
+            right_v = self.right_node.next()
+            if right_v is None:
+                continue
+            key = self.right_key(right_v)
+            if key is None:
+                self.build_nulls = True
+            elif key not in self.keys:
+                self.keys.add(key)
+                if self.memory is not None:
+                    self.memory.grow(self,record_size((key,)))
+        target = runtime_filter_target(self.left_node) if self.use_runtime_filter else None
+        if target is not None and len(self.keys) > 0:
+            self.runtime_filter = RuntimeFilter(self.keys)
+            target.add_runtime_filter(self.left_key_expr if self.left_key_expr is not None else self.left_key,self.runtime_filter)
+
+    def contains(self,key) -> bool:
+        if self.method == 'hash':
+            return key in self.keys
+        # skip the right keys smaller than the left one, the left rows after it have greater or equal keys
+        while True:
+            if self.current_right_key is None:
+                if not self.right_node.has_next():
+                    return False
+                right_v = self.right_node.next()
+                if right_v is None:
+                    continue
+                self.current_right_key = self.right_key(right_v)
+                continue
+            if self.current_right_key < key:
+                self.current_right_key = None
+                continue
+            return self.current_right_key == key
+
+    def keep(self,left_v) -> bool:
+        key = self.left_key(left_v)
+        return key is not None and self.contains(key)
+
+    def next(self) -> tuple:
+        if self.method == 'hash' and self.keys is None:
+            self.build()
+        while self.left_node.has_next():
+            left_v = self.left_node.next()
+            if left_v is not None and self.keep(left_v):
+                self.rows_emitted += 1
+                return left_v
+        return None
+
+    def has_next(self) -> bool:
+        if self.left_node.has_next():
+            return True
+        if self.memory is not None:
+            self.memory.release(self)
+        return False
+
+    def reset(self):
+        self.left_node.reset()
+        self.right_node.reset()
+        self.keys = None
+        self.build_nulls = False
+        self.current_right_key = None
+        if self.memory is not None:
+            self.memory.release(self)
+
+    def ordering(self):
+        # the left rows are returned in their order
+        return ordering(self.left_node)
+
+    def explain_metrics(self) -> dict:
+        metrics = {'method': self.method,'rows_emitted': self.rows_emitted}
+        if self.keys is not None:
+            metrics['build_keys'] = len(self.keys)
+        if self.runtime_filter is not None:
+            metrics['runtime_filter'] = self.runtime_filter.stats()
+        return metrics
+
+
+class AntiJoin(SemiJoin):
+    """
+    Return the rows of the left node without any row with the same key in the right node, as NOT EXISTS. A left
+    row with a null key has no match and is returned. With null_aware=True the semantics are the ones of NOT IN:
+    no row is returned when a right key is null, and the left rows with a null key are only returned when the
+    right node is empty; it needs method='hash'.
+    """
+    anti = True
+
+    def __init__(self,left_node,right_node,left_key,right_key,method = 'hash',null_aware = False):
+        if null_aware and method != 'hash':
+            raise ValueError("null aware anti joins need method='hash'")
+        super().__init__(left_node,right_node,left_key,right_key,method,runtime_filter=False)
+        self.null_aware = null_aware
+
+    def keep(self,left_v) -> bool:
+        key = self.left_key(left_v)
+        if self.null_aware and (self.build_nulls or key is None):
+            return not self.build_nulls and len(self.keys) == 0
+        return key is None or not self.contains(key)
+
+
+def estimated_rows(node):
+    """
+    Number of rows of a scan known without reading it, the table size for a FileScan (before its filters)
+    and the list size for a MemoryScan, None for other nodes.
+    """
+    node = node.node if isinstance(node,InstrumentedNode) else node
+    if isinstance(node,FileScan):
+        return node.count_rows()
+    if isinstance(node,MemoryScan):
+        return len(node.table)
+    return None
+
+
+class PrefetchedRows(object):
+    """
+    Return the rows already read from a node and then the remaining rows of the node.
+    """
+    def __init__(self,rows:list,node):
+        self.rows = rows
+        self.idx = 0
+        self.child = node
+
+    def next(self):
+        if self.idx < len(self.rows):
+            self.idx += 1
+            return self.rows[self.idx - 1]
+        return self.child.next()
+
+    def has_next(self):
+        return self.idx < len(self.rows) or self.child.has_next()
+
+    def reset(self):
+        self.idx = 0
+        self.child.reset()
+
+    def ordering(self):
+        return ordering(self.child)
+
+
+class AdaptiveJoin(object):
+    """
+    Equi join that picks its algorithm once it sees its inputs. When both inputs report they are ordered on
+    their key column (see ordering) they are merge joined. Otherwise the first sample_size rows of both inputs
+    are read and the hash table is built on the smaller side: a side that ends within its sample has a known
+    size, otherwise the table size of its scan is used. When the build rows go over build_limit bytes, or the
+    memory context asks the join to spill, the build and probe rows are partitioned on the key into temporary
+    files and joined partition by partition (grace hash join). A merge join, or a grace hash join asked to
+    spill again, has nothing to move to disk and fails with MemoryLimitExceeded. The output is
+    (*left row, *right row) whatever the build side.
+    """
+    def __init__(self,left_node,right_node,left_key,right_key,sample_size:int = 1024,build_limit:int = None,partitions:int = 16):
+        self.left_node = left_node
+        self.right_node = right_node
+        self.left_key_expr = left_key if isinstance(left_key,Expr) else None
+        self.right_key_expr = right_key if isinstance(right_key,Expr) else None
+        self.left_key = left_key.compile() if isinstance(left_key,Expr) else left_key
+        self.right_key = right_key.compile() if isinstance(right_key,Expr) else right_key
+        self.sample_size = sample_size
+        self.build_limit = build_limit
+        self.n_partitions = partitions
+        self.strategy = None
+        self.build_side = None
+        self.estimates = None
+        self.hash_table = defaultdict(list)
+        self.build_rows = 0
+        self.build_bytes = 0
+        self.partitions = None
+        self.spill_bytes = 0
+        self.output = None
+        self.head = None
+        self.memory = None
+
+    def sample(self,node) -> tuple:
+        rows = []
+        while len(rows) < self.sample_size and node.has_next():
+            row = node.next()
+            if row is not None:
+                rows.append(row)
+        return rows,not node.has_next()
+
+    def choose_build_side(self,left_sample:tuple,right_sample:tuple) -> str:
+        sizes = []
+        for node,(rows,finished) in ((self.left_node,left_sample),(self.right_node,right_sample)):
+            estimate = estimated_rows(node)
+            sizes.append(len(rows) if finished else max(estimate,len(rows)) if estimate is not None else math.inf)
+        self.estimates = {'left': sizes[0],'right': sizes[1]}
+        return 'right' if sizes[1] < sizes[0] else 'left'
+
+    def can_merge(self) -> bool:
+        return isinstance(self.left_key_expr,Col) and isinstance(self.right_key_expr,Col) \
+            and ordering(self.left_node) == self.left_key_expr.index and ordering(self.right_node) == self.right_key_expr.index
+
+    def join_rows(self):
+        if self.can_merge():
+            self.strategy = 'merge'
+            yield from self.merge_rows()
+            return
+        left_sample = self.sample(self.left_node)
+        right_sample = self.sample(self.right_node)
+        self.build_side = self.choose_build_side(left_sample,right_sample)
+        self.strategy = 'hash'
+        left_rows = PrefetchedRows(left_sample[0],self.left_node)
+        right_rows = PrefetchedRows(right_sample[0],self.right_node)
+        build,probe = (left_rows,right_rows) if self.build_side == 'left' else (right_rows,left_rows)
+        build_key,probe_key = (self.left_key,self.right_key) if self.build_side == 'left' else (self.right_key,self.left_key)
+        for row in run(build):
+            self.add_build_row(build_key(row),row)
+        if self.partitions is None:
+            for row in run(probe):
+                for build_row in self.hash_table.get(probe_key(row),()):
+                    yield self.combine(build_row,row)
+            return
+        # grace hash join, the probe rows are partitioned like the build rows and each pair is joined in memory
+        probe_partitions = [tempfile.TemporaryFile() for _ in range(self.n_partitions)]
+        for row in run(probe):
+            pickle.dump(row,probe_partitions[hash(probe_key(row)) % self.n_partitions])
+        self.spill_bytes = sum(partition.tell() for partition in self.partitions + probe_partitions)
+        for build_partition,probe_partition in zip(self.partitions,probe_partitions):
+            hash_table = defaultdict(list)
+            for row in self.read_partition(build_partition):
+                hash_table[build_key(row)].append(row)
+            for row in self.read_partition(probe_partition):
+                for build_row in hash_table.get(probe_key(row),()):
+                    yield self.combine(build_row,row)
+            build_partition.close()
+            probe_partition.close()
+
+    def merge_rows(self):
+        """
+        Merge join of the sorted inputs, only the right rows of the current key are kept.
+        """
+        right_rows = run(self.right_node)
+        right_row = next(right_rows,None)
+        group_key,group = None,[]
+        for left_row in run(self.left_node):
+            key = self.left_key(left_row)
+            if len(group) == 0 or key != group_key:
+                group_key,group = key,[]
+                if self.memory is not None:
+                    self.memory.release(self)
+                while right_row is not None and self.right_key(right_row) < key:
+                    right_row = next(right_rows,None)
+                while right_row is not None and self.right_key(right_row) == key:
+                    group.append(right_row)
+                    if self.memory is not None:
+                        self.memory.grow(self,record_size(right_row))
+                    right_row = next(right_rows,None)
+            for row in group:
+                yield (*left_row,*row)
+
+    def add_build_row(self,key,row):
+        self.build_rows += 1
+        if self.partitions is not None:
+            pickle.dump(row,self.partitions[hash(key) % self.n_partitions])
+            return
+        self.hash_table[key].append(row)
+        n_bytes = record_size(row)
+        self.build_bytes += n_bytes
+        if self.build_limit is not None and self.build_bytes > self.build_limit:
+            self.spill()
+        elif self.memory is not None:
+            self.memory.grow(self,n_bytes)
+
+    def spill(self):
+        """
+        Move the build rows kept so far to partition files, the following build rows are written to them too.
+        """
+        if self.strategy != 'hash' or self.partitions is not None:
+            stats = self.memory.operator_stats(self) if self.memory is not None else {'operator': type(self).__name__,'current': self.build_bytes}
+            limit = self.memory.limit if self.memory is not None else self.build_limit
+            raise MemoryLimitExceeded(f"query memory limit of {limit} bytes exceeded by {stats['operator']} "
+                                      f"retaining {stats['current']} bytes, the {self.strategy} join cannot spill")
+        self.strategy = 'grace'
+        self.partitions = [tempfile.TemporaryFile() for _ in range(self.n_partitions)]
+        for key,rows in self.hash_table.items():
+            for row in rows:
+                pickle.dump(row,self.partitions[hash(key) % self.n_partitions])
+        self.hash_table = defaultdict(list)
+        self.build_bytes = 0
+        if self.memory is not None:
+            self.memory.release(self)
+
+    def read_partition(self,partition):
+        partition.seek(0)
+        while True:
+            try:
+                yield pickle.load(partition)
+            except EOFError:
+                return
+
+    def combine(self,build_row:tuple,probe_row:tuple) -> tuple:
+        return (*build_row,*probe_row) if self.build_side == 'left' else (*probe_row,*build_row)
+
+    def next(self) -> tuple:
+        if self.output is None:
+            self.output = self.join_rows()
+            self.head = next(self.output,None)
+        row = self.head
+        if row is not None:
+            self.head = next(self.output,None)
+        return row
+
+    def has_next(self) -> bool:
+        if self.output is None:
+            self.output = self.join_rows()
+            self.head = next(self.output,None)
+        if self.head is None and self.memory is not None:
+            self.memory.release(self)
+        return self.head is not None
+
+    def reset(self):
+        self.left_node.reset()
+        self.right_node.reset()
+        self.hash_table = defaultdict(list)
+        self.build_rows = 0
+        self.build_bytes = 0
+        self.partitions = None
+        self.output = None
+        self.head = None
+        if self.memory is not None:
+            self.memory.release(self)
+
+    def ordering(self):
+        # a merge join keeps the order of the left input, the left columns come first
+        return self.left_key_expr.index if self.can_merge() else None
+
+    def explain_metrics(self) -> dict:
+        metrics = {'strategy': self.strategy}
+        if self.build_side is not None:
+            metrics.update({'build_side': self.build_side,'build_rows': self.build_rows,'estimated_rows': self.estimates})
+        if self.partitions is not None:
+            metrics['spill_bytes'] = self.spill_bytes
+        return metrics
 
 
 class NestedLoopJoin(object):
     def __init__(self,left_node,right_node):
         self.left_node = left_node
         self.right_node = right_node
-        self.buffer_join = []
+        self.buffer_join = deque()
+        self.memory = None
 
     def next(self) -> tuple:
         if len(self.buffer_join) > 0:
-            return self.buffer_join.pop(0)
+            return self.buffer_join.popleft()
         elif self.left_node.has_next():
             left_v =  self.left_node.next()
+            if self.memory is not None:
+                self.memory.release(self)
             while self.right_node.has_next():
                 right_v = self.right_node.next()
                 self.buffer_join.append((*left_v,*right_v))
+                if self.memory is not None:
+                    self.memory.grow(self,record_size(self.buffer_join[-1]))
             self.right_node.reset()
             if len(self.buffer_join) > 0: 
-                return self.buffer_join.pop(0)
+                return self.buffer_join.popleft()
         return None
 
     def has_next(self) -> bool:
-        return self.left_node.has_next() or len(self.buffer_join) > 0
+        if self.left_node.has_next() or len(self.buffer_join) > 0:
+            return True
+        if self.memory is not None:
+            self.memory.release(self)
+        return False
     
     def reset(self):
         self.left_node.reset()
         self.right_node.reset()
+        self.buffer_join = deque()
+        if self.memory is not None:
+            self.memory.release(self)
+
+
+class BlockNestedLoopJoin(object):
+    """
+    Nested loop join that reads the left rows in blocks of up to block_size bytes and scans the right node once
+    per block instead of once per left row. The right rows are kept after the first scan when they fit in
+    cache_limit bytes, then the next blocks do not scan the right node again. The predicate is evaluated on
+    the joined (*left row, *right row) rows, it can be any expression (with params) or function, without it
+    every pair is returned. Within a block the rows come in the order of the right rows.
+    """
+    def __init__(self,left_node,right_node,predicate = None,params:tuple = (),block_size:int = 1 << 20,cache_limit:int = 16 << 20):
+        self.left_node = left_node
+        self.right_node = right_node
+        self.predicate = predicate
+        if isinstance(predicate,Expr):
+            self.batch_filter = bind(predicate.compile_batch(),params)
+        elif predicate is not None:
+            self.batch_filter = lambda rows: [row for row in rows if predicate(row)]
+        else:
+            self.batch_filter = None
+        self.block_size = block_size
+        self.cache_limit = cache_limit
+        self.cache = None
+        self.blocks = 0
+        self.right_scans = 0
+        self.output = None
+        self.head = None
+        self.memory = None
+
+    def read_block(self) -> list:
+        block = []
+        block_bytes = 0
+        while block_bytes < self.block_size and self.left_node.has_next():
+            row = self.left_node.next()
+            if row is not None:
+                block.append(row)
+                block_bytes += record_size(row)
+        if self.memory is not None and block_bytes > 0:
+            self.memory.grow(self,block_bytes)
+        return block
+
+    def right_rows(self):
+        if self.cache is not None:
+            yield from self.cache
+            return
+        if self.right_scans > 0:
+            self.right_node.reset()
+        self.right_scans += 1
+        # the first scan keeps the right rows while they fit in the cache limit
+        cache = [] if self.right_scans == 1 else None
+        cache_bytes = 0
+        for row in run(self.right_node):
+            if cache is not None:
+                cache.append(row)
+                cache_bytes += record_size(row)
+                if cache_bytes > self.cache_limit:
+                    cache = None
+            yield row
+        if cache is not None:
+            self.cache = cache
+            if self.memory is not None:
+                self.memory.grow(self,cache_bytes)
+
+    def join_rows(self):
+        while True:
+            block = self.read_block()
+            if len(block) == 0:
+                return
+            self.blocks += 1
+            for right_row in self.right_rows():
+                rows = [(*left_row,*right_row) for left_row in block]
+                yield from self.batch_filter(rows) if self.batch_filter is not None else rows
+            if self.memory is not None:
+                self.memory.release(self)
+                if self.cache is not None:
+                    self.memory.grow(self,sum(record_size(row) for row in self.cache))
+
+    def next(self) -> tuple:
+        if self.output is None:
+            self.output = self.join_rows()
+            self.head = next(self.output,None)
+        row = self.head
+        if row is not None:
+            self.head = next(self.output,None)
+        return row
+
+    def has_next(self) -> bool:
+        if self.output is None:
+            self.output = self.join_rows()
+            self.head = next(self.output,None)
+        if self.head is None and self.memory is not None:
+            self.memory.release(self)
+        return self.head is not None
+
+    def reset(self):
+        self.left_node.reset()
+        self.output = None
+        self.head = None
+        if self.memory is not None:
+            self.memory.release(self)
+            if self.cache is not None:
+                self.memory.grow(self,sum(record_size(row) for row in self.cache))
+
+    def explain_metrics(self) -> dict:
+        return {'blocks': self.blocks,'right_scans': self.right_scans,'right_cached': self.cache is not None}
+
+
+
+class IndexNestedLoopJoin(object):
+    """
+    For every row of the left node look up the rows of the right table with a HashIndex on the join column,
+    the right table is never scanned. The output is (*left row, *right row) as in the other joins.
+    """
+    def __init__(self,left_node,index,left_key,snapshot = None):
+        self.left_node = left_node
+        self.index = index
+        self.left_key = left_key.compile() if isinstance(left_key,Expr) else left_key
+        self.snapshot = snapshot
+        self.buffer_join = []
+        self.lookups = 0
+
+    def next(self) -> tuple:
+        if len(self.buffer_join) > 0:
+            return self.buffer_join.pop()
+        elif self.left_node.has_next():
+            left_v = self.left_node.next()
+            if left_v is None:
+                return None
+            self.lookups += 1
+            matches = self.index.fetch(self.left_key(left_v),self.snapshot)
+            self.buffer_join = [(*left_v,*right_v) for right_v in reversed(matches)]
+            if len(self.buffer_join) > 0:
+                return self.buffer_join.pop()
+        return None
+
+    def has_next(self) -> bool:
+        return self.left_node.has_next() or len(self.buffer_join) > 0
+
+    def reset(self):
+        self.left_node.reset()
         self.buffer_join = []
 
+    def explain_metrics(self) -> dict:
+        return {'lookups': self.lookups,'index_pages_read': self.index.pages_read}
 
 
 class FileScan(object):
-    def __init__(self,path,db_name,table_name,schema):
+    """
+    Read the records of a table file page by page. Optionally a predicate and a list of columns can be pushed
+    down into the scan: when the predicate is an expression the pages whose zone map can not match it are
+    skipped without being read, only the columns referenced by the predicate and the output are decoded and
+    the records are filtered and projected with one compiled function per page.
+
+    On mvcc tables only the records visible in the snapshot are returned: the snapshot of the given transaction,
+    the given snapshot or a new one taken when the scan is created.
+    """
+    def __init__(self,path,db_name,table_name,schema,predicate=None,columns:list = None,params:tuple = (),snapshot = None,transaction = None):
         self.db = DataBase(path,db_name,table_name,schema)
+        self.snapshot = None
+        if self.db.mvcc:
+            self.snapshot = transaction.snapshot if transaction is not None else snapshot if snapshot is not None else self.db.transactions.snapshot()
+        self.table_name = table_name
+        self.predicate = predicate
+        self.columns = columns
+        self.params = params
+        self.pages_read = 0
+        self.pages_skipped = 0
+        self.rows_filtered = 0
+        self.rows_skipped = 0
+        self.key_filters = []
+        self.row_filters = []
+        self.page_no = 0
+        self.records = []
+        self.slot = 0
+        self.zone_map = None
+        self.decode_columns = None
+        self.batch_filter = None
+        self.batch_project = None
+        if isinstance(predicate,Expr):
+            self.zone_map = ZoneMap.load(path,schema)
+            self.batch_filter = bind(predicate.compile_batch(),params)
+        elif predicate is not None:
+            self.batch_filter = lambda rows: [row for row in rows if predicate(row)]
+        if columns is not None:
+            self.batch_project = compile_batch_projection([Col(i) for i in columns])
+            if predicate is None or isinstance(predicate,Expr):
+                self.decode_columns = set(columns) | (predicate.columns() if predicate is not None else set())
+        if self.db.mvcc and self.decode_columns is not None:
+            # the hidden xmin and xmax columns come first
+            self.decode_columns = set(range(self.db.hidden_columns)) | {i + self.db.hidden_columns for i in self.decode_columns}
         
     
     def next(self) -> tuple:
         if self.has_next():
-            record = self.db.last_page().records.pop(0)
-            return record.record
+            record = self.records[self.slot]
+            self.slot += 1
+            return record
         return None
 
     def has_next(self) -> bool:
+        while self.slot >= len(self.records):
+            if not self.load_next_page():
+                return False
+        return True
+            
+    
+    def load_next_page(self) -> bool:
+        while self.zone_map is not None and not self.predicate.may_match(self.zone_map.page_zone(self.page_no),self.params):
+            self.page_no += 1
+            self.pages_skipped += 1
+        page_bytes = self.db.read_page(self.page_no)
+        if page_bytes is None:
+            return False
+        self.page_no += 1
+        self.pages_read += 1
+        page = DBPage()
+        schema = self.db.header.schema
+        active_key_filters = [(col,runtime_filter) for col,runtime_filter in self.key_filters if runtime_filter.enabled]
+        if self.db.mvcc:
+            page.decode(page_bytes,schema,self.decode_columns)
+            records = self.db.visible_records(page,self.snapshot)
+        elif len(active_key_filters) > 0:
+            # decode only the join key columns first and the rest of the columns just for the rows that pass
+            page.decode(page_bytes,schema,{col for col,_ in active_key_filters})
+            n_records = len(page.records)
+            slots = range(n_records)
+            for col,runtime_filter in active_key_filters:
+                slots = [slot for slot in runtime_filter.filter([(slot,page.records[slot].record[col]) for slot in slots],lambda x: x[1])]
+                slots = [slot for slot,_ in slots]
+            self.rows_filtered += n_records - len(slots)
+            pointers = page.header.record_pointers
+            records = self.db.resolve_overflow([page.decode_record(page_bytes[pointers[slot][0]-pointers[slot][1]:pointers[slot][0]],schema,self.decode_columns)
+                                                for slot in slots])
+        else:
+            page.decode(page_bytes,schema,self.decode_columns)
+            records = self.db.resolve_overflow([record.record for record in page.records])
+        if self.batch_filter is not None:
+            records = self.batch_filter(records)
+        if self.batch_project is not None:
+            records = self.batch_project(records)
+        for key,runtime_filter in self.row_filters:
+            n_records = len(records)
+            records = runtime_filter.filter(records,key)
+            self.rows_filtered += n_records - len(records)
+        self.records = records
+        self.slot = 0
+        return True
+
+    def page_record_count(self,page_no:int) -> int:
+        """
+        Number of records of the page, read from its header without reading the rest of the page.
+        """
+        return int.from_bytes(os.pread(self.db.db.fileno(),12,self.db.page_offset(page_no))[8:12],'little')
 
-        if len(self.db.pages) == 0:
-            self.load_next_page()
+    def count_rows(self) -> int:
+        """
+        Number of rows of the table from the record counts of the page headers, only valid when can_skip_rows().
+        """
+        return sum(self.page_record_count(page_no) for page_no in range(self.db.page_count()))
 
-        if len(self.db.pages) > 0  and len(self.db.last_page().records) == 0:
-            self.db.pages.pop()
-            self.load_next_page()
+    def column_bounds(self,col:int):
+        """
+        Min and max of an output column without reading the records, from the first and last record when the
+        table is clustered on the column or from an up to date zone map. None when they are not known.
+        """
+        table_col = self.columns[col] if self.columns is not None else col
+        pages = [page_no for page_no in range(self.db.page_count()) if self.page_record_count(page_no) > 0]
+        if len(pages) == 0 or table_col >= len(self.db.schema):
+            return None
+        if self.db.header.sort_col == table_col:
+            schema = self.db.header.schema
+            columns = {self.db.hidden_columns + table_col}
+            bounds = []
+            for page_no,slot in ((pages[0],0),(pages[-1],-1)):
+                page_bytes = self.db.read_page(page_no)
+                page = DBPage(page_size=self.db.page_size)
+                page.header.decode(page_bytes[0:int.from_bytes(page_bytes[12:16],'little')])
+                end,size = page.header.record_pointers[slot]
+                record = self.db.resolve_overflow([page.decode_record(page_bytes[end-size:end],schema,columns)])[0]
+                bounds.append(record[self.db.hidden_columns + table_col])
+                self.pages_read += 1
+            return None if None in bounds else tuple(bounds)
+        zone_map = self.zone_map if self.zone_map is not None else ZoneMap.load(self.db.db_path,self.db.schema)
+        if zone_map is None or table_col not in zone_map.numeric_columns:
+            return None
+        low = min(zone[table_col][0] for zone in zone_map.zones)
+        high = max(zone[table_col][1] for zone in zone_map.zones)
+        if low > high:
+            return None
+        return (int(low),int(high)) if self.db.schema[table_col] == 'int' else (low,high)
 
-        if len(self.db.pages) > 0 and len(self.db.last_page().records) > 0:
-            #print("We have records to read")
-            return True
-        return False
-            
-    
-    def load_next_page(self):
-         #load page
-        is_page_loaded = self.db.read()
-        # if not is_page_loaded:
-        #     print("not more pages available to load")
+    def can_skip_rows(self) -> bool:
+        """
+        Rows can be skipped without decoding them when every record of the table is returned.
+        """
+        return self.batch_filter is None and len(self.key_filters) == 0 and len(self.row_filters) == 0 and not self.db.mvcc
+
+    def skip_rows(self,n:int) -> int:
+        """
+        Skip the next n rows, the pages before the one holding the first row to return are skipped reading only
+        the record count of their header and that page is decoded from the first row to return. Returns the
+        number of rows skipped, less than n when the table ends before.
+        """
+        buffered = min(len(self.records) - self.slot,n)
+        self.slot += buffered
+        skipped = buffered
+        n_pages = self.db.page_count()
+        while skipped < n and self.page_no < n_pages:
+            size = self.page_record_count(self.page_no)
+            if skipped + size > n:
+                break
+            skipped += size
+            self.page_no += 1
+            self.pages_skipped += 1
+        if skipped < n and self.page_no < n_pages:
+            first_slot = n - skipped
+            page_bytes = self.db.read_page(self.page_no)
+            self.page_no += 1
+            self.pages_read += 1
+            page = DBPage(page_size=self.db.page_size)
+            page.header.decode(page_bytes[0:int.from_bytes(page_bytes[12:16],'little')])
+            pointers = page.header.record_pointers[first_slot:]
+            schema = self.db.header.schema
+            records = self.db.resolve_overflow([page.decode_record(page_bytes[end-size:end],schema,self.decode_columns) for end,size in pointers])
+            self.records = self.batch_project(records) if self.batch_project is not None else records
+            self.slot = 0
+            skipped = n
+        self.rows_skipped += skipped
+        return skipped
+
+    def ordering(self):
+        """
+        Index of the output column the records come sorted on, when the table has been clustered.
+        """
+        sort_col = self.db.header.sort_col
+        if sort_col is None or self.columns is None:
+            return sort_col
+        return self.columns.index(sort_col) if sort_col in self.columns else None
+
+    def add_runtime_filter(self,key,runtime_filter:RuntimeFilter):
+        """
+        Apply a join runtime filter to the scanned rows. When the key is a column expression the key column is
+        decoded first and the rest of the record only if the key passes the filter.
+        """
+        col = None
+        if isinstance(key,Col) and not self.db.mvcc:
+            col = self.columns[key.index] if self.columns is not None else key.index
+        if col is not None and col not in self.db.text_columns:
+            self.key_filters.append((col,runtime_filter))
+        else:
+            self.row_filters.append((key.compile() if isinstance(key,Expr) else key,runtime_filter))
     
     def reset(self):
-        self.db.reset_page_read()
+        self.page_no = 0
+        self.records = []
+        self.slot = 0
+
+    def explain_metrics(self) -> dict:
+        metrics = {'table': self.table_name, 'pages_read': self.pages_read, 'pages_skipped': self.pages_skipped}
+        if len(self.key_filters) > 0 or len(self.row_filters) > 0:
+            metrics['rows_filtered'] = self.rows_filtered
+        if self.rows_skipped > 0:
+            metrics['rows_skipped'] = self.rows_skipped
+        return metrics
 
 
 
+class ColumnScan(object):
+    """
+    Read the given columns of a table as numpy arrays, each call to next returns a batch as a dict from column
+    index to array with the records of pages_per_batch pages, the pages of a batch are read with a single read.
+    Requires numpy.
+    """
+    def __init__(self,path,db_name,table_name,schema,columns:list,pages_per_batch=256):
+        if np is None:
+            raise ImportError("ColumnScan requires numpy")
+        self.db = DataBase(path,db_name,table_name,schema)
+        if self.db.mvcc:
+            raise NotImplementedError("ColumnScan does not check the visibility of the records of mvcc tables")
+        self.table_name = table_name
+        self.columns = columns
+        self.pages_per_batch = pages_per_batch
+        self.page_no = 0
+        self.pages_read = 0
+        self.done = False
+
+    def next(self) -> dict:
+        if self.done:
+            return None
+        pages = self.db.read_pages(self.page_no,self.pages_per_batch)
+        if len(pages) < self.pages_per_batch:
+            self.done = True
+        if len(pages) == 0:
+            return None
+        self.page_no += len(pages)
+        self.pages_read += len(pages)
+        arrays = [DBPage().decode_columns(page_bytes,self.db.header.schema,self.columns) for page_bytes in pages]
+        return {i: np.concatenate([page_arrays[i] for page_arrays in arrays]) for i in self.columns}
+
+    def has_next(self) -> bool:
+        return not self.done
+
+    def reset(self):
+        self.page_no = 0
+        self.done = False
+
+    def explain_metrics(self) -> dict:
+        return {'table': self.table_name, 'pages_read': self.pages_read}
+
+
+class SampleScan(object):
+    """
+    Read a random subset of the table pages (TABLESAMPLE SYSTEM), the number of pages comes from the start and
+    end offsets of the header so only the sampled pages are read, in file order. Optionally the rows of the
+    sampled pages are sampled again with probability row_fraction (BERNOULLI). With a seed the same sample is
+    returned every time.
+
+    `fraction` is the fraction of the table actually sampled, sums and counts over the sample can be divided
+    by it to estimate the values over the whole table.
+    """
+    def __init__(self,path,db_name,table_name,schema,page_fraction:float,row_fraction:float = 1.0,seed = None,snapshot = None):
+        self.db = DataBase(path,db_name,table_name,schema)
+        self.snapshot = None
+        if self.db.mvcc:
+            self.snapshot = snapshot if snapshot is not None else self.db.transactions.snapshot()
+        self.table_name = table_name
+        self.row_fraction = row_fraction
+        self.seed = seed
+        header = self.db.header
+        n_pages = max(header.end_offset - header.start_offset,0) // self.db.page_size
+        n_sampled = min(max(int(round(n_pages * page_fraction)),1 if page_fraction > 0 else 0),n_pages)
+        self.pages = sorted(random.Random(seed).sample(range(n_pages),n_sampled))
+        self.fraction = (n_sampled / n_pages if n_pages > 0 else 0.0) * row_fraction
+        self.random = random.Random(seed)
+        self.page_idx = 0
+        self.pages_read = 0
+        self.records = []
+        self.slot = 0
+
+    def next(self) -> tuple:
+        if self.has_next():
+            record = self.records[self.slot]
+            self.slot += 1
+            return record
+        return None
+
+    def has_next(self) -> bool:
+        while self.slot >= len(self.records):
+            if not self.load_next_page():
+                return False
+        return True
+
+    def load_next_page(self) -> bool:
+        if self.page_idx >= len(self.pages):
+            return False
+        page_bytes = self.db.read_page(self.pages[self.page_idx])
+        self.page_idx += 1
+        if page_bytes is None:
+            return False
+        self.pages_read += 1
+        page = DBPage()
+        page.decode(page_bytes,self.db.header.schema)
+        records = self.db.visible_records(page,self.snapshot)
+        if self.row_fraction < 1.0:
+            records = [record for record in records if self.random.random() < self.row_fraction]
+        self.records = records
+        self.slot = 0
+        return True
+
+    def reset(self):
+        self.page_idx = 0
+        self.records = []
+        self.slot = 0
+        self.random = random.Random(self.seed)
+
+    def ordering(self):
+        # the sampled pages are read in file order
+        return self.db.header.sort_col
+
+    def explain_metrics(self) -> dict:
+        return {'table': self.table_name, 'pages_read': self.pages_read, 'sample_fraction': round(self.fraction,6)}
+
+
+class HashIndexScan(object):
+    """
+    Return the records whose indexed column is equal to the key using a HashIndex (see indexes.py), reading the
+    index bucket and the table pages that hold the matching records instead of the whole table. The key can be
+    a value or a Const or Param expression.
+    """
+    def __init__(self,index,key,params:tuple = (),snapshot = None,transaction = None):
+        self.index = index
+        self.key = constant_value(key,params) if isinstance(key,Expr) else key
+        self.snapshot = transaction.snapshot if transaction is not None else snapshot
+        self.records = None
+        self.slot = 0
+
+    def next(self) -> tuple:
+        if self.has_next():
+            record = self.records[self.slot]
+            self.slot += 1
+            return record
+        return None
+
+    def has_next(self) -> bool:
+        if self.records is None:
+            self.records = self.index.fetch(self.key,self.snapshot)
+        return self.slot < len(self.records)
+
+    def reset(self):
+        self.records = None
+        self.slot = 0
+
+    def explain_metrics(self) -> dict:
+        return {'table': self.index.db.header.table_name.rstrip('\x00'),'index_pages_read': self.index.pages_read}
+
+
+class InvertedIndexScan(object):
+    """
+    Return the records whose tokens include all (match='all') or any (match='any') of the given tokens using an
+    InvertedIndex (see indexes.py), the postings are combined before any table page is read.
+    """
+    def __init__(self,index,tokens:list,match:str = 'all',snapshot = None,transaction = None):
+        if match not in ('all','any'):
+            raise ValueError(f"unknown match {match}, expected all or any")
+        self.index = index
+        self.tokens = list(tokens)
+        self.match = match
+        self.snapshot = transaction.snapshot if transaction is not None else snapshot
+        self.records = None
+        self.slot = 0
+        self.postings_matched = 0
+
+    def next(self) -> tuple:
+        if self.has_next():
+            record = self.records[self.slot]
+            self.slot += 1
+            return record
+        return None
+
+    def has_next(self) -> bool:
+        if self.records is None:
+            record_ids = self.index.match_all(self.tokens) if self.match == 'all' else self.index.match_any(self.tokens)
+            self.postings_matched = len(record_ids)
+            self.records = self.index.fetch(record_ids,self.snapshot)
+        return self.slot < len(self.records)
+
+    def reset(self):
+        self.records = None
+        self.slot = 0
+
+    def explain_metrics(self) -> dict:
+        return {'tokens': self.tokens,'match': self.match,'postings_matched': self.postings_matched}
+
+
+class TokenCountScan(object):
+    """
+    (token, number of records) of every token of an InvertedIndex ordered by token, read from the postings
+    lengths without reading the table.
+    """
+    def __init__(self,index):
+        self.index = index
+        self.rows = None
+        self.slot = 0
+
+    def next(self) -> tuple:
+        if self.has_next():
+            row = self.rows[self.slot]
+            self.slot += 1
+            return row
+        return None
+
+    def has_next(self) -> bool:
+        if self.rows is None:
+            self.rows = sorted(self.index.counts().items())
+        return self.slot < len(self.rows)
+
+    def reset(self):
+        self.rows = None
+        self.slot = 0
+
+    def ordering(self):
+        return 0
+
 
 class CSVFileStream(object):
 
@@ -277,10 +1351,13 @@ class MemoryScan(object):
 class Projection(object):
     """
     Map the child records using the given map function, e.g. to return a subset
-    of the fields.
+    of the fields. A list of expressions is compiled into a single function returning the tuple.
     """
-    def __init__(self, proj):
-        self.proj = proj
+    def __init__(self, proj, params = ()):
+        if isinstance(proj,Expr):
+            proj = [proj]
+        self.exprs = proj if isinstance(proj,(list,tuple)) else None
+        self.proj = bind(compile_projection(proj),params) if self.exprs is not None else proj
 
     def next(self):
         if self.has_next():
@@ -296,6 +1373,35 @@ class Projection(object):
     def reset(self):
         self.child.reset()
 
+class Unnest(object):
+    """
+    Split the delimited value of a column, e.g. the genres of the movies, and return one row per token with
+    the column replaced by the token, so the rows can be filtered or grouped by token.
+    """
+    def __init__(self,col:int,delimiter:str = '|'):
+        self.col = col
+        self.delimiter = delimiter
+        self.buffer = []
+
+    def next(self):
+        if len(self.buffer) > 0:
+            return self.buffer.pop()
+        current_tuple = self.child.next()
+        if current_tuple is None:
+            return None
+        value = current_tuple[self.col]
+        tokens = [] if value is None else list(dict.fromkeys(token.strip() for token in value.split(self.delimiter) if token.strip() != ''))
+        self.buffer = [(*current_tuple[:self.col],token,*current_tuple[self.col+1:]) for token in reversed(tokens)]
+        return self.buffer.pop() if len(self.buffer) > 0 else None
+
+    def has_next(self):
+        return len(self.buffer) > 0 or self.child.has_next()
+
+    def reset(self):
+        self.buffer = []
+        self.child.reset()
+
+
 class Selection(object):
     """
     Filter the child records using the given predicate function.
@@ -303,14 +1409,23 @@ class Selection(object):
     Yes it's confusing to call this "selection" as it's unrelated to SELECT in
     SQL, and is more like the WHERE clause. We keep the naming to be consistent
     with the literature.
+
+    The predicate may be a function or an expression, expressions are compiled once into a python function.
     """
-    def __init__(self, predicate):
-        self.predicate = predicate
+    def __init__(self, predicate, params = ()):
+        self.expr = predicate if isinstance(predicate,Expr) else None
+        self.params = params
+        self.predicate = bind(predicate.compile(),params) if self.expr is not None else predicate
+
+    def add_runtime_filter(self,key,runtime_filter):
+        key = key.compile() if isinstance(key,Expr) else key
+        predicate = self.predicate
+        self.predicate = lambda row: predicate(row) and (not runtime_filter.enabled or runtime_filter.might_contain(key(row)))
 
     def next(self):
         if self.has_next():
             current_tuple = self.child.next()
-            if self.predicate(current_tuple):
+            if current_tuple is not None and self.predicate(current_tuple):
                 return current_tuple
         else:        
             return None
@@ -318,21 +1433,37 @@ class Selection(object):
     def has_next(self):
         return self.child.has_next()
 
+    def ordering(self):
+        return ordering(self.child)
+
 
 class Limit(object):
     """
     Return only as many as the limit, then stop. If offset parameter is provided the function will 
     skip the number of rows provided as its value and start the limiting counting from the offset number.
+
+    When the rows come from a FileScan without filters, directly or through projections, the offset is skipped
+    in the scan counting the records of each page from its header, so the skipped pages are not decoded.
     """
     def __init__(self, n, offset = 0):
         self.n = n
         self.offset = offset
         self.fetched = 0 - offset
+        self.offset_skipped = offset == 0
+
+    def skip_offset(self):
+        self.offset_skipped = True
+        target = self.child.node if isinstance(self.child,InstrumentedNode) else self.child
+        while isinstance(target,Projection):
+            target = target.child.node if isinstance(target.child,InstrumentedNode) else target.child
+        if isinstance(target,FileScan) and target.can_skip_rows():
+            self.fetched += target.skip_rows(-self.fetched)
 
     def next(self):
         if self.has_next():
             cur_element = self.child.next()
-            if self.n > self.fetched:
+            # None only means the child has no row yet, e.g. a filtered row or a probe row without match
+            if cur_element is not None and self.n > self.fetched:
                 self.fetched += 1 
                 if self.fetched > 0:
                     return cur_element
@@ -341,40 +1472,103 @@ class Limit(object):
 
 
     def has_next(self):
+        if not self.offset_skipped:
+            self.skip_offset()
         return self.child.has_next() and self.fetched < self.n
     
     def reset(self):
         self.fetched = 0 - self.offset
+        self.offset_skipped = self.offset == 0
+
+    def ordering(self):
+        return ordering(self.child)
 
 class Sort(object):
     """
-    Sort based on the given key function
+    Sort based on the given key function. When a memory context with a limit is attached the buffered rows
+    are spilled to disk as sorted runs that are merged back when the child has been consumed.
+
+    If the key is a column expression and the child already produces its rows ordered on that column, for
+    example a scan over a clustered table, the rows are passed through without being buffered.
     """
     def __init__(self, key, desc=False):
-        self.key = key
+        self.key_expr = key if isinstance(key,Expr) else None
+        self.key = key.compile() if isinstance(key,Expr) else key
         self.desc = desc
+        self.presorted = False
         self.sorted_elements = []
         self.idx = 0
+        self.loaded = False
+        self.runs = []
+        self.merged = None
+        self.merged_head = None
+        self.spill_bytes = 0
+        self.memory = None
 
     def next(self):
-        if len(self.sorted_elements) == 0:
-            while True:
-                element = self.child.next()
-                if element is None:
-                    break
-                self.sorted_elements.append(element)
-            #print(f"unsorted_elements: {self.sorted_elements}")
-            
-            self.sorted_elements = list(sorted(self.sorted_elements,key=self.key,reverse=self.desc))
-            #self.buble_sort()
-            #print(f"sorted_elements: {self.sorted_elements}")
-            current_element = self.sorted_elements[self.idx]
-            self.idx+=1
+        if not self.loaded:
+            self.presorted = not self.desc and isinstance(self.key_expr,Col) and ordering(self.child) == self.key_expr.index
+            if self.presorted:
+                self.loaded = True
+            else:
+                self.load()
+        if self.presorted:
+            return self.child.next()
+        if len(self.runs) > 0:
+            current_element = self.merged_head
+            self.merged_head = next(self.merged,None)
             return current_element
-        else:
+        if self.idx < len(self.sorted_elements):
             current_element = self.sorted_elements[self.idx]
             self.idx+=1
             return current_element
+        return None
+
+    def load(self):
+        while True:
+            element = self.child.next()
+            if element is None:
+                if self.child.has_next():
+                    continue
+                break
+            self.sorted_elements.append(element)
+            if self.memory is not None:
+                self.memory.grow(self,record_size(element))
+        #print(f"unsorted_elements: {self.sorted_elements}")
+
+        self.sorted_elements = list(sorted(self.sorted_elements,key=self.key,reverse=self.desc))
+        #self.buble_sort()
+        #print(f"sorted_elements: {self.sorted_elements}")
+        self.loaded = True
+        if len(self.runs) > 0:
+            self.merge_runs()
+
+    def spill(self):
+        """
+        Write the rows buffered so far to a temporary file as a sorted run and release their memory.
+        """
+        run_file = tempfile.TemporaryFile()
+        for element in sorted(self.sorted_elements,key=self.key,reverse=self.desc):
+            pickle.dump(element,run_file)
+        self.spill_bytes += run_file.tell()
+        self.runs.append(run_file)
+        self.sorted_elements = []
+        if self.memory is not None:
+            self.memory.release(self)
+
+    def merge_runs(self):
+        runs = [self.read_run(run_file) for run_file in self.runs]
+        runs.append(iter(self.sorted_elements))
+        self.merged = heapq.merge(*runs,key=self.key,reverse=self.desc)
+        self.merged_head = next(self.merged,None)
+
+    def read_run(self,run_file):
+        run_file.seek(0)
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
 
 
     def buble_sort(self):
@@ -400,26 +1594,103 @@ class Sort(object):
 
 
     def has_next(self):
-        return self.child.has_next() or self.idx < len(self.sorted_elements)
+        if self.presorted:
+            return self.child.has_next()
+        if self.loaded and len(self.runs) > 0:
+            more = self.merged_head is not None
+        else:
+            more = self.child.has_next() or self.idx < len(self.sorted_elements)
+        if not more and self.memory is not None:
+            self.memory.release(self)
+        return more
     
     def reset(self):
         self.idx = 0
+        if self.presorted:
+            self.child.reset()
+        if self.memory is not None and not self.presorted:
+            # the rows kept in memory are returned again
+            self.memory.release(self)
+            self.memory.grow(self,sum(record_size(element) for element in self.sorted_elements))
+        if len(self.runs) > 0:
+            self.merge_runs()
+
+    def ordering(self):
+        return self.key_expr.index if isinstance(self.key_expr,Col) and not self.desc else None
+
+    def explain_metrics(self) -> dict:
+        return {'presorted': self.presorted}
 
 
 
 
 class Aggregation(object):
-    def __init__(self,group_col,col,func_name):
-        self.group_col = group_col
-        self.col = col
+    """
+    Hash group aggregation, the functions are count, sum, avg and the approximate approx_count_distinct
+    (HyperLogLog) and approx_percentile (t-digest) whose memory per group is bounded by the target error.
+    The sketches are mergeable: with emit_state=True the groups are returned with their sketch instead of
+    the estimate, and with merge_states=True the input column is expected to hold such sketches, so partial
+    aggregations over partitions can be combined by a final one. The group and value can be functions or expressions.
+
+    Without a group column the whole input is one group with the key None. Then count(*) and min/max over an
+    unfiltered FileScan are answered from the table metadata: the record counts of the page headers, and the
+    first and last records of a table clustered on the column or its zone map, so no record is decoded.
+    """
+    sketch_functions = ('approx_count_distinct','approx_percentile')
+    metadata_functions = ('count','min','max')
+
+    def __init__(self,group_col,col,func_name,percentile:float = 0.5,error:float = 0.02,emit_state = False,merge_states = False):
+        self.group_expr = group_col if isinstance(group_col,Expr) else None
+        self.col_expr = col if isinstance(col,Expr) else None
+        self.group_col = group_col.compile() if isinstance(group_col,Expr) else (lambda row: None) if group_col is None else group_col
+        self.col = col.compile() if isinstance(col,Expr) else col
+        self.global_group = group_col is None
         self.func_name = func_name.lower()
+        self.percentile = percentile
+        self.error = error
+        self.emit_state = emit_state
+        self.merge_states = merge_states
         self.acc = dict()
         self.result_keys = list()
         self.idx = 0 
+        self.groups = 0
+        self.memory = None
+        self.metadata_checked = not self.global_group or self.func_name not in self.metadata_functions
+        self.from_metadata = False
+        self.empty_emitted = not self.global_group or emit_state
+
+    def metadata_result(self):
+        """
+        Answer the aggregation from the metadata of the scanned table, when the input is a FileScan whose rows
+        are all returned and the value is counted with count(*) or is a column for min/max.
+        """
+        self.metadata_checked = True
+        scan = self.child.node if isinstance(self.child,InstrumentedNode) else self.child
+        if not isinstance(scan,FileScan) or not scan.can_skip_rows() or self.emit_state or self.merge_states:
+            return
+        if self.func_name == 'count':
+            if not isinstance(self.col_expr,Const) or self.col_expr.value is None:
+                return
+            value = scan.count_rows()
+            if value == 0:
+                return
+        else:
+            if not isinstance(self.col_expr,Col):
+                return
+            bounds = scan.column_bounds(self.col_expr.index)
+            if bounds is None:
+                return
+            value = bounds[0] if self.func_name == 'min' else bounds[1]
+        self.acc[None] = value
+        self.result_keys = [None]
+        self.groups = 1
+        self.from_metadata = True
 
     def sum_func(self,current_group_col,current_acc_val,current_tuple):
             current_val_col = self.col(current_tuple)
-            self.acc.update({current_group_col:current_acc_val+current_val_col})
+            if current_val_col is not None:
+                current_acc_val += current_val_col
+            self.acc.update({current_group_col:current_acc_val})
 
     def count_func(self,current_group_col,current_acc_val,current_tuple):
         current_val_col = 0 if self.col(current_tuple) is None else 1
@@ -427,20 +1698,53 @@ class Aggregation(object):
 
     def avg_func(self,current_group_col, current_acc_val, current_tuple):
         current_val_col = self.col(current_tuple)
-        count_current_val_col = 0 if self.col(current_tuple) is None else 1
         count_key = f"count_{current_group_col}"
         sum_key = f"sum_{current_group_col}"
-        self.acc.update({count_key:self.acc.get(count_key,0)+count_current_val_col})
-        self.acc.update({sum_key:self.acc.get(sum_key,0)+current_val_col})
-        self.acc.update({current_group_col: round(self.acc.get(sum_key,0)/self.acc.get(count_key,1),2)})
-
-
+        if current_val_col is not None:
+            self.acc.update({count_key:self.acc.get(count_key,0)+1})
+            self.acc.update({sum_key:self.acc.get(sum_key,0)+current_val_col})
+        count = self.acc.get(count_key,0)
+        self.acc.update({current_group_col: round(self.acc.get(sum_key,0)/count,2) if count > 0 else None})
+
+    def min_max_func(self,current_group_col,current_tuple):
+        value = self.col(current_tuple)
+        current = self.acc.get(current_group_col)
+        if current is None or (value is not None and (value < current if self.func_name == 'min' else value > current)):
+            self.acc[current_group_col] = value
+
+    def sketch_func(self,current_group_col,current_tuple):
+        sketch = self.acc.get(current_group_col)
+        if sketch is None:
+            if self.func_name == 'approx_count_distinct':
+                sketch = HyperLogLog(self.error)
+            else:
+                sketch = TDigest(max(int(2 / self.error),20))
+            self.acc[current_group_col] = sketch
+            if self.memory is not None:
+                self.memory.grow(self,sketch.size_bytes())
+        value = self.col(current_tuple)
+        if self.merge_states:
+            sketch.merge(value)
+        elif value is not None:
+            sketch.add(value)
+
+    def result(self,key):
+        value = self.acc.get(key)
+        if self.func_name not in self.sketch_functions or self.emit_state:
+            return value
+        if self.func_name == 'approx_count_distinct':
+            return value.count()
+        return value.quantile(self.percentile)
 
     def next(self):
+        if not self.metadata_checked:
+            self.metadata_result()
         if len(self.result_keys) == 0:
-            while True:
+            while not self.from_metadata:
                 current_tuple = self.child.next()
                 if current_tuple is None:
+                    if self.child.has_next():
+                        continue
                     break
                 
                 #print(current_tuple)
@@ -448,47 +1752,461 @@ class Aggregation(object):
                 current_acc_val = self.acc.get(current_group_col,0)
                 if current_group_col not in self.acc:
                     self.result_keys.append(current_group_col)
+                    self.groups += 1
+                    if self.memory is not None:
+                        self.memory.grow(self,record_size((current_group_col,current_acc_val)))
                 if self.func_name == 'sum':
                     self.sum_func(current_group_col,current_acc_val,current_tuple)
                 elif self.func_name == 'count':
                     self.count_func(current_group_col,current_acc_val,current_tuple)
                 elif self.func_name == 'avg':
                     self.avg_func(current_group_col,current_acc_val,current_tuple)
+                elif self.func_name in ('min','max'):
+                    self.min_max_func(current_group_col,current_tuple)
+                elif self.func_name in self.sketch_functions:
+                    self.sketch_func(current_group_col,current_tuple)
                 else:
                     raise NotImplementedError(f"the function {self.func_name} has not been implemented yet or does not exsits")
             if len(self.result_keys) == 0:
+                if self.groups == 0 and not self.empty_emitted and not self.child.has_next():
+                    # a global aggregate over no rows still returns one row, as in SQL
+                    self.empty_emitted = True
+                    return (None,0 if self.func_name in ('count','approx_count_distinct') else None)
                 return None
             key = self.result_keys.pop(0)
-            return (key,self.acc.get(key))
+            return (key,self.result(key))
         else:
             key = self.result_keys.pop(0)
-            return (key,self.acc.get(key))
+            return (key,self.result(key))
 
     def has_next(self):
-        return self.child.has_next() or len(self.result_keys) > 0
+        if not self.metadata_checked:
+            self.metadata_result()
+        if (not self.from_metadata and self.child.has_next()) or len(self.result_keys) > 0 \
+                or (self.groups == 0 and not self.empty_emitted):
+            return True
+        if self.memory is not None:
+            self.memory.release(self)
+        return False
 
     def reset(self):
         return self.child.reset()    
 
-class Insert(object):
+    def explain_metrics(self) -> dict:
+        metrics = {'hash_table_size': self.groups}
+        if self.from_metadata:
+            metrics['from_metadata'] = True
+        return metrics
+
+
+class StreamAggregation(object):
+    """
+    Group aggregation over an input that is already ordered on the group key, for example the output of Sort,
+    MergeJoin or a scan over a clustered table. A group is emitted as soon as a row with a different key
+    arrives, so only the running value of the current group is kept in memory and the first groups are returned
+    before the whole input has been read. Supports the same functions as Aggregation and the keys may be
+    functions or expressions.
+    """
+    functions = ('sum','count','avg')
 
-    def __init__(self,db:DataBase,records:list[tuple]):
+    def __init__(self,group_col,col,func_name):
+        self.group_col = group_col.compile() if isinstance(group_col,Expr) else group_col
+        self.col = col.compile() if isinstance(col,Expr) else col
+        self.func_name = func_name.lower()
+        if self.func_name not in self.functions:
+            raise NotImplementedError(f"the function {self.func_name} has not been implemented yet or does not exsits")
+        self.current_key = None
+        self.in_group = False
+        self.sum = 0
+        self.count = 0
+        self.done = False
+        self.groups = 0
+
+    def next(self):
+        while not self.done:
+            current_tuple = self.child.next()
+            if current_tuple is None:
+                if self.child.has_next():
+                    continue
+                self.done = True
+                return self.result() if self.in_group else None
+            key = self.group_col(current_tuple)
+            if self.in_group and key != self.current_key:
+                result = self.result()
+                self.start_group(key)
+                self.accumulate(current_tuple)
+                return result
+            if not self.in_group:
+                self.start_group(key)
+            self.accumulate(current_tuple)
+        return None
+
+    def start_group(self,key):
+        self.current_key = key
+        self.in_group = True
+        self.sum = 0
+        self.count = 0
+        self.groups += 1
+
+    def accumulate(self,current_tuple):
+        value = self.col(current_tuple)
+        if value is not None:
+            self.count += 1
+            if self.func_name != 'count':
+                self.sum += value
+
+    def result(self) -> tuple:
+        if self.func_name == 'sum':
+            return (self.current_key,self.sum)
+        elif self.func_name == 'count':
+            return (self.current_key,self.count)
+        return (self.current_key,round(self.sum/self.count,2) if self.count > 0 else None)
+
+    def has_next(self):
+        return not self.done
+
+    def reset(self):
+        self.child.reset()
+        self.in_group = False
+        self.done = False
+
+    def ordering(self):
+        # groups come out in the order of their keys
+        return 0
+
+    def explain_metrics(self) -> dict:
+        return {'groups': self.groups}
+
+
+class VectorAggregation(object):
+    """
+    Grouped aggregation over the column batches produced by ColumnScan. Each batch is factorized on the group
+    column with numpy and reduced with bincount (sum, count, avg) or ufunc.at (min, max), the partial results
+    of the batches are merged the same way at the end. Groups are emitted in ascending key order as
+    (key, value) tuples like Aggregation. Requires numpy.
+    """
+    functions = ('sum','count','avg','min','max')
+
+    def __init__(self,group_col:int,col:int,func_name:str):
+        if np is None:
+            raise ImportError("VectorAggregation requires numpy")
+        self.group_col = group_col
+        self.col = col
+        self.func_name = func_name.lower()
+        if self.func_name not in self.functions:
+            raise NotImplementedError(f"the function {self.func_name} has not been implemented yet or does not exsits")
+        self.partials = []
+        self.results = None
+        self.idx = 0
+
+    def reduce(self,keys,values,counts=None):
+        """
+        Aggregate values by key, counts are the number of rows each value stands for when merging partials.
+        """
+        unique_keys,inverse = np.unique(keys,return_inverse=True)
+        n = len(unique_keys)
+        if self.func_name in ('sum','avg','count'):
+            sums = np.bincount(inverse,weights=values,minlength=n)
+            counts = np.bincount(inverse,minlength=n) if counts is None else np.bincount(inverse,weights=counts,minlength=n)
+            return unique_keys,sums,counts
+        values = values.astype(np.float64)
+        reduced = np.full(n,np.inf if self.func_name == 'min' else -np.inf)
+        ufunc = np.minimum if self.func_name == 'min' else np.maximum
+        ufunc.at(reduced,inverse,values)
+        return unique_keys,reduced,None
+
+    def load(self):
+        while self.child.has_next():
+            batch = self.child.next()
+            if batch is None or len(batch[self.group_col]) == 0:
+                continue
+            self.partials.append(self.reduce(batch[self.group_col],batch[self.col]))
+        if len(self.partials) == 0:
+            self.results = []
+            return
+        keys = np.concatenate([partial[0] for partial in self.partials])
+        values = np.concatenate([partial[1] for partial in self.partials])
+        counts = np.concatenate([partial[2] for partial in self.partials]) if self.partials[0][2] is not None else None
+        keys,values,counts = self.reduce(keys,values,counts)
+        if self.func_name == 'count':
+            values = counts.astype(np.int64)
+        elif self.func_name == 'avg':
+            values = np.round(values / counts,2)
+        self.results = list(zip(keys.tolist(),values.tolist()))
+        self.partials = []
+
+    def next(self):
+        if self.results is None:
+            self.load()
+        if self.idx < len(self.results):
+            result = self.results[self.idx]
+            self.idx += 1
+            return result
+        return None
+
+    def has_next(self):
+        return self.results is None or self.idx < len(self.results)
+
+    def reset(self):
+        self.idx = 0
+
+    def explain_metrics(self) -> dict:
+        return {'hash_table_size': len(self.results) if self.results is not None else 0}
+
+
+class Insert(object):
+    """
+    Insert the records and commit them. The records are the given list or, without a list, the rows of the child
+    node, e.g. Q(Insert(db),Projection(...),FileScan(...)), which are streamed into the pages of the table as they
+    are produced. Full pages are written several at a time (see DataBase.write_buffer_pages), so the rows of a
+    query are stored without being held in memory. On mvcc tables the records are inserted by the given
+    transaction and are committed with it, without a transaction they are inserted in their own transaction.
+    """
+    def __init__(self,db:DataBase,records:list[tuple] = None,transaction = None):
         self.records = records
+        self.position = 0
         self.db = db
-        self.n = len(records)
+        self.n = 0
+        self.transaction = transaction
+        self.own_transaction = None
+        self.done = False
+        if db.mvcc and transaction is None:
+            self.own_transaction = self.transaction = db.transactions.begin()
     
     def next(self):
-        self.db.add_record(self.records.pop(0))
+        if self.records is not None:
+            record = self.records[self.position]
+            self.position += 1
+        else:
+            record = self.child.next()
+            if record is None:
+                return None
+        self.db.add_record(record,self.transaction)
+        self.n += 1
     
     def has_next(self):
-        if len(self.records) > 0:
+        if self.records is not None and self.position < len(self.records):
             return True
-        else:
-            self.db.write()
+        elif self.records is None and self.child.has_next():
+            return True
+        elif self.done:
+            return False
+        elif self.own_transaction is not None:
+            if not self.own_transaction.finished:
+                self.own_transaction.commit()
+                print("{} records inserted".format(self.n))
+        elif not self.db.mvcc:
+            # the transaction of a table without mvcc has nothing to commit, the table commits the pages itself
+            self.db.commit()
             print("{} records inserted".format(self.n))
+        self.done = True
         return False
 
-            
+    def explain_metrics(self) -> dict:
+        return {'rows_inserted': self.n}
+
+
+class ExchangeClosed(Exception):
+    pass
+
+
+class ExchangeDone(object):
+    """
+    Sent by a worker through every queue of the exchange when its input is exhausted or failed.
+    """
+    def __init__(self,error = None):
+        self.error = error
+
+
+class Exchange(object):
+    """
+    Run the subtree below it in worker threads or processes that send its rows in batches through bounded
+    queues, so the operators below and above the exchange run at the same time. The subtree is the child set
+    by Q, or a list of independent subtrees given as inputs each run by its own worker.
+
+        gather: the rows of all the inputs are returned by the exchange, in no particular order across inputs.
+        hash: the rows are split into `partitions` outputs by the hash of the key, read with `output(i)`.
+        broadcast: every one of the `partitions` outputs returns all the rows.
+
+    The outputs of a hash or broadcast exchange have to be read concurrently, usually by the inputs of a gather
+    exchange, because a worker waits when the queue of an output that is not being read is full:
+
+        split = Q(Exchange('hash',key=Col(1),partitions=4),FileScan(...))
+        q = Exchange(inputs=[Q(Aggregation(...),split.output(i)) for i in range(4)])
+
+    With processes=True the workers are forked processes instead of threads so cpu bound subtrees are not
+    limited by the GIL, the rows are pickled through the queues and the state of the subtree (e.g. pages_read)
+    stays in the worker.
+    """
+    modes = ('gather','hash','broadcast')
+
+    def __init__(self,mode = 'gather',key = None,partitions:int = 1,inputs:list = None,batch_size:int = 1024,queue_size:int = 8,processes = False):
+        if mode not in self.modes:
+            raise ValueError(f"unknown exchange mode {mode}, expected one of {self.modes}")
+        if mode == 'hash' and key is None:
+            raise ValueError("a hash exchange needs a key")
+        self.mode = mode
+        self.key = key.compile() if isinstance(key,Expr) else key
+        self.partitions = partitions if mode != 'gather' else 1
+        self.inputs = list(inputs) if inputs is not None else None
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.processes = processes
+        self.context = multiprocessing.get_context('fork') if processes else None
+        self.started = False
+        self.start_lock = threading.Lock()
+        self.workers = []
+        self.queues = []
+        self.buffers = []
+        self.done = []
+        self.stop = None
+        self.batches_received = 0
+
+    def input_nodes(self) -> list:
+        return self.inputs if self.inputs is not None else [self.child]
+
+    def start(self):
+        with self.start_lock:
+            if not self.started:
+                self.start_workers()
+                self.started = True
+
+    def start_workers(self):
+        if self.processes:
+            self.stop = self.context.Event()
+            self.queues = [self.context.Queue(self.queue_size) for _ in range(self.partitions)]
+        else:
+            self.stop = threading.Event()
+            self.queues = [queue.Queue(self.queue_size) for _ in range(self.partitions)]
+        self.buffers = [[] for _ in range(self.partitions)]
+        self.done = [0] * self.partitions
+        for node in self.input_nodes():
+            if self.processes:
+                worker = self.context.Process(target=self.produce,args=(node,),daemon=True)
+            else:
+                worker = threading.Thread(target=self.produce,args=(node,),daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def send(self,partition:int,item):
+        while True:
+            try:
+                self.queues[partition].put(item,timeout=0.1)
+                return
+            except queue.Full:
+                if self.stop.is_set():
+                    raise ExchangeClosed()
+
+    def produce(self,node):
+        batches = [[] for _ in range(self.partitions)]
+        all_partitions = range(self.partitions)
+        try:
+            for row in run(node):
+                targets = (hash(self.key(row)) % self.partitions,) if self.mode == 'hash' else all_partitions
+                for i in targets:
+                    batches[i].append(row)
+                    if len(batches[i]) >= self.batch_size:
+                        self.send(i,batches[i])
+                        batches[i] = []
+            for i in all_partitions:
+                if len(batches[i]) > 0:
+                    self.send(i,batches[i])
+            error = None
+        except ExchangeClosed:
+            return
+        except Exception as e:
+            error = e
+            if self.processes:
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    error = RuntimeError(f"{type(e).__name__}: {e}")
+        try:
+            for i in all_partitions:
+                self.send(i,ExchangeDone(error))
+        except ExchangeClosed:
+            return
+
+    def fetch(self,partition:int) -> bool:
+        """
+        Wait until there is a row to return for the partition, False when every worker has finished.
+        """
+        self.start()
+        while len(self.buffers[partition]) == 0:
+            if self.done[partition] == len(self.workers):
+                return False
+            item = self.queues[partition].get()
+            if isinstance(item,ExchangeDone):
+                self.done[partition] += 1
+                if item.error is not None:
+                    self.close()
+                    raise item.error
+            else:
+                # the batch is reversed so the rows are popped from the end in their original order
+                item.reverse()
+                self.buffers[partition] = item
+                self.batches_received += 1
+        return True
+
+    def read(self,partition:int):
+        return self.buffers[partition].pop() if self.fetch(partition) else None
+
+    def next(self):
+        if self.mode != 'gather':
+            raise ValueError(f"the rows of a {self.mode} exchange are read from its outputs")
+        return self.read(0)
+
+    def has_next(self):
+        if self.mode != 'gather':
+            raise ValueError(f"the rows of a {self.mode} exchange are read from its outputs")
+        return self.fetch(0)
+
+    def output(self,partition:int) -> "ExchangeOutput":
+        if partition < 0 or partition >= self.partitions:
+            raise IndexError(f"the exchange has {self.partitions} outputs")
+        return ExchangeOutput(self,partition)
+
+    def close(self):
+        """
+        Stop the workers, a query that is not read to the end should be closed so they do not wait forever.
+        """
+        if self.stop is not None:
+            self.stop.set()
+        for worker in self.workers:
+            if self.processes and worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def reset(self):
+        self.close()
+        for node in self.input_nodes():
+            node.reset()
+        self.started = False
+        self.buffers = []
+
+    def ordering(self):
+        # a single worker sends its rows in order through a single queue
+        inputs = self.input_nodes()
+        return ordering(inputs[0]) if self.mode == 'gather' and len(inputs) == 1 else None
+
+    def explain_metrics(self) -> dict:
+        return {'mode': self.mode,'workers': len(self.input_nodes()),'partitions': self.partitions,'batches': self.batches_received}
+
+
+class ExchangeOutput(object):
+    """
+    One output of a hash or broadcast exchange, the exchange starts its workers when an output is first read.
+    """
+    def __init__(self,exchange:Exchange,partition:int):
+        self.exchange = exchange
+        self.partition = partition
+
+    def next(self):
+        return self.exchange.read(self.partition)
+
+    def has_next(self):
+        return self.exchange.fetch(self.partition)
+
 
 def Q(*nodes):
     """
@@ -503,6 +2221,49 @@ def Q(*nodes):
     return root
 
 
+def ordering(node):
+    """
+    Index of the column the rows produced by the node are sorted on in ascending order, None when unknown.
+    """
+    return node.ordering() if hasattr(node,'ordering') else None
+
+
+def cluster_table(path,db_name,table_name,schema,col:int,memory_limit:int = None) -> int:
+    """
+    Rewrite the table sorted on the given column and record the sort column in the header, so the scans over
+    it report their ordering and Sort, MergeJoin and the aggregations on that column do not sort it again.
+    The table is sorted with Sort, spilling to disk when the memory limit is exceeded, into a new file that
+    replaces the original one. Returns the number of records.
+    """
+    q = Q(Sort(Col(col)),FileScan(path,db_name,table_name,schema))
+    memory = MemoryContext(memory_limit)
+    tmp_path = f"{path}.cluster"
+    for stale_path in (tmp_path,tmp_path + '.ovf'):
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    source = q.child.db
+    db = DataBase(tmp_path,db_name,table_name,schema,mvcc=source.mvcc,page_size=source.page_size,record_format=source.header.record_format)
+    n_records = 0
+    for record in memory.run(q):
+        db.add_record(record)
+        n_records += 1
+    db.header.sort_col = col
+    db.write()
+    for table in (db,source):
+        table.db.close()
+        table.db = None
+        if table.overflow is not None:
+            table.overflow.close()
+            table.overflow = None
+    os.replace(tmp_path,path)
+    # the long text values were copied to the overflow pages of the new file, the old ones are not referenced
+    if os.path.exists(tmp_path + '.ovf'):
+        os.replace(tmp_path + '.ovf',path + '.ovf')
+    elif os.path.exists(path + '.ovf'):
+        os.remove(path + '.ovf')
+    return n_records
+
+
 def run(q):
     """
     Run the given query to completion by calling `next` on the (presumed) root
@@ -516,6 +2277,126 @@ def run(q):
         yield x
 
 
+CHILD_ATTRIBUTES = ('child','left_node','right_node')
+
+class InstrumentedNode(object):
+    """
+    Wrap an executor node and record how many rows it produced, how many times it was called and
+    how much wall and cpu time was spent on it. Attribute access falls through to the wrapped node so
+    the parent operators keep working as if the wrapper was not there.
+
+    Times are inclusive of the children, the exclusive time is obtained subtracting the time
+    recorded by the instrumented children.
+    """
+    def __init__(self,node):
+        self.node = node
+        self.children = []
+        self.calls = 0
+        self.rows_out = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+
+    def next(self):
+        self.calls += 1
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = self.node.next()
+        self.wall_time += time.perf_counter() - wall_start
+        self.cpu_time += time.process_time() - cpu_start
+        if result is not None:
+            self.rows_out += 1
+        return result
+
+    def has_next(self):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = self.node.has_next()
+        self.wall_time += time.perf_counter() - wall_start
+        self.cpu_time += time.process_time() - cpu_start
+        return result
+
+    def reset(self):
+        return self.node.reset()
+
+    def __getattr__(self,name):
+        return getattr(self.node,name)
+
+    def rows_in(self) -> int:
+        return sum(child.rows_out for child in self.children)
+
+    def exclusive_wall_time(self) -> float:
+        return max(self.wall_time - sum(child.wall_time for child in self.children),0.0)
+
+    def exclusive_cpu_time(self) -> float:
+        return max(self.cpu_time - sum(child.cpu_time for child in self.children),0.0)
+
+    def metrics(self) -> dict:
+        metrics = {}
+        if hasattr(self.node,'explain_metrics'):
+            metrics.update(self.node.explain_metrics())
+        if hasattr(self.node,'spill_bytes'):
+            metrics['spill_bytes'] = self.node.spill_bytes
+        return metrics
+
+    def to_dict(self) -> dict:
+        return {
+            'operator': type(self.node).__name__,
+            'rows_in': self.rows_in(),
+            'rows_out': self.rows_out,
+            'calls': self.calls,
+            'wall_time_ms': round(self.exclusive_wall_time()*1000,3),
+            'cpu_time_ms': round(self.exclusive_cpu_time()*1000,3),
+            'metrics': self.metrics(),
+            'children': [child.to_dict() for child in self.children]
+        }
+
+    def to_json(self,indent=2) -> str:
+        return json.dumps(self.to_dict(),indent=indent,default=str)
+
+    def explain(self) -> str:
+        """
+        Render the collected statistics as an EXPLAIN ANALYZE tree, one operator per line.
+        """
+        lines = []
+        self._explain_lines(self.to_dict(),0,lines)
+        return '\n'.join(lines)
+
+    def _explain_lines(self,stats,depth,lines):
+        details = ' '.join(f"{k}={v}" for k,v in stats['metrics'].items())
+        prefix = '  '*depth + ('-> ' if depth > 0 else '')
+        lines.append(f"{prefix}{stats['operator']} (rows_in={stats['rows_in']} rows_out={stats['rows_out']} "
+                     f"calls={stats['calls']} wall={stats['wall_time_ms']}ms cpu={stats['cpu_time_ms']}ms"
+                     + (f" {details}" if details else '') + ")")
+        for child in stats['children']:
+            self._explain_lines(child,depth+1,lines)
+
+
+def instrument(node):
+    """
+    Wrap every operator of the query tree with an InstrumentedNode. The tree is only modified when
+    this function is called so queries that are not instrumented do not pay for it.
+    """
+    wrapper = InstrumentedNode(node)
+    for attr in CHILD_ATTRIBUTES:
+        child = getattr(node,attr,None)
+        if child is not None:
+            instrumented_child = instrument(child)
+            setattr(node,attr,instrumented_child)
+            wrapper.children.append(instrumented_child)
+    return wrapper
+
+
+def explain_analyze(q) -> InstrumentedNode:
+    """
+    Run the given query to completion with instrumentation enabled and return the instrumented root,
+    use `explain()` or `to_json()` on it to inspect the results.
+    """
+    root = instrument(q)
+    for _ in run(root):
+        pass
+    return root
+
+
 import os
 import psutil
 from datetime import datetime
@@ -559,7 +2440,124 @@ class ResourceMonitoring:
             if bytes_value < 1024:
                 return f"{bytes_value:.2f} {unit}"
             bytes_value /= 1024
-        return f"{bytes_value:.2f} TB"    
+        return f"{bytes_value:.2f} TB"
+
+
+def record_size(record) -> int:
+    """
+    Approximate number of bytes retained by a row, the tuple itself plus each of its values.
+    """
+    if isinstance(record,tuple):
+        return sys.getsizeof(record) + sum(sys.getsizeof(v) for v in record)
+    return sys.getsizeof(record)
+
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+class MemoryContext:
+    """
+    Per query memory accounting. Operators that buffer rows report the bytes they retain with `grow` and
+    give them back with `release`, the context keeps the current and high-water usage per operator and for
+    the whole query, the operators release everything when they are exhausted or reset. When a limit is set
+    and the query goes over it the operator is asked to spill. The query fails with MemoryLimitExceeded
+    naming the operator if it does not know how to spill, or if it retains less than min_spill_bytes
+    (limit // 8 by default) or not enough to bring the query back under the limit, as the other operators
+    hold the memory and spilling would only write tiny runs.
+
+    With trace=True tracemalloc is used to also record the real python allocation high-water of the query,
+    this catches short spikes that a sampling monitor like ResourceMonitoring would miss.
+    """
+    def __init__(self,limit=None,trace=False,min_spill_bytes=None):
+        self.limit = limit
+        self.min_spill_bytes = min_spill_bytes if min_spill_bytes is not None or limit is None else limit // 8
+        self.trace = trace
+        self.current = 0
+        self.peak = 0
+        self.traced_peak = 0
+        self.operators = dict()
+        self.started_tracing = False
+
+    def attach(self,q):
+        """
+        Set this context on every operator of the query tree that reports memory.
+        """
+        node = q.node if isinstance(q,InstrumentedNode) else q
+        if hasattr(node,'memory'):
+            node.memory = self
+        for attr in CHILD_ATTRIBUTES:
+            child = getattr(node,attr,None)
+            if child is not None:
+                self.attach(child)
+
+    def operator_stats(self,operator) -> dict:
+        key = id(operator)
+        if key not in self.operators:
+            name = f"{type(operator).__name__}#{len(self.operators)}"
+            self.operators[key] = {'operator': name,'current': 0,'peak': 0}
+        return self.operators[key]
+
+    def grow(self,operator,n_bytes:int):
+        stats = self.operator_stats(operator)
+        stats['current'] += n_bytes
+        stats['peak'] = max(stats['peak'],stats['current'])
+        self.current += n_bytes
+        self.peak = max(self.peak,self.current)
+        if self.limit is not None and self.current > self.limit:
+            if hasattr(operator,'spill') and stats['current'] >= self.min_spill_bytes \
+                    and self.current - stats['current'] <= self.limit:
+                operator.spill()
+            else:
+                raise MemoryLimitExceeded(f"query memory limit of {self.limit} bytes exceeded by "
+                                          f"{stats['operator']} retaining {stats['current']} bytes "
+                                          f"of the {self.current} bytes of the query")
+
+    def release(self,operator,n_bytes:int = None):
+        """
+        Give back n_bytes retained by the operator, or all of them when n_bytes is not provided.
+        """
+        if id(operator) not in self.operators:
+            return
+        stats = self.operator_stats(operator)
+        n_bytes = stats['current'] if n_bytes is None else min(n_bytes,stats['current'])
+        stats['current'] -= n_bytes
+        self.current -= n_bytes
+
+    def start(self):
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            tracemalloc.reset_peak()
+
+    def stop(self):
+        if self.trace and tracemalloc.is_tracing():
+            self.traced_peak = max(self.traced_peak,tracemalloc.get_traced_memory()[1])
+            if self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+
+    def run(self,q):
+        """
+        Run the given query to completion accounting its memory with this context.
+        """
+        self.attach(q)
+        self.start()
+        try:
+            for x in run(q):
+                yield x
+        finally:
+            self.stop()
+
+    def report(self) -> dict:
+        return {
+            'limit': self.limit,
+            'current': self.current,
+            'peak': self.peak,
+            'traced_peak': self.traced_peak,
+            'operators': sorted(self.operators.values(),key=lambda x: x['peak'],reverse=True)
+        }
 
 class TestInMemoryDB:
     # Test it by running pytest
@@ -947,6 +2945,14 @@ class TestHashJoin:
         assert result == expected
 
 
+    def test_repeated_probe_keys(self):
+        result = tuple(run(Q(
+           HashJoin(
+               Q(MemoryScan(self.left)),Q(MemoryScan(((1.0,3),(2.0,3),(3.0,1)))),lambda x: x[1],lambda x: x[1])
+               )))
+        expected = (('ToyStory', 3, 3, 1.0, 3), ('ToyStory', 3, 6, 1.0, 3), ('ToyStory', 3, 3, 2.0, 3), ('ToyStory', 3, 6, 2.0, 3), ('Poor things', 1, 2, 3.0, 1))
+        assert result == expected
+
     def test_projection_after(self):
         result = tuple(run(Q(Projection(lambda x: (x[0],x[3])),
            HashJoin(
@@ -993,6 +2999,747 @@ class TestMergeJoin:
         assert result == expected
 
 
+def create_table(path,table_name,schema,records) -> str:
+    """
+    Write the given records into a new table file, used by the tests that need a real file on disk.
+    """
+    db = DataBase(str(path),'mydb',table_name,schema)
+    for record in records:
+        db.add_record(record)
+    db.write()
+    db.db.close()
+    db.db = None
+    return str(path)
+
+
+class TestExplainAnalyze:
+    birds = TestInMemoryDB.birds
+
+    def test_rows_and_calls_per_operator(self):
+        root = explain_analyze(Q(
+            Projection(lambda x: (x[0],)),
+            Selection(lambda x: not x[3]),
+            MemoryScan(self.birds)
+        ))
+        stats = root.to_dict()
+        selection = stats['children'][0]
+        scan = selection['children'][0]
+        print(root.explain())
+        assert (stats['operator'],stats['rows_in'],stats['rows_out']) == ('Projection',3,3)
+        assert (selection['operator'],selection['rows_in'],selection['rows_out']) == ('Selection',10,3)
+        assert (scan['operator'],scan['rows_out'],scan['calls']) == ('MemoryScan',10,10)
+        assert root.explain().splitlines()[2].startswith('    -> MemoryScan (rows_in=0 rows_out=10')
+
+    def test_hash_table_size_and_json_export(self):
+        root = explain_analyze(Q(
+            HashJoin(
+                Q(MemoryScan(TestHashJoin.left)),Q(MemoryScan(TestHashJoin.right)),lambda x: x[1],lambda x: x[1])
+            ))
+        stats = json.loads(root.to_json())
+        assert stats['operator'] == 'HashJoin'
+        assert stats['metrics'] == {'hash_table_size': 4}
+        assert [child['operator'] for child in stats['children']] == ['MemoryScan','MemoryScan']
+
+    def test_file_scan_pages_read(self,tmp_path):
+        path = create_table(tmp_path / 'movies.db','movies',('int','str','str'),
+                            [(i,f'Movie {i}','Drama|Comedy') for i in range(1,301)])
+        root = explain_analyze(Q(
+            Aggregation(lambda x: x[2],lambda x: x[0],"count"),
+            FileScan(path,'mydb','movies',('int','str','str'))
+        ))
+        stats = root.to_dict()
+        assert stats['metrics'] == {'hash_table_size': 1}
+        assert stats['children'][0]['rows_out'] == 300
+        assert stats['children'][0]['metrics'] == {'table': 'movies', 'pages_read': 3, 'pages_skipped': 0}
+
+
+class TestMemoryContext:
+    birds = TestInMemoryDB.birds
+    numbers = tuple((i*7919 % 1000, f'row {i}') for i in range(1000))
+
+    def test_operator_high_water(self):
+        memory = MemoryContext(trace=True)
+        result = tuple(memory.run(Q(
+            HashJoin(
+                Q(MemoryScan(TestHashJoin.left)),Q(MemoryScan(TestHashJoin.right)),lambda x: x[1],lambda x: x[1])
+            )))
+        report = memory.report()
+        print(report)
+        assert len(result) == 4
+        assert report['operators'][0]['operator'] == 'HashJoin#0'
+        assert report['operators'][0]['peak'] == sum(record_size(r) for r in TestHashJoin.left)
+        assert report['peak'] == report['operators'][0]['peak']
+        assert report['traced_peak'] > 0
+
+    def test_limit_raises_naming_the_operator(self):
+        memory = MemoryContext(limit=500)
+        try:
+            tuple(memory.run(Q(
+                Aggregation(lambda x: x[0],lambda x: x[2],"sum"),
+                MemoryScan(self.birds)
+            )))
+            assert False, "expected the memory limit to be exceeded"
+        except MemoryLimitExceeded as e:
+            assert 'Aggregation#0' in str(e)
+
+    def test_sort_spills_over_the_limit(self):
+        memory = MemoryContext(limit=10000)
+        sort = Sort(lambda x: x[0])
+        result = tuple(memory.run(Q(sort,MemoryScan(self.numbers))))
+        assert result == tuple(sorted(self.numbers,key=lambda x: x[0]))
+        assert len(sort.runs) > 1 and sort.spill_bytes > 0
+        assert memory.report()['peak'] <= 10000 + record_size(self.numbers[0])*2
+        assert memory.report()['current'] == 0
+
+    def test_operators_release_their_memory(self):
+        memory = MemoryContext()
+        join = HashJoin(Q(MemoryScan(self.numbers)),Q(Sort(lambda x: x[0]),MemoryScan(self.numbers)),lambda x: x[0],lambda x: x[0])
+        result = tuple(memory.run(Q(Aggregation(lambda x: x[0],lambda x: x[1],'count'),join)))
+        assert len(result) == len(set(x[0] for x in self.numbers))
+        report = memory.report()
+        assert report['peak'] > 0 and report['current'] == 0
+        assert all(operator['current'] == 0 for operator in report['operators'])
+
+    def test_no_tiny_runs_when_another_operator_holds_the_memory(self):
+        limit = sum(record_size(x) for x in self.numbers) + 1000
+        memory = MemoryContext(limit=limit)
+        sort = Sort(lambda x: x[0])
+        join = HashJoin(Q(MemoryScan(self.numbers)),Q(MemoryScan(self.numbers)),lambda x: x[0],lambda x: x[0])
+        try:
+            tuple(memory.run(Q(sort,join)))
+            assert False, "expected the memory limit to be exceeded"
+        except MemoryLimitExceeded as e:
+            assert 'Sort#1' in str(e)
+        assert len(sort.runs) == 0
+
+
+class TestVectorAggregation:
+    ratings = [(i % 7,i % 5,float(i % 11) / 2,1000 + i) for i in range(3000)]
+
+    def expected(self,func):
+        values = defaultdict(list)
+        for row in self.ratings:
+            values[row[1]].append(row[2])
+        return tuple((k,func(v)) for k,v in sorted(values.items()))
+
+    def test_numeric_aggregations(self,tmp_path):
+        import pytest
+        pytest.importorskip('numpy')
+        schema = ('int','int','float','int')
+        path = create_table(tmp_path / 'ratings.db','ratings',schema,self.ratings)
+        results = dict()
+        for func_name in VectorAggregation.functions:
+            results[func_name] = tuple(run(Q(VectorAggregation(1,2,func_name),ColumnScan(path,'mydb','ratings',schema,[1,2],pages_per_batch=4))))
+        assert results['count'] == self.expected(len)
+        assert results['sum'] == self.expected(sum)
+        assert results['avg'] == self.expected(lambda v: round(sum(v)/len(v),2))
+        assert results['min'] == self.expected(min)
+        assert results['max'] == self.expected(max)
+
+    def test_column_scan_with_str_columns(self,tmp_path):
+        import pytest
+        pytest.importorskip('numpy')
+        schema = ('int','str','str')
+        path = create_table(tmp_path / 'movies.db','movies',schema,[(i,f'Movie {i}','Drama') for i in range(500)])
+        batches = list(run(Q(ColumnScan(path,'mydb','movies',schema,[0,1],pages_per_batch=2))))
+        assert [int(v) for batch in batches for v in batch[0]] == list(range(500))
+        assert batches[0][1][3] == 'Movie 3'
+
+
+class TestExpressions:
+    birds = TestInMemoryDB.birds
+    movies = [(i,f'Movie {i}','Drama' if i % 2 else 'Comedy') for i in range(1,1001)]
+
+    def test_selection_and_projection_expressions(self):
+        result = tuple(run(Q(
+            Projection([Col(0),Col(2) * 1000]),
+            Selection((Col(3) == True) & (Col(2) <= 0.01)),
+            MemoryScan(self.birds)
+        )))
+        assert result == (('rufhum',3.4),)
+
+    def test_file_scan_pushdown_and_zone_maps(self,tmp_path):
+        path = create_table(tmp_path / 'movies.db','movies',('int','str','str'),self.movies)
+        scan = FileScan(path,'mydb','movies',('int','str','str'),predicate=(Col(0) > 950) & (Col(2) == 'Comedy'),columns=[1])
+        result = tuple(run(Q(scan)))
+        assert result == tuple((f'Movie {i}',) for i in range(952,1001,2))
+        assert scan.pages_skipped == 0
+
+        DataBase(path,'mydb','movies',('int','str','str')).build_zone_map()
+        scan = FileScan(path,'mydb','movies',('int','str','str'),predicate=(Col(0) > 950) & (Col(2) == 'Comedy'),columns=[1])
+        assert tuple(run(Q(scan))) == result
+        assert scan.pages_read == 1 and scan.pages_skipped == 6
+
+    def test_stale_zone_map_is_ignored(self,tmp_path):
+        path = create_table(tmp_path / 'movies.db','movies',('int','str','str'),self.movies)
+        DataBase(path,'mydb','movies',('int','str','str')).build_zone_map()
+        db = DataBase(path,'mydb','movies',('int','str','str'))
+        db.add_record((5000,'Movie 5000','Drama'))
+        db.write()
+        db.db.close()
+        db.db = None
+        scan = FileScan(path,'mydb','movies',('int','str','str'),predicate=Col(0) == 5000)
+        assert tuple(run(Q(scan))) == ((5000,'Movie 5000','Drama'),)
+        assert scan.zone_map is None
+
+
+
+class TestRuntimeFilter:
+    movies = TestExpressions.movies
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        runtime_filter = RuntimeFilter(range(0,2000,2))
+        assert all(runtime_filter.might_contain(key) for key in range(0,2000,2))
+        assert not runtime_filter.might_contain(-1) and not runtime_filter.might_contain(5000)
+        false_positives = sum(runtime_filter.might_contain(key) for key in range(1,2000,2))
+        assert false_positives < 50
+
+    def test_hash_join_pushes_filter_into_file_scan(self,tmp_path):
+        path = create_table(tmp_path / 'movies.db','movies',('int','str','str'),self.movies)
+        ratings = [(1,10,4.0),(2,500,3.0),(3,999,5.0)]
+        scan = FileScan(path,'mydb','movies',('int','str','str'))
+        join = HashJoin(Q(MemoryScan(ratings)),Q(scan),Col(1),Col(0))
+        result = tuple(run(Q(join)))
+        assert result == ((1,10,4.0,10,'Movie 10','Comedy'),(2,500,3.0,500,'Movie 500','Comedy'),(3,999,5.0,999,'Movie 999','Drama'))
+        assert scan.rows_filtered >= 990
+        assert join.explain_metrics()['runtime_filter']['checked'] == 1000
+
+    def test_filter_through_selection_and_disable(self):
+        keys = [(i,) for i in range(20000)]
+        selection = Selection(lambda x: x[0] % 2 == 0)
+        join = HashJoin(Q(MemoryScan(keys)),Q(selection,MemoryScan(list(keys))),lambda x: x[0],lambda x: x[0])
+        assert len(tuple(run(Q(join)))) == 10000
+        assert join.runtime_filter.selectivity() == 1.0
+
+        runtime_filter = RuntimeFilter(range(20000))
+        assert len(runtime_filter.filter(list(range(20000)),lambda x: x)) == 20000
+        assert not runtime_filter.enabled
+        assert len(runtime_filter.filter([-1],lambda x: x)) == 1
+
+
+class TestClusteredTable:
+    ratings = [((i*7919) % 500,i,float(i % 5)) for i in range(2000)]
+    schema = ('int','int','float')
+
+    def test_cluster_records_sort_column(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        cluster_table(path,'mydb','ratings',self.schema,0,memory_limit=20000)
+        scan = FileScan(path,'mydb','ratings',self.schema)
+        assert scan.ordering() == 0
+        result = tuple(run(Q(scan)))
+        assert [x[0] for x in result] == sorted(x[0] for x in self.ratings)
+        assert FileScan(path,'mydb','ratings',self.schema,columns=[1,0]).ordering() == 1
+        assert FileScan(path,'mydb','ratings',self.schema,columns=[1]).ordering() is None
+
+    def test_sort_and_merge_join_skip_clustered_input(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        cluster_table(path,'mydb','ratings',self.schema,0)
+        movies = [(i,f'Movie {i}') for i in range(0,500,100)]
+        sort = Sort(Col(0))
+        join = MergeJoin(Q(Sort(lambda x: x[0]),MemoryScan(movies)),Q(sort,Selection(Col(2) >= 4.0),FileScan(path,'mydb','ratings',self.schema)),Col(0),Col(0))
+        result = tuple(run(Q(join)))
+        assert sort.presorted
+        assert ordering(join) == 0
+        assert result == tuple((m,name,*r) for m,name in movies for r in sorted(self.ratings) if r[0] == m and r[2] >= 4.0)
+
+    def test_out_of_order_insert_clears_sort_column(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        cluster_table(path,'mydb','ratings',self.schema,0)
+        db = DataBase(path,'mydb','ratings',self.schema)
+        db.add_record((600,1,1.0))
+        assert db.header.sort_col == 0
+        db.add_record((3,1,1.0))
+        assert db.header.sort_col is None
+        db.write()
+        db.db.close()
+        db.db = None
+        assert FileScan(path,'mydb','ratings',self.schema).ordering() is None
+
+    def test_cluster_keeps_overflow_values(self,tmp_path):
+        schema = ('int','text')
+        movies = [(3,'a' * 2000),(1,'b' * 2000),(2,'c' * 2000),(0,'d')]
+        path = create_table(tmp_path / 'movies.db','movies',schema,movies)
+        cluster_table(path,'mydb','movies',schema,0)
+        assert tuple(run(Q(FileScan(path,'mydb','movies',schema)))) == tuple(sorted(movies))
+        assert not os.path.exists(path + '.cluster.ovf')
+
+
+class TestStreamAggregation:
+    ratings = sorted(((i*7919) % 50,i,float(i % 5)) for i in range(1000))
+
+    def test_same_result_as_hash_aggregation(self):
+        for func_name in ('sum','count','avg'):
+            expected = tuple(run(Q(Aggregation(lambda x: x[0],lambda x: x[2],func_name),MemoryScan(self.ratings))))
+            result = tuple(run(Q(StreamAggregation(Col(0),Col(2),func_name),MemoryScan(self.ratings))))
+            assert result == expected
+
+    def test_limit_returns_before_reading_the_input(self):
+        scan = MemoryScan(self.ratings)
+        result = tuple(run(Q(Limit(2),StreamAggregation(Col(0),Col(2),'count'),scan)))
+        assert result == ((0,20),(1,20))
+        assert scan.idx < 100
+
+    def test_after_sort_with_filtered_rows(self):
+        result = tuple(run(Q(
+            StreamAggregation(lambda x: x[0],lambda x: x[2],'sum'),
+            Sort(Col(0)),
+            Selection(lambda x: x[0] < 3),
+            MemoryScan(list(reversed(self.ratings)))
+        )))
+        expected = tuple(run(Q(Aggregation(lambda x: x[0],lambda x: x[2],'sum'),MemoryScan([x for x in self.ratings if x[0] < 3]))))
+        assert result == expected and len(result) == 3
+
+
+class TestApproxAggregation:
+    ratings = [(i % 10,(i * 7919) % 3000,float((i * 31) % 11) / 2) for i in range(30000)]
+
+    def test_distinct_users_and_median_per_movie(self):
+        distinct = dict(run(Q(Aggregation(lambda x: x[0],lambda x: x[1],'approx_count_distinct'),MemoryScan(self.ratings))))
+        medians = dict(run(Q(Aggregation(lambda x: x[0],lambda x: x[2],'approx_percentile',percentile=0.5),MemoryScan(self.ratings))))
+        for movie in range(10):
+            users = {x[1] for x in self.ratings if x[0] == movie}
+            assert abs(distinct[movie] - len(users)) / len(users) < 0.06
+            assert abs(medians[movie] - 2.5) <= 0.5
+
+    def test_merge_partial_states(self):
+        partials = []
+        for partition in range(3):
+            rows = self.ratings[partition::3]
+            partials.extend(run(Q(Aggregation(lambda x: x[0],lambda x: x[1],'approx_count_distinct',emit_state=True),MemoryScan(rows))))
+        assert isinstance(partials[0][1],HyperLogLog)
+        merged = dict(run(Q(Aggregation(lambda x: x[0],lambda x: x[1],'approx_count_distinct',merge_states=True),MemoryScan(partials))))
+        single = dict(run(Q(Aggregation(lambda x: x[0],lambda x: x[1],'approx_count_distinct'),MemoryScan(self.ratings))))
+        assert merged == single
+
+
+class TestSampleScan:
+    schema = ('int','int','float')
+
+    def test_page_sample_reads_only_sampled_pages(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,[(i,i % 50,float(i % 5)) for i in range(20000)])
+        n_pages = FileScan(path,'mydb','ratings',self.schema).db.page_count()
+        scan = SampleScan(path,'mydb','ratings',self.schema,0.1,seed=42)
+        result = tuple(run(Q(scan)))
+        assert scan.pages_read == len(scan.pages) == round(n_pages * 0.1)
+        assert abs(scan.fraction - 0.1) < 0.01
+        assert abs(len(result) / scan.fraction - 20000) < 2000
+        assert tuple(run(Q(SampleScan(path,'mydb','ratings',self.schema,0.1,seed=42)))) == result
+
+    def test_row_sample(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,[(i,i % 50,float(i % 5)) for i in range(20000)])
+        scan = SampleScan(path,'mydb','ratings',self.schema,1.0,row_fraction=0.25,seed=1)
+        count = sum(1 for _ in run(Q(scan)))
+        assert scan.fraction == 0.25
+        assert abs(count - 5000) < 500
+
+
+class TestMVCC:
+    schema = ('int','int','float')
+
+    def create(self,path,records) -> DataBase:
+        db = DataBase(str(path),'mydb','ratings',self.schema,mvcc=True)
+        for _ in run(Q(Insert(db,list(records)))):
+            pass
+        return db
+
+    def scan(self,db,**kwargs) -> tuple:
+        return tuple(run(Q(FileScan(db.db_path,'mydb','ratings',self.schema,**kwargs))))
+
+    def test_snapshot_isolation(self,tmp_path):
+        db = self.create(tmp_path / 'ratings.db',[(i,1,4.0) for i in range(100)])
+        before = db.transactions.snapshot()
+        transaction = db.transactions.begin()
+        for _ in run(Q(Insert(db,[(i,2,3.0) for i in range(100,1000)],transaction))):
+            pass
+        db.write()
+        assert len(self.scan(db)) == 100
+        assert len(self.scan(db,transaction=transaction)) == 1000
+        transaction.commit()
+        assert len(self.scan(db)) == 1000
+        assert len(self.scan(db,snapshot=before)) == 100
+        assert len(self.scan(db,predicate=Col(0) >= 990,columns=[0])) == 10
+
+    def test_abort_and_delete(self,tmp_path):
+        db = self.create(tmp_path / 'ratings.db',[(i,1,4.0) for i in range(500)])
+        with db.transactions.begin() as transaction:
+            for i in range(500,1000):
+                db.add_record((i,2,3.0),transaction)
+            transaction.abort()
+        assert len(self.scan(db)) == 500
+        reopened = DataBase(db.db_path,'mydb','ratings',self.schema)
+        assert reopened.mvcc and len(self.scan(reopened)) == 500
+
+        deleter = db.transactions.begin()
+        assert db.delete(lambda x: x[0] < 100,deleter) == 100
+        other = db.transactions.begin()
+        try:
+            db.delete(lambda x: x[0] == 5,other)
+            assert False, "expected a WriteConflict"
+        except WriteConflict:
+            other.abort()
+        assert len(self.scan(db)) == 500
+        deleter.commit()
+        assert [x[0] for x in self.scan(db)] == list(range(100,500))
+
+    def test_scans_run_while_inserting(self,tmp_path):
+        import threading
+        db = self.create(tmp_path / 'ratings.db',[(i,1,4.0) for i in range(2000)])
+        snapshot = db.transactions.snapshot()
+        counts = []
+        def scan():
+            for _ in range(5):
+                counts.append(sum(1 for _ in run(Q(FileScan(db.db_path,'mydb','ratings',self.schema,snapshot=snapshot)))))
+        reader = threading.Thread(target=scan)
+        reader.start()
+        for batch in range(10):
+            for _ in run(Q(Insert(db,[(i,3,2.0) for i in range(200)]))):
+                pass
+        reader.join()
+        assert counts == [2000] * 5
+        assert len(self.scan(db)) == 4000
+
+
+class TestInsertTransaction:
+    def test_insert_with_a_transaction_into_a_table_without_mvcc(self,tmp_path):
+        path = str(tmp_path / 'ratings.db')
+        db = DataBase(path,'mydb','ratings',('int','int','float'))
+        transaction = TransactionManager.for_table(path).begin()
+        for _ in run(Q(Insert(db,[(i,1,4.0) for i in range(10)],transaction))):
+            pass
+        assert len(tuple(run(Q(FileScan(path,'mydb','ratings',('int','int','float')))))) == 10
+
+    def test_commits_once(self,tmp_path):
+        db = DataBase(str(tmp_path / 'ratings.db'),'mydb','ratings',('int','int','float'))
+        class CommitCounter:
+            commits = 0
+            def record_added(self,record):
+                pass
+            def committed(self):
+                self.commits += 1
+        counter = CommitCounter()
+        db.add_listener(counter)
+        insert = Q(Insert(db,[(1,1,4.0)]))
+        for _ in run(insert):
+            pass
+        assert not insert.has_next() and not insert.has_next()
+        assert counter.commits == 1
+
+
+class TestPageSize:
+
+    def test_page_size_is_kept_in_the_header(self,tmp_path):
+        records = [(i,i % 7,float(i % 5)) for i in range(5000)]
+        db = DataBase(str(tmp_path / 'ratings.db'),'mydb','ratings',('int','int','float'),page_size=16384)
+        for _ in run(Q(Insert(db,list(records)))):
+            pass
+        scan = FileScan(str(tmp_path / 'ratings.db'),'mydb','ratings',('int','int','float'))
+        assert scan.db.page_size == 16384
+        assert tuple(run(Q(scan))) == tuple(records)
+        assert scan.pages_read == scan.db.page_count() == os.path.getsize(tmp_path / 'ratings.db') // 16384
+
+    def test_long_text_values_use_overflow_pages(self,tmp_path):
+        records = [(i,f'Movie {i}','plot ' * (i * 500)) for i in range(6)]
+        db = DataBase(str(tmp_path / 'movies.db'),'mydb','movies',('int','str','text'))
+        for _ in run(Q(Insert(db,list(records)))):
+            pass
+        assert os.path.getsize(tmp_path / 'movies.db.ovf') >= 5 * 2500
+        scan = FileScan(str(tmp_path / 'movies.db'),'mydb','movies',('int','str','text'),predicate=Col(0) >= 4,columns=[2])
+        assert tuple(run(Q(scan))) == ((records[4][2],),(records[5][2],))
+        assert tuple(run(Q(FileScan(str(tmp_path / 'movies.db'),'mydb','movies',('int','str','text'))))) == tuple(records)
+
+
+class TestExchange:
+    ratings = [(i % 37,(i * 7919) % 500,float(i % 5)) for i in range(5000)]
+
+    def test_gather_inputs(self):
+        exchange = Exchange(inputs=[MemoryScan(self.ratings[i::4]) for i in range(4)],batch_size=64,queue_size=2)
+        assert sorted(run(Q(exchange))) == sorted(self.ratings)
+        assert exchange.explain_metrics()['workers'] == 4
+        in_order = Q(Exchange(batch_size=100),Selection(Col(0) < 5),MemoryScan(self.ratings))
+        assert tuple(run(in_order)) == tuple(x for x in self.ratings if x[0] < 5)
+
+    def test_hash_repartition_parallel_aggregation(self):
+        split = Q(Exchange('hash',key=Col(0),partitions=4,batch_size=128),MemoryScan(self.ratings))
+        q = Exchange(inputs=[Q(Aggregation(lambda x: x[0],lambda x: x[2],'sum'),split.output(i)) for i in range(4)])
+        expected = run(Q(Aggregation(lambda x: x[0],lambda x: x[2],'sum'),MemoryScan(self.ratings)))
+        assert sorted(run(q)) == sorted(expected)
+
+    def test_broadcast_join(self):
+        movies = [(i,f"Movie {i}") for i in range(0,500,7)]
+        split = Q(Exchange('hash',key=Col(1),partitions=3),MemoryScan(self.ratings))
+        broadcast = Q(Exchange('broadcast',partitions=3),MemoryScan(movies))
+        joins = [HashJoin(broadcast.output(i),split.output(i),Col(0),Col(1),runtime_filter=False) for i in range(3)]
+        result = sorted(run(Q(Exchange(inputs=joins))))
+        assert result == sorted((*m,*r) for m in movies for r in self.ratings if r[1] == m[0])
+
+    def test_worker_processes_and_errors(self,tmp_path):
+        schema = ('int','int','float')
+        path = create_table(tmp_path / 'ratings.db','ratings',schema,self.ratings)
+        inputs = [Q(Selection(Col(1) < 100),FileScan(path,'mydb','ratings',schema)) for _ in range(2)]
+        result = tuple(run(Q(Exchange(inputs=inputs,processes=True))))
+        assert sorted(result) == sorted(2 * [x for x in self.ratings if x[1] < 100])
+        import pytest
+        with pytest.raises(ZeroDivisionError):
+            tuple(run(Q(Exchange(),Projection(lambda x: x[0] / 0),MemoryScan(self.ratings))))
+
+
+class TestHashIndexScan:
+    schema = ('int','str','str')
+    movies = [(i,f"Movie {i} ({1950 + i % 70})",'Drama' if i % 4 else 'Comedy') for i in range(3000)]
+
+    def test_lookup_reads_only_matching_pages(self,tmp_path):
+        from indexes import HashIndex
+        db = DataBase(str(tmp_path / 'movies.db'),'mydb','movies',self.schema)
+        index = HashIndex(db,1)
+        for _ in run(Q(Insert(db,list(self.movies)))):
+            pass
+        scan = HashIndexScan(index,Param(0),(self.movies[1234][1],))
+        index.pages_read = 0
+        assert tuple(run(Q(scan))) == (self.movies[1234],)
+        assert scan.explain_metrics() == {'table': 'movies','index_pages_read': 1}
+        assert tuple(run(Q(HashIndexScan(index,'Movie 1234')))) == ()
+
+    def test_index_nested_loop_join(self,tmp_path):
+        from indexes import HashIndex
+        path = create_table(tmp_path / 'movies.db','movies',self.schema,self.movies)
+        index = HashIndex(DataBase(path,'mydb','movies',self.schema),0)
+        ratings = [(user,(user * 7919) % 3500,4.0) for user in range(200)]
+        join = IndexNestedLoopJoin(Q(MemoryScan(ratings)),index,Col(1))
+        result = tuple(run(Q(join)))
+        assert result == tuple((*r,*m) for r in ratings for m in self.movies if m[0] == r[1])
+        assert join.lookups == 200
+
+
+class TestInvertedIndexScan:
+    schema = ('int','str','str')
+    movies = [(1,'Toy Story (1995)','Adventure|Animation|Children|Comedy|Fantasy'),(2,'Jumanji (1995)','Adventure|Children|Fantasy'),
+              (3,'Grumpier Old Men (1995)','Comedy|Romance'),(4,'Waiting to Exhale (1995)','Comedy|Drama|Romance'),
+              (5,'Father of the Bride Part II (1995)','Comedy'),(6,'Heat (1995)','Action|Crime|Thriller')]
+
+    def test_genre_queries_and_counts(self,tmp_path):
+        from indexes import InvertedIndex
+        path = create_table(tmp_path / 'movies.db','movies',self.schema,self.movies)
+        index = InvertedIndex(DataBase(path,'mydb','movies',self.schema),2)
+        assert tuple(x[0] for x in run(Q(InvertedIndexScan(index,['Comedy','Romance'])))) == (3,4)
+        assert tuple(x[0] for x in run(Q(InvertedIndexScan(index,['Children','Drama'],match='any')))) == (1,2,4)
+        counts = tuple(run(Q(TokenCountScan(index))))
+        expected = tuple(sorted(run(Q(Aggregation(Col(2),Col(0),'count'),Unnest(2),MemoryScan(self.movies)))))
+        assert counts == expected and dict(counts)['Comedy'] == 4
+
+
+class TestLimitOffsetSkip:
+    schema = ('int','str','float')
+    movies = [(i,f"Movie {i}",float(i % 10) / 2) for i in range(5000)]
+
+    def test_offset_skips_pages_by_header(self,tmp_path):
+        path = create_table(tmp_path / 'movies.db','movies',self.schema,self.movies)
+        scan = FileScan(path,'mydb','movies',self.schema)
+        result = tuple(run(Q(Limit(10,offset=4321),scan)))
+        assert result == tuple(self.movies[4321:4331])
+        assert scan.rows_skipped == 4321 and scan.pages_read <= 2 and scan.pages_skipped > 20
+        projected = tuple(run(Q(Limit(3,offset=1000),Projection([Col(1)]),FileScan(path,'mydb','movies',self.schema,columns=[0,1]))))
+        assert projected == (('Movie 1000',),('Movie 1001',),('Movie 1002',))
+        assert tuple(run(Q(Limit(10,offset=4995),FileScan(path,'mydb','movies',self.schema)))) == tuple(self.movies[4995:])
+        assert tuple(run(Q(Limit(10,offset=6000),FileScan(path,'mydb','movies',self.schema)))) == ()
+
+    def test_filtered_scan_is_not_skipped(self,tmp_path):
+        path = create_table(tmp_path / 'movies.db','movies',self.schema,self.movies)
+        scan = FileScan(path,'mydb','movies',self.schema,predicate=Col(2) > 4.0)
+        result = tuple(run(Q(Limit(5,offset=100),scan)))
+        assert result == tuple([x for x in self.movies if x[2] > 4.0][100:105])
+        assert scan.rows_skipped == 0
+
+
+class TestMetadataAggregation:
+    schema = ('int','int','float','int')
+    ratings = [(i % 300,(i * 7919) % 2000,float(i % 10) / 2,1000000000 + i) for i in range(5000)]
+
+    def test_count_from_page_headers(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        scan = FileScan(path,'mydb','ratings',self.schema)
+        aggregation = Aggregation(None,Const(1),'count')
+        assert tuple(run(Q(aggregation,scan))) == ((None,5000),)
+        assert aggregation.from_metadata and scan.pages_read == 0
+        filtered = Aggregation(None,Const(1),'count')
+        assert tuple(run(Q(filtered,FileScan(path,'mydb','ratings',self.schema,predicate=Col(0) < 10)))) == ((None,170),)
+        assert not filtered.from_metadata
+
+    def test_min_max_from_zone_map_and_sort_order(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        scan = FileScan(path,'mydb','ratings',self.schema)
+        assert tuple(run(Q(Aggregation(None,Col(1),'max'),scan))) == ((None,1999),) and scan.pages_read > 1
+        DataBase(path,'mydb','ratings',self.schema).build_zone_map()
+        scan = FileScan(path,'mydb','ratings',self.schema,columns=[2,1])
+        aggregation = Aggregation(None,Col(1),'min')
+        assert tuple(run(Q(aggregation,scan))) == ((None,0),)
+        assert aggregation.from_metadata and scan.pages_read == 0
+        cluster_table(path,'mydb','ratings',self.schema,3)
+        scan = FileScan(path,'mydb','ratings',self.schema)
+        assert tuple(run(Q(Aggregation(None,Col(3),'max'),scan))) == ((None,1000004999),) and scan.pages_read == 2
+        grouped = dict(run(Q(Aggregation(Col(0),Col(2),'min'),MemoryScan(self.ratings))))
+        assert grouped == {user: min(x[2] for x in self.ratings if x[0] == user) for user in range(300)}
+
+
+class TestRecordFormat:
+    schema = ('int','str','text','float','int')
+    movies = [(1,'Toy Story (1995)','Animation|Comedy',4.5,820000000),(2,'',None,None,-5),(3,None,'x' * 1000,None,830000000)]
+
+    def test_fixed_offset_records_keep_nulls_and_empty_strings(self,tmp_path):
+        path = str(tmp_path / 'movies.db')
+        db = DataBase(path,'mydb','movies',self.schema,record_format=RECORD_FORMAT_V2)
+        for _ in run(Q(Insert(db,list(self.movies)))):
+            pass
+        scan = FileScan(path,'mydb','movies',self.schema)
+        assert scan.db.header.schema.record_format == RECORD_FORMAT_V2
+        assert tuple(run(Q(scan))) == tuple(self.movies)
+        assert tuple(run(Q(FileScan(path,'mydb','movies',self.schema,predicate=Col(4) > 0,columns=[4])))) == ((820000000,),(830000000,))
+        page_bytes = scan.db.read_page(0)
+        page = DBPage()
+        page.header.decode(page_bytes[0:int.from_bytes(page_bytes[12:16],'little')])
+        end,size = page.header.record_pointers[0]
+        assert page.decode_field(page_bytes[end-size:end],scan.db.header.schema,1) == 'Toy Story (1995)'
+
+    def test_mvcc_and_cluster_keep_the_format(self,tmp_path):
+        path = str(tmp_path / 'movies.db')
+        db = DataBase(path,'mydb','movies',self.schema,mvcc=True,record_format=RECORD_FORMAT_V2)
+        for _ in run(Q(Insert(db,list(self.movies)))):
+            pass
+        transaction = db.transactions.begin()
+        assert db.delete(lambda x: x[0] == 2,transaction) == 1
+        transaction.commit()
+        assert [x[0] for x in run(Q(FileScan(path,'mydb','movies',self.schema)))] == [1,3]
+        cluster_table(path,'mydb','movies',self.schema,0)
+        scan = FileScan(path,'mydb','movies',self.schema)
+        assert scan.db.header.record_format == RECORD_FORMAT_V2 and scan.ordering() == 0
+
+    def test_filter_and_sum_a_nullable_column(self,tmp_path):
+        path = str(tmp_path / 'movies.db')
+        db = DataBase(path,'mydb','movies',self.schema,record_format=RECORD_FORMAT_V2)
+        for _ in run(Q(Insert(db,list(self.movies)))):
+            pass
+        scan = lambda **kwargs: FileScan(path,'mydb','movies',self.schema,**kwargs)
+        assert tuple(run(Q(scan(predicate=Col(3) > 1.0,columns=[0])))) == ((1,),)
+        assert tuple(run(Q(Selection(Col(3) <= 1.0),scan()))) == ()
+        assert tuple(run(Q(Aggregation(None,Col(3),'sum'),scan()))) == ((None,4.5),)
+        assert tuple(run(Q(Aggregation(None,Col(3),'avg'),scan()))) == ((None,4.5),)
+        assert tuple(run(Q(Aggregation(Col(0),Col(3),'avg'),scan()))) == ((1,4.5),(2,None),(3,None))
+
+
+class TestInsertSelect:
+    schema = ('int','int','float','int')
+    ratings = [(i % 300,(i * 7919) % 2000,float(i % 10) / 2,1000000000 + i) for i in range(20000)]
+
+    def test_insert_streams_child_rows_in_page_batches(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        target = DataBase(str(tmp_path / 'high.db'),'mydb','high',('int','float'))
+        writes = []
+        write = target.write
+        target.write = lambda: (writes.append(len(target.pages)),write())
+        insert = Insert(target)
+        for _ in run(Q(insert,Projection([Col(1),Col(2)]),FileScan(path,'mydb','ratings',self.schema,predicate=Col(2) >= 4.0))):
+            pass
+        expected = tuple((x[1],x[2]) for x in self.ratings if x[2] >= 4.0)
+        assert insert.n == len(expected)
+        assert tuple(run(Q(FileScan(target.db_path,'mydb','high',('int','float'))))) == expected
+        assert len(writes) < target.page_count() and max(writes) > 1
+
+
+class TestSemiJoin:
+    movies = ((1,'Toy Story (1995)'),(2,'Jumanji (1995)'),(3,'Heat (1995)'),(4,'Sabrina (1995)'),(5,None))
+    ratings = ((1,1,4.0),(2,1,3.0),(1,3,5.0),(3,3,2.0),(3,1,5.0),(4,None,1.0))
+
+    def test_hash_and_merge_semi_join(self):
+        expected = ((1,'Toy Story (1995)'),(3,'Heat (1995)'))
+        semi = SemiJoin(Q(MemoryScan(self.movies)),Q(MemoryScan(self.ratings)),Col(0),Col(1))
+        assert tuple(run(Q(semi))) == expected
+        assert semi.explain_metrics()['build_keys'] == 2 and semi.rows_emitted == 2
+        merge = SemiJoin(Q(MemoryScan(self.movies)),Q(Sort(Col(1)),MemoryScan(self.ratings[:5])),Col(0),Col(1),method='merge')
+        assert tuple(run(Q(merge))) == expected
+
+    def test_anti_join_not_exists_and_not_in(self):
+        unrated = ((2,'Jumanji (1995)'),(4,'Sabrina (1995)'),(5,None))
+        assert tuple(run(Q(AntiJoin(Q(MemoryScan(self.movies)),Q(MemoryScan(self.ratings)),Col(0),Col(1))))) == unrated
+        merge = AntiJoin(Q(MemoryScan(self.movies)),Q(Sort(Col(1)),MemoryScan(self.ratings[:5])),Col(0),Col(1),method='merge')
+        assert tuple(run(Q(merge))) == unrated
+        not_in = AntiJoin(Q(MemoryScan(self.movies)),Q(MemoryScan(self.ratings)),Col(0),Col(1),null_aware=True)
+        assert tuple(run(Q(not_in))) == ()
+        titles = AntiJoin(Q(MemoryScan(self.movies)),Q(MemoryScan(self.movies[:2])),Col(1),Col(1),null_aware=True)
+        assert tuple(run(Q(titles))) == ((3,'Heat (1995)'),(4,'Sabrina (1995)'))
+
+    def test_runtime_filter_into_the_left_scan(self,tmp_path):
+        schema = ('int','int','float','int')
+        ratings = [(i % 300,(i * 7919) % 2000,float(i % 10) / 2,1000000000 + i) for i in range(5000)]
+        path = create_table(tmp_path / 'ratings.db','ratings',schema,ratings)
+        scan = FileScan(path,'mydb','ratings',schema)
+        semi = SemiJoin(Q(scan),Q(MemoryScan([(7,),(8,)])),Col(0),Col(0))
+        assert tuple(run(Q(semi))) == tuple(x for x in ratings if x[0] in (7,8))
+        assert semi.runtime_filter is not None and scan.rows_filtered > 0
+
+
+class TestAdaptiveJoin:
+    schema = ('int','int','float','int')
+    ratings = [(i % 300,(i * 7919) % 2000,float(i % 10) / 2,1000000000 + i) for i in range(5000)]
+    movies = [(i,f"Movie {i}") for i in range(0,2000,7)]
+
+    def expected(self) -> list:
+        titles = dict(self.movies)
+        return sorted((*x,x[1],titles[x[1]]) for x in self.ratings if x[1] in titles)
+
+    def test_builds_on_the_smaller_side(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',self.schema,self.ratings)
+        join = AdaptiveJoin(Q(FileScan(path,'mydb','ratings',self.schema)),Q(MemoryScan(self.movies)),Col(1),Col(0),sample_size=100)
+        assert sorted(run(Q(join))) == self.expected()
+        metrics = join.explain_metrics()
+        assert metrics['strategy'] == 'hash' and metrics['build_side'] == 'right' and metrics['build_rows'] == len(self.movies)
+        assert metrics['estimated_rows'] == {'left': 5000,'right': len(self.movies)}
+
+    def test_merge_when_both_inputs_are_sorted(self):
+        join = AdaptiveJoin(Q(Sort(Col(1)),MemoryScan(self.ratings)),Q(Sort(Col(0)),MemoryScan(self.movies)),Col(1),Col(0))
+        result = list(run(Q(join)))
+        assert join.strategy == 'merge' and sorted(result) == self.expected()
+        assert [x[1] for x in result] == sorted(x[1] for x in result)
+
+    def test_spills_to_a_grace_hash_join(self):
+        join = AdaptiveJoin(Q(MemoryScan(self.movies)),Q(MemoryScan(self.ratings)),Col(0),Col(1),sample_size=10,build_limit=2000,partitions=4)
+        assert sorted(run(Q(join))) == sorted((x[1],self.movies[x[1] // 7][1],*x) for x in self.ratings if x[1] % 7 == 0)
+        assert join.strategy == 'grace' and join.build_side == 'left' and join.explain_metrics()['spill_bytes'] > 0
+        memory = MemoryContext(limit=5000)
+        join = AdaptiveJoin(Q(MemoryScan(self.ratings)),Q(MemoryScan(self.movies)),Col(1),Col(0),sample_size=10)
+        assert sorted(memory.run(Q(join))) == self.expected()
+        assert join.strategy == 'grace' and join.build_side == 'right'
+
+    def test_merge_join_over_the_memory_limit_fails(self):
+        duplicates = [(0,i) for i in range(500)]
+        join = AdaptiveJoin(Q(Sort(Col(0)),MemoryScan(duplicates)),Q(Sort(Col(0)),MemoryScan(duplicates)),Col(0),Col(0))
+        try:
+            list(MemoryContext(limit=5000).run(Q(join)))
+            assert False
+        except MemoryLimitExceeded as e:
+            assert join.strategy == 'merge' and 'AdaptiveJoin' in str(e)
+
+
+class TestBlockNestedLoopJoin:
+    movies = [(i,f"Movie {i}",1990 + i % 30) for i in range(200)]
+    ratings = [(i % 50,(i * 7) % 200,float(i % 10) / 2,1000000000 + i) for i in range(2000)]
+
+    def test_theta_join_scans_the_right_side_once_per_block(self,tmp_path):
+        path = create_table(tmp_path / 'ratings.db','ratings',('int','int','float','int'),self.ratings)
+        scan = FileScan(path,'mydb','ratings',('int','int','float','int'))
+        predicate = (Col(0) == Col(4)) & (Col(5) < Col(2) - 1990)
+        join = BlockNestedLoopJoin(Q(MemoryScan(self.movies)),Q(scan),predicate,block_size=2000,cache_limit=0)
+        result = sorted(run(Q(join)))
+        assert result == sorted((*m,*r) for m in self.movies for r in self.ratings if m[0] == r[1] and r[2] < m[2] - 1990)
+        assert join.blocks > 1 and join.right_scans == join.blocks and not join.explain_metrics()['right_cached']
+
+    def test_cached_right_side_and_params(self):
+        right = MemoryScan(self.ratings[:100])
+        join = BlockNestedLoopJoin(Q(MemoryScan(self.movies)),Q(right),Col(5) > Param(0),params=(4.0,),block_size=500)
+        result = list(run(Q(join)))
+        assert len(result) == len(self.movies) * sum(1 for r in self.ratings[:100] if r[2] > 4.0)
+        assert join.blocks > 1 and join.right_scans == 1 and join.cache is not None
+        product = BlockNestedLoopJoin(Q(MemoryScan(self.movies[:3])),Q(MemoryScan(self.movies[:2])))
+        assert sorted(run(Q(product))) == sorted((*x,*y) for x in self.movies[:3] for y in self.movies[:2])
+
 
 if __name__ == '__main__':
-    print('ok')
\ No newline at end of file
+    print('ok')
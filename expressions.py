@@ -0,0 +1,347 @@
+"""
+Declarative expressions for the executor nodes. Unlike the lambdas used by Selection and Projection an
+expression tree can be inspected, so the scans can use it to skip pages and to decode only the columns that
+are needed. Each expression is compiled once into a single python function, either over a tuple or over a
+batch (list) of tuples, and the generated function is cached by its source code. Param placeholders are
+read from the params argument of the generated functions so a prepared query is compiled only once.
+
+    Selection((Col(2) > 3.5) & (Col(1) != 'Drama'))
+    Projection([Col(0), Col(2) * 2])
+"""
+from collections import OrderedDict
+from functools import partial
+
+COMPILED_CACHE_SIZE = 1024
+ARITHMETIC_OPS = ('+','-','*','/')
+_compiled_cache = OrderedDict()
+
+
+class Expr(object):
+
+    def source(self) -> str:
+        raise NotImplementedError
+
+    def columns(self) -> set:
+        return set()
+
+    def may_match(self,zones:dict,params:tuple = ()) -> bool:
+        """
+        Given the (min,max) range of some columns return False only when no row inside those ranges can
+        satisfy the expression. Used by the scans to skip pages and partitions.
+        """
+        return True
+
+    def to_dict(self) -> dict:
+        """
+        JSON serializable form of the expression, rebuilt with expr_from_dict, e.g. to send it to a worker.
+        """
+        raise NotImplementedError
+
+    def compile(self):
+        """
+        Compile the expression into a function over one row.
+        """
+        return compile_source(f"lambda row, params=(): {self.source()}")
+
+    def compile_batch(self):
+        """
+        Compile the expression as a predicate over a batch of rows returning the rows that satisfy it.
+        """
+        return compile_source(f"lambda rows, params=(): [row for row in rows if {self.source()}]")
+
+    def __eq__(self,other): return Comparison('==',self,other)
+    def __ne__(self,other): return Comparison('!=',self,other)
+    def __lt__(self,other): return Comparison('<',self,other)
+    def __le__(self,other): return Comparison('<=',self,other)
+    def __gt__(self,other): return Comparison('>',self,other)
+    def __ge__(self,other): return Comparison('>=',self,other)
+    def __add__(self,other): return Arithmetic('+',self,other)
+    def __sub__(self,other): return Arithmetic('-',self,other)
+    def __mul__(self,other): return Arithmetic('*',self,other)
+    def __truediv__(self,other): return Arithmetic('/',self,other)
+    def __and__(self,other): return And(self,other)
+    def __or__(self,other): return Or(self,other)
+    def __invert__(self): return Not(self)
+
+    __hash__ = object.__hash__
+
+    def __bool__(self):
+        raise TypeError("expressions can not be used as booleans, combine them with &, | and ~")
+
+    def __repr__(self):
+        return self.source()
+
+
+class Col(Expr):
+    def __init__(self,index:int):
+        self.index = index
+
+    def source(self) -> str:
+        return f"row[{self.index}]"
+
+    def to_dict(self) -> dict:
+        return {'type': 'Col','index': self.index}
+
+    def columns(self) -> set:
+        return {self.index}
+
+
+class Const(Expr):
+    def __init__(self,value):
+        if not isinstance(value,(int,float,str,bool,type(None))):
+            raise TypeError(f"constant of type {type(value).__name__} is not supported")
+        self.value = value
+
+    def source(self) -> str:
+        return repr(self.value)
+
+    def to_dict(self) -> dict:
+        return {'type': 'Const','value': self.value}
+
+
+class Param(Expr):
+    """
+    Placeholder for a value provided when the query is executed.
+    """
+    def __init__(self,index:int):
+        self.index = index
+
+    def source(self) -> str:
+        return f"params[{self.index}]"
+
+    def to_dict(self) -> dict:
+        return {'type': 'Param','index': self.index}
+
+
+class Comparison(Expr):
+    flipped = {'==':'==','!=':'!=','<':'>','<=':'>=','>':'<','>=':'<='}
+    ordering = ('<','<=','>','>=')
+
+    def __init__(self,op:str,left,right):
+        self.op = op
+        self.left = as_expr(left)
+        self.right = as_expr(right)
+
+    def source(self) -> str:
+        comparison = f"{self.left.source()} {self.op} {self.right.source()}"
+        if self.op in self.ordering:
+            # a NULL value never satisfies an ordering comparison instead of raising a TypeError
+            guards = [f"{side.source()} is not None and " for side in (self.left,self.right) if not isinstance(side,Const)]
+            comparison = ''.join(guards) + comparison
+        return f"({comparison})"
+
+    def to_dict(self) -> dict:
+        return {'type': type(self).__name__,'op': self.op,'left': self.left.to_dict(),'right': self.right.to_dict()}
+
+    def columns(self) -> set:
+        return self.left.columns() | self.right.columns()
+
+    def may_match(self,zones:dict,params:tuple = ()) -> bool:
+        if isinstance(self.left,Col) and isinstance(self.right,(Const,Param)):
+            col,value,op = self.left,constant_value(self.right,params),self.op
+        elif isinstance(self.left,(Const,Param)) and isinstance(self.right,Col):
+            col,value,op = self.right,constant_value(self.left,params),self.flipped[self.op]
+        else:
+            return True
+        if col.index not in zones or value is None:
+            return True
+        low,high = zones[col.index]
+        try:
+            if op == '==':
+                return low <= value <= high
+            elif op == '!=':
+                return not (low == high == value)
+            elif op == '<':
+                return low < value
+            elif op == '<=':
+                return low <= value
+            elif op == '>':
+                return high > value
+            elif op == '>=':
+                return high >= value
+        except TypeError:
+            return True
+        return True
+
+
+class Arithmetic(Expr):
+    def __init__(self,op:str,left,right):
+        self.op = op
+        self.left = as_expr(left)
+        self.right = as_expr(right)
+
+    def source(self) -> str:
+        return f"({self.left.source()} {self.op} {self.right.source()})"
+
+    def to_dict(self) -> dict:
+        return {'type': type(self).__name__,'op': self.op,'left': self.left.to_dict(),'right': self.right.to_dict()}
+
+    def columns(self) -> set:
+        return self.left.columns() | self.right.columns()
+
+
+class And(Expr):
+    def __init__(self,*items):
+        self.items = [as_expr(item) for item in items]
+
+    def source(self) -> str:
+        return '(' + ' and '.join(item.source() for item in self.items) + ')'
+
+    def to_dict(self) -> dict:
+        return {'type': 'And','items': [item.to_dict() for item in self.items]}
+
+    def columns(self) -> set:
+        return set().union(*(item.columns() for item in self.items))
+
+    def may_match(self,zones:dict,params:tuple = ()) -> bool:
+        return all(item.may_match(zones,params) for item in self.items)
+
+
+class Or(Expr):
+    def __init__(self,*items):
+        self.items = [as_expr(item) for item in items]
+
+    def source(self) -> str:
+        return '(' + ' or '.join(item.source() for item in self.items) + ')'
+
+    def to_dict(self) -> dict:
+        return {'type': 'Or','items': [item.to_dict() for item in self.items]}
+
+    def columns(self) -> set:
+        return set().union(*(item.columns() for item in self.items))
+
+    def may_match(self,zones:dict,params:tuple = ()) -> bool:
+        return any(item.may_match(zones,params) for item in self.items)
+
+
+class Not(Expr):
+    def __init__(self,item):
+        self.item = as_expr(item)
+
+    def source(self) -> str:
+        return f"(not {self.item.source()})"
+
+    def to_dict(self) -> dict:
+        return {'type': 'Not','item': self.item.to_dict()}
+
+    def columns(self) -> set:
+        return self.item.columns()
+
+
+def as_expr(value) -> Expr:
+    return value if isinstance(value,Expr) else Const(value)
+
+
+def expr_from_dict(data:dict) -> Expr:
+    """
+    Rebuild an expression from to_dict. The indexes and operators end up in the compiled source so they are
+    checked, the data may come from another process.
+    """
+    kind = data['type']
+    if kind in ('Col','Param'):
+        if type(data['index']) is not int:
+            raise ValueError(f"invalid index {data['index']!r}")
+        return (Col if kind == 'Col' else Param)(data['index'])
+    elif kind == 'Const':
+        return Const(data['value'])
+    elif kind in ('Comparison','Arithmetic'):
+        if data['op'] not in (Comparison.flipped if kind == 'Comparison' else ARITHMETIC_OPS):
+            raise ValueError(f"invalid operator {data['op']!r}")
+        return (Comparison if kind == 'Comparison' else Arithmetic)(data['op'],expr_from_dict(data['left']),expr_from_dict(data['right']))
+    elif kind in ('And','Or'):
+        return (And if kind == 'And' else Or)(*[expr_from_dict(item) for item in data['items']])
+    elif kind == 'Not':
+        return Not(expr_from_dict(data['item']))
+    raise ValueError(f"unknown expression type {kind}")
+
+
+def constant_value(expr:Expr,params:tuple):
+    if isinstance(expr,Param):
+        return params[expr.index] if expr.index < len(params) else None
+    return expr.value
+
+
+def compile_source(source:str):
+    """
+    Evaluate the generated lambda source, functions are cached by source so equal expressions share them.
+    The cache keeps the most recently used functions only.
+    """
+    fn = _compiled_cache.get(source)
+    if fn is None:
+        fn = eval(compile(source,'<expression>','eval'),{'__builtins__': {}})
+        _compiled_cache[source] = fn
+        if len(_compiled_cache) > COMPILED_CACHE_SIZE:
+            _compiled_cache.popitem(last=False)
+    else:
+        _compiled_cache.move_to_end(source)
+    return fn
+
+
+def bind(fn,params:tuple):
+    """
+    Fix the params of a compiled function so it can be called with a row only.
+    """
+    return partial(fn,params=params) if len(params) > 0 else fn
+
+
+def compile_projection(exprs:list):
+    """
+    Compile a list of expressions into one function returning the projected tuple for a row.
+    """
+    items = ''.join(f"{as_expr(e).source()}," for e in exprs)
+    return compile_source(f"lambda row, params=(): ({items})")
+
+
+def compile_batch_projection(exprs:list):
+    items = ''.join(f"{as_expr(e).source()}," for e in exprs)
+    return compile_source(f"lambda rows, params=(): [({items}) for row in rows]")
+
+
+class TestExpressions:
+    rows = [(1,'Toy Story',3.5),(2,'Jumanji',2.0),(3,'Heat',4.5)]
+
+    def test_compile_predicate(self):
+        predicate = ((Col(2) > 3) & (Col(1) != 'Heat')) | (Col(0) == 2)
+        fn = predicate.compile()
+        assert [fn(row) for row in self.rows] == [True,True,False]
+        assert predicate.compile_batch()(self.rows) == self.rows[:2]
+        assert predicate.columns() == {0,1,2}
+
+    def test_compile_projection_and_cache(self):
+        fn = compile_projection([Col(1),Col(2) * 2,Const('x')])
+        assert fn(self.rows[0]) == ('Toy Story',7.0,'x')
+        assert compile_projection([Col(1),Col(2) * 2,Const('x')]) is fn
+        assert compile_batch_projection([Col(0)])(self.rows) == [(1,),(2,),(3,)]
+
+    def test_may_match_ranges(self):
+        zones = {0: (10,20)}
+        assert not (Col(0) > 20).may_match(zones)
+        assert (Col(0) >= 20).may_match(zones)
+        assert not (Const(5) > Col(0)).may_match(zones)
+        assert not ((Col(0) == 3) | (Col(0) == 30)).may_match(zones)
+        assert ((Col(0) == 3) | (Col(1) == 'a')).may_match(zones)
+        assert not ((Col(0) < 50) & (Col(0) < 10)).may_match(zones)
+
+    def test_params(self):
+        predicate = (Col(0) >= Param(0)) & (Col(2) < Param(1))
+        assert bind(predicate.compile_batch(),(2,4.0))(self.rows) == [(2,'Jumanji',2.0)]
+        assert not predicate.may_match({0: (10,20)},(30,1.0))
+        assert predicate.may_match({0: (10,20)},(15,1.0))
+
+    def test_dict_round_trip(self):
+        import json
+        predicate = ((Col(2) * 2 > Param(0)) & ~(Col(1) == 'Heat')) | (Col(0) == None)
+        rebuilt = expr_from_dict(json.loads(json.dumps(predicate.to_dict())))
+        assert rebuilt.source() == predicate.source()
+        try:
+            expr_from_dict({'type': 'Col','index': '0] or exit('})
+            assert False, "expected a ValueError"
+        except ValueError:
+            pass
+
+    def test_expression_is_not_a_boolean(self):
+        try:
+            bool(Col(0) == 1)
+            assert False, "expected a TypeError"
+        except TypeError:
+            pass
@@ -0,0 +1,532 @@
+"""
+Secondary indexes of a table, stored in their own file next to it and kept up to date by listening to the
+DataBase used to write the table (see DataBase.add_listener).
+
+    HashIndex: extendible hashing on one column for equality lookups. A directory of 2**global_depth entries
+        points to the bucket pages, a full bucket is split in two and only the directory entries pointing to
+        it change, doubling the directory when the bucket already used all the bits of the directory. A lookup
+        reads one bucket page and then the table pages of the matching records.
+    InvertedIndex: token -> compressed postings over a column of delimited values, for AND/OR token queries
+        and counts per token.
+
+The index file has the page size of the table: page 0 holds the index metadata and the list of directory pages,
+the bucket pages use the table page format with (key, page_no, slot) records. When the table is changed
+without the index (its size or last page do not match the ones stored with the index) the index is rebuilt
+when it is opened.
+"""
+import heapq
+import math
+import os
+import struct
+
+from data_layout import DataBase, DBPage, PageRecord, PAGE_STATIC_HEADER_SIZE
+from sketches import hash64
+
+INDEX_MAGIC = b'EHIX'
+INDEX_META = struct.Struct("<4siiiqQi") # magic, column, global depth, pages, table size and last page hash, directory pages
+NO_PAGE = 0 # page 0 is the metadata page so it can mark the end of a bucket chain
+
+
+def table_signature(db:DataBase) -> tuple:
+    """
+    Size and hash of the last page of the table, stored with an index to find out if the table changed without it.
+    Records are only appended so any new record changes one of them, the hidden columns updated by mvcc
+    deletes may change them too but they do not make the index stale.
+    """
+    size = os.stat(db.db_path).st_size
+    n_pages = db.page_count()
+    return (size,hash64(db.read_page(n_pages - 1) if n_pages > 0 else b''))
+
+
+def fetch_records(db:DataBase,locations:list,snapshot = None) -> list:
+    """
+    Records at the (page_no, slot) locations, reading every table page once and decoding only the records at
+    those slots. On mvcc tables only the records visible in the snapshot are returned, without the hidden columns.
+    """
+    schema = db.header.schema
+    if db.mvcc and snapshot is None:
+        snapshot = db.transactions.snapshot()
+    pages = dict()
+    for page_no,slot in locations:
+        pages.setdefault(page_no,[]).append(slot)
+    records = []
+    for page_no,slots in pages.items():
+        if len(db.pages) > 0 and page_no == db.last_page_no():
+            # the last page may have records that are not written yet
+            page_records = [db.last_page().records[slot].record for slot in slots]
+        else:
+            page_bytes = db.read_page(page_no)
+            page = DBPage(page_size=db.page_size)
+            page.header.decode(page_bytes[0:int.from_bytes(page_bytes[12:16],'little')])
+            pointers = page.header.record_pointers
+            page_records = [page.decode_record(page_bytes[pointers[slot][0]-pointers[slot][1]:pointers[slot][0]],schema) for slot in slots]
+        for record in db.resolve_overflow(page_records):
+            if db.mvcc:
+                if not snapshot.is_visible(record[0],record[1]):
+                    continue
+                record = record[db.hidden_columns:]
+            records.append(record)
+    return records
+
+
+class Bucket:
+    """
+    Chain of bucket pages, the first one is the page the directory points to. More pages are only chained when
+    the entries can not be split because all of them have the same hash, e.g. a repeated key. Every page is
+    kept as [page_no, entries, bytes used].
+    """
+    def __init__(self,local_depth:int,pages:list):
+        self.local_depth = local_depth
+        self.pages = pages
+
+    def entries(self) -> list:
+        return [entry for _,entries,_ in self.pages for entry in entries]
+
+
+class HashIndex:
+    """
+    Extendible hash index on a column of the table written through db. Text keys longer than an eighth of a
+    page are indexed by their prefix, the records are always compared with the key when they are fetched.
+    """
+    def __init__(self,db:DataBase,col:int,path:str = None):
+        self.db = db
+        self.col = col
+        self.path = path if path is not None else f"{db.db_path}.hidx{col}"
+        self.page_size = db.page_size
+        self.dtype = db.schema[col]
+        self.schema = (self.dtype,'int','int')
+        self.record_col = db.hidden_columns + col
+        self.entries_per_directory_page = self.page_size // 4
+        max_directory_pages = (self.page_size - INDEX_META.size) // 4
+        self.max_global_depth = min(int(math.log2(max_directory_pages * self.entries_per_directory_page)),32)
+        self.buckets = dict() # head page -> Bucket, the buckets changed since the last flush
+        self.pages_read = 0
+        self.file = None
+        if not (os.path.isfile(self.path) and self.load()):
+            self.build()
+        db.add_listener(self)
+
+    def index_key(self,value):
+        if self.dtype == 'float':
+            # the key is compared with the value stored in the table, rounded to single precision
+            return struct.unpack('f',struct.pack('f',value))[0]
+        if self.dtype == 'text' and len(value.encode('utf-8')) > self.page_size // 8:
+            return value.encode('utf-8')[:self.page_size // 8].decode('utf-8','ignore')
+        return value
+
+    def entry_size(self,entry:tuple) -> int:
+        return len(PageRecord(entry).encode(self.schema)) + 8
+
+    def load(self) -> bool:
+        self.file = open(self.path,'r+b')
+        meta = os.pread(self.file.fileno(),self.page_size,0)
+        magic,col,global_depth,n_pages,size,last_page_hash,n_directory_pages = INDEX_META.unpack_from(meta)
+        if magic != INDEX_MAGIC or col != self.col or (size,last_page_hash) != table_signature(self.db):
+            self.file.close()
+            return False
+        self.global_depth = global_depth
+        self.n_pages = n_pages
+        self.directory_pages = list(struct.unpack_from(f"<{n_directory_pages}i",meta,INDEX_META.size))
+        directory = []
+        for page_no in self.directory_pages:
+            directory.extend(struct.unpack(f"<{self.entries_per_directory_page}i",os.pread(self.file.fileno(),self.page_size,page_no * self.page_size)))
+        self.directory = directory[:1 << global_depth]
+        return True
+
+    def build(self):
+        """
+        Create the index file and add the records already in the table.
+        """
+        self.file = open(self.path,'w+b')
+        self.global_depth = 0
+        self.n_pages = 1
+        self.directory_pages = []
+        head = self.allocate()
+        self.directory = [head]
+        self.buckets[head] = Bucket(0,[[head,[],PAGE_STATIC_HEADER_SIZE]])
+        self.db.write()
+        schema = self.db.header.schema
+        for page_no in range(self.db.page_count()):
+            page = DBPage()
+            page.decode(self.db.read_page(page_no),schema,{self.record_col})
+            for slot,record in enumerate(page.records):
+                value = record.record[self.record_col]
+                if self.dtype == 'text':
+                    value = self.db.resolve_overflow([(value,)])[0][0]
+                self.insert(value,page_no,slot)
+        self.flush()
+
+    def allocate(self) -> int:
+        page_no = self.n_pages
+        self.n_pages += 1
+        return page_no
+
+    def read_bucket(self,head:int) -> Bucket:
+        pages = []
+        page_no = head
+        local_depth = 0
+        while page_no != NO_PAGE:
+            page = DBPage(page_size=self.page_size)
+            page.decode(os.pread(self.file.fileno(),self.page_size,page_no * self.page_size),self.schema)
+            self.pages_read += 1
+            if page_no == head:
+                local_depth = page.header.min_id
+            used = page.header.start_offset + self.page_size - page.header.end_offset
+            pages.append([page_no,[record.record for record in page.records],used])
+            page_no = page.header.max_id
+        return Bucket(local_depth,pages)
+
+    def bucket(self,head:int) -> Bucket:
+        bucket = self.buckets.get(head)
+        if bucket is None:
+            bucket = self.buckets[head] = self.read_bucket(head)
+        return bucket
+
+    def insert(self,key,page_no:int,slot:int):
+        key = self.index_key(key)
+        entry = (key,page_no,slot)
+        size = self.entry_size(entry)
+        key_hash = hash64(key)
+        while True:
+            head = self.directory[key_hash & ((1 << self.global_depth) - 1)]
+            bucket = self.bucket(head)
+            last = bucket.pages[-1]
+            if last[2] + size <= self.page_size:
+                last[1].append(entry)
+                last[2] += size
+                return
+            if self.can_split(bucket,key_hash):
+                self.split(head,bucket)
+            else:
+                bucket.pages.append([self.allocate(),[entry],PAGE_STATIC_HEADER_SIZE + size])
+                return
+
+    def can_split(self,bucket:Bucket,key_hash:int) -> bool:
+        if bucket.local_depth == self.global_depth and self.global_depth >= self.max_global_depth:
+            return False
+        return any(hash64(entry[0]) != key_hash for entry in bucket.entries())
+
+    def split(self,head:int,bucket:Bucket):
+        if bucket.local_depth == self.global_depth:
+            self.directory = self.directory + self.directory
+            self.global_depth += 1
+        bit = 1 << bucket.local_depth
+        bucket.local_depth += 1
+        entries = bucket.entries()
+        sibling_head = self.allocate()
+        sibling = Bucket(bucket.local_depth,[[sibling_head,[],PAGE_STATIC_HEADER_SIZE]])
+        self.pack(bucket,[entry for entry in entries if not hash64(entry[0]) & bit])
+        self.pack(sibling,[entry for entry in entries if hash64(entry[0]) & bit])
+        self.buckets[sibling_head] = sibling
+        for i,page_no in enumerate(self.directory):
+            if page_no == head and i & bit:
+                self.directory[i] = sibling_head
+
+    def pack(self,bucket:Bucket,entries:list):
+        """
+        Lay out the entries over the pages of the bucket, the pages left empty at the end of the chain are
+        dropped from it (their space in the file is not reused).
+        """
+        page_numbers = [page_no for page_no,_,_ in bucket.pages]
+        pages = [[page_numbers[0],[],PAGE_STATIC_HEADER_SIZE]]
+        for entry in entries:
+            size = self.entry_size(entry)
+            if pages[-1][2] + size > self.page_size:
+                page_no = page_numbers[len(pages)] if len(pages) < len(page_numbers) else self.allocate()
+                pages.append([page_no,[],PAGE_STATIC_HEADER_SIZE])
+            pages[-1][1].append(entry)
+            pages[-1][2] += size
+        bucket.pages = pages
+
+    def lookup(self,key) -> list:
+        """
+        (page_no, slot) of the records whose column may be equal to the key.
+        """
+        key = self.index_key(key)
+        head = self.directory[hash64(key) & ((1 << self.global_depth) - 1)]
+        bucket = self.buckets.get(head)
+        if bucket is None:
+            bucket = self.read_bucket(head)
+        return [(page_no,slot) for entry_key,page_no,slot in bucket.entries() if entry_key == key]
+
+    def fetch(self,key,snapshot = None) -> list:
+        """
+        Records of the table whose column is equal to the key, reading only the table pages that hold them. On
+        mvcc tables only the records visible in the snapshot are returned.
+        """
+        return [record for record in fetch_records(self.db,self.lookup(key),snapshot) if record[self.col] == key]
+
+    def flush(self):
+        fd = self.file.fileno()
+        for bucket in self.buckets.values():
+            for i,(page_no,entries,_) in enumerate(bucket.pages):
+                page = DBPage(page_size=self.page_size)
+                for entry in entries:
+                    page.add_record(PageRecord(entry),self.schema)
+                # the page header ids hold the local depth and the next page of the chain
+                page.header.min_id = bucket.local_depth if i == 0 else 0
+                page.header.max_id = bucket.pages[i + 1][0] if i + 1 < len(bucket.pages) else NO_PAGE
+                os.pwrite(fd,bytes(page.encode(self.schema)),page_no * self.page_size)
+        self.buckets = dict()
+        n_directory_pages = -(-len(self.directory) // self.entries_per_directory_page)
+        while len(self.directory_pages) < n_directory_pages:
+            self.directory_pages.append(self.allocate())
+        for i,page_no in enumerate(self.directory_pages):
+            entries = self.directory[i * self.entries_per_directory_page:(i + 1) * self.entries_per_directory_page]
+            os.pwrite(fd,struct.pack(f"<{len(entries)}i",*entries).ljust(self.page_size,b'\x00'),page_no * self.page_size)
+        size,last_page_hash = table_signature(self.db)
+        meta = INDEX_META.pack(INDEX_MAGIC,self.col,self.global_depth,self.n_pages,size,last_page_hash,len(self.directory_pages))
+        meta += struct.pack(f"<{len(self.directory_pages)}i",*self.directory_pages)
+        os.pwrite(fd,meta.ljust(self.page_size,b'\x00'),0)
+
+    def record_added(self,record:tuple):
+        self.insert(record[self.col],self.db.last_page_no(),len(self.db.last_page().records) - 1)
+
+    def committed(self):
+        self.flush()
+
+    def rolled_back(self):
+        # the records of an aborted transaction stay in the table, invisible, so their entries are kept
+        self.flush()
+
+    def __del__(self):
+        if getattr(self,'file',None) is not None:
+            self.file.close()
+
+
+class Postings:
+    """
+    Increasing record ids of one token, each id is page_no << 16 | slot and is stored as the varint encoded
+    difference with the previous one, so the dense postings of a common token take about one byte per record.
+    """
+    def __init__(self,data:bytes = b'',count:int = 0,last:int = 0):
+        self.data = bytearray(data)
+        self.count = count
+        self.last = last
+
+    def add(self,record_id:int):
+        delta = record_id - self.last
+        self.last = record_id
+        self.count += 1
+        while delta >= 0x80:
+            self.data.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        self.data.append(delta)
+
+    def ids(self) -> list:
+        ids = []
+        current = 0
+        value = 0
+        shift = 0
+        for byte in self.data:
+            value |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            current += value
+            ids.append(current)
+            value = 0
+            shift = 0
+        return ids
+
+
+def intersect(lists:list) -> list:
+    """
+    Ids present in all the sorted lists, the shortest list drives the intersection.
+    """
+    if len(lists) == 0:
+        return []
+    lists = sorted(lists,key=len)
+    result = lists[0]
+    for other in lists[1:]:
+        matches = []
+        i = 0
+        n = len(other)
+        for record_id in result:
+            while i < n and other[i] < record_id:
+                i += 1
+            if i == n:
+                break
+            if other[i] == record_id:
+                matches.append(record_id)
+        result = matches
+    return result
+
+
+class InvertedIndex:
+    """
+    Inverted index over a column holding delimited tokens, like the genres of the movies "Adventure|Animation".
+    Every token keeps the compressed postings of the records containing it, queries combine the postings of
+    several tokens and only read the table pages of the matching records, and the number of records per token
+    is the length of its postings. On mvcc tables the counts include the records that are not visible.
+
+    The index is kept in memory and the whole file is written on commit.
+    """
+    magic = b'INVX'
+    header_format = struct.Struct("<4siqQi") # magic, column, table size and last page hash, tokens
+    token_format = struct.Struct("<Hiqi") # token bytes, records, last record id, postings bytes
+
+    def __init__(self,db:DataBase,col:int,delimiter:str = '|',path:str = None):
+        self.db = db
+        self.col = col
+        self.delimiter = delimiter
+        self.path = path if path is not None else f"{db.db_path}.inv{col}"
+        self.record_col = db.hidden_columns + col
+        self.postings = dict()
+        if not (os.path.isfile(self.path) and self.load()):
+            self.build()
+        db.add_listener(self)
+
+    def tokens(self,value) -> list:
+        if value is None:
+            return []
+        return list(dict.fromkeys(token.strip() for token in value.split(self.delimiter) if token.strip() != ''))
+
+    def add(self,value,page_no:int,slot:int):
+        record_id = (page_no << 16) | slot
+        for token in self.tokens(value):
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = Postings()
+            postings.add(record_id)
+
+    def load(self) -> bool:
+        with open(self.path,'rb') as f:
+            content = f.read()
+        magic,col,size,last_page_hash,n_tokens = self.header_format.unpack_from(content)
+        if magic != self.magic or col != self.col or (size,last_page_hash) != table_signature(self.db):
+            return False
+        offset = self.header_format.size
+        for _ in range(n_tokens):
+            token_size,count,last,data_size = self.token_format.unpack_from(content,offset)
+            offset += self.token_format.size
+            token = content[offset:offset+token_size].decode('utf-8')
+            offset += token_size
+            self.postings[token] = Postings(content[offset:offset+data_size],count,last)
+            offset += data_size
+        return True
+
+    def build(self):
+        self.db.write()
+        schema = self.db.header.schema
+        for page_no in range(self.db.page_count()):
+            page = DBPage()
+            page.decode(self.db.read_page(page_no),schema,{self.record_col})
+            values = self.db.resolve_overflow([(record.record[self.record_col],) for record in page.records])
+            for slot,(value,) in enumerate(values):
+                self.add(value,page_no,slot)
+        self.flush()
+
+    def flush(self):
+        content = bytearray(self.header_format.pack(self.magic,self.col,*table_signature(self.db),len(self.postings)))
+        for token,postings in self.postings.items():
+            encoded = token.encode('utf-8')
+            content.extend(self.token_format.pack(len(encoded),postings.count,postings.last,len(postings.data)))
+            content.extend(encoded)
+            content.extend(postings.data)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path,'wb') as f:
+            f.write(content)
+        os.replace(tmp_path,self.path)
+
+    def record_ids(self,token:str) -> list:
+        postings = self.postings.get(token)
+        return postings.ids() if postings is not None else []
+
+    def match_all(self,tokens:list) -> list:
+        """
+        Ids of the records containing every token.
+        """
+        return intersect([self.record_ids(token) for token in tokens])
+
+    def match_any(self,tokens:list) -> list:
+        """
+        Ids of the records containing at least one of the tokens.
+        """
+        return list(heapq.merge(*[self.record_ids(token) for token in tokens])) if len(tokens) > 1 else \
+            [record_id for token in tokens for record_id in self.record_ids(token)]
+
+    def fetch(self,record_ids:list,snapshot = None) -> list:
+        unique = sorted(set(record_ids))
+        return fetch_records(self.db,[(record_id >> 16,record_id & 0xffff) for record_id in unique],snapshot)
+
+    def counts(self) -> dict:
+        return {token: postings.count for token,postings in self.postings.items()}
+
+    def record_added(self,record:tuple):
+        self.add(record[self.col],self.db.last_page_no(),len(self.db.last_page().records) - 1)
+
+    def committed(self):
+        self.flush()
+
+    def rolled_back(self):
+        self.flush()
+
+
+class TestHashIndex:
+    schema = ('int','str','float')
+
+    def create(self,path,records) -> DataBase:
+        db = DataBase(str(path),'mydb','movies',self.schema)
+        for record in records:
+            db.add_record(record)
+        db.commit()
+        return db
+
+    def test_splits_and_lookups(self,tmp_path):
+        records = [(i,f"Movie {i}",float(i % 10) / 2) for i in range(5000)]
+        db = self.create(tmp_path / 'movies.db',records[:1000])
+        index = HashIndex(db,1)
+        for record in records[1000:]:
+            db.add_record(record)
+        db.commit()
+        assert index.global_depth > 3
+        assert len(set(index.directory)) > 8
+        for i in (0,999,1000,4999):
+            index.pages_read = 0
+            assert index.fetch(f"Movie {i}") == [records[i]]
+            assert index.pages_read == 1
+        assert index.fetch("Movie 5000") == []
+
+        reopened = HashIndex(db,1)
+        assert reopened.directory == index.directory
+        assert reopened.fetch("Movie 4242") == [records[4242]]
+
+    def test_repeated_keys_and_stale_index(self,tmp_path):
+        records = [(i,'Drama' if i % 3 else 'Comedy',float(i % 10) / 2) for i in range(3000)]
+        db = self.create(tmp_path / 'movies.db',records)
+        index = HashIndex(db,1)
+        assert len(index.fetch('Comedy')) == 1000 and len(index.fetch('Drama')) == 2000
+        assert len(HashIndex(db,2).fetch(1.5)) == 300
+        other = DataBase(db.db_path,'mydb','movies',self.schema)
+        other.add_record((3000,'Comedy',1.0))
+        other.commit()
+        assert len(HashIndex(other,1).fetch('Comedy')) == 1001
+
+
+class TestInvertedIndex:
+    schema = ('int','str','str')
+    movies = [(i,f"Movie {i}",'|'.join(g for j,g in enumerate(('Adventure','Animation','Children','Comedy','Drama','Horror','Romance'))
+                                         if (i >> j) & 1) or '(no genres listed)') for i in range(2000)]
+
+    def test_postings_and_queries(self,tmp_path):
+        db = DataBase(str(tmp_path / 'movies.db'),'mydb','movies',self.schema)
+        for record in self.movies[:500]:
+            db.add_record(record)
+        db.commit()
+        index = InvertedIndex(db,2)
+        for record in self.movies[500:]:
+            db.add_record(record)
+        db.commit()
+        assert index.counts()['Comedy'] == sum(1 for m in self.movies if 'Comedy' in m[2].split('|'))
+        assert index.counts()['(no genres listed)'] == 16
+        assert len(index.postings['Drama'].data) < index.counts()['Drama'] * 2
+        both = index.fetch(index.match_all(['Comedy','Drama']))
+        assert both == [m for m in self.movies if {'Comedy','Drama'} <= set(m[2].split('|'))]
+        either = index.fetch(index.match_any(['Horror','Romance']))
+        assert either == [m for m in self.movies if {'Horror','Romance'} & set(m[2].split('|'))]
+        assert index.match_all(['Comedy','Western']) == []
+
+        reopened = InvertedIndex(db,2)
+        assert reopened.counts() == index.counts()
+        assert reopened.match_all(['Animation','Children']) == index.match_all(['Animation','Children'])
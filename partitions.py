@@ -0,0 +1,262 @@
+"""
+Partitioned tables: one logical table stored in several table files, the partition of a record is chosen by
+the hash of a column or by the range its value falls in. The partitioning and the min/max of the numeric
+columns of every partition are kept in a small JSON catalog file, so a scan with a predicate only opens the
+partitions that can hold matching rows, e.g. a time range over ratings partitioned by timestamp:
+
+    ratings = PartitionedTable('ratings.parts','mydb','ratings',('int','int','float','int'),col=3,
+                               method='range',bounds=[1000000000,1200000000,1400000000])
+    run(Q(Insert(ratings,records)))
+    run(Q(ratings.scan(Col(3) >= 1300000000)))
+
+Range partition i holds the values in [bounds[i-1], bounds[i]), the first and last partitions are open ended.
+Hash partitions use a stable hash (see sketches.hash64) so the partition of a value is the same in every process.
+The statistics of a partition are only updated by the inserts done through PartitionedTable, the partition
+files should not be written directly.
+"""
+import bisect
+import json
+import os
+
+from data_layout import DataBase, FIXED_WIDTH, PAGE_SIZE
+from executor import Q, run, Exchange, FileScan, Insert
+from expressions import Expr, And, Col, Comparison, Const, Param, constant_value
+from sketches import hash64
+
+PYTHON_TYPES = {'int': int, 'float': float, 'double': float, 'str': str, 'text': str}
+
+
+def equality_value(expr:Expr,col:int,params:tuple):
+    """
+    Value the column is compared to with == in the predicate or in one of the conditions of its top level and,
+    None when there is no such comparison.
+    """
+    if isinstance(expr,And):
+        for item in expr.items:
+            value = equality_value(item,col,params)
+            if value is not None:
+                return value
+    elif isinstance(expr,Comparison) and expr.op == '==':
+        for left,right in ((expr.left,expr.right),(expr.right,expr.left)):
+            if isinstance(left,Col) and left.index == col and isinstance(right,(Const,Param)):
+                return constant_value(right,params)
+    return None
+
+
+class PartitionedTable:
+    """
+    Partitioned tables are not transactional: the partition files are written without mvcc and add_record
+    rejects a transaction with a ValueError, the records are durable when commit is called.
+    """
+    methods = ('hash','range')
+
+    def __init__(self,path:str,db_name:str,table_name:str,schema:tuple,col:int = None,method:str = 'hash',partitions:int = None,bounds:list = None,page_size:int = PAGE_SIZE):
+        self.path = path
+        self.db_name = db_name
+        self.table_name = table_name
+        self.schema = tuple(schema)
+        self.mvcc = False
+        self.dbs = dict()
+        self.dirty = set()
+        if os.path.isfile(path):
+            self.load()
+            return
+        if method not in self.methods:
+            raise ValueError(f"unknown partitioning method {method}, expected one of {self.methods}")
+        if col is None or not 0 <= col < len(self.schema):
+            raise ValueError("the partitioning column must be one of the table columns")
+        if method == 'range':
+            if bounds is None or len(bounds) == 0 or list(bounds) != sorted(set(bounds)):
+                raise ValueError("range partitioning needs a list of increasing bounds")
+            n_partitions = len(bounds) + 1
+        else:
+            if partitions is None or partitions < 1:
+                raise ValueError("hash partitioning needs the number of partitions")
+            if self.schema[col] not in ('int','str','text'):
+                raise ValueError(f"can not hash partition on a {self.schema[col]} column")
+            n_partitions = partitions
+        self.col = col
+        self.method = method
+        self.bounds = list(bounds) if method == 'range' else None
+        self.n_partitions = n_partitions
+        self.page_size = page_size
+        self.counts = [0] * n_partitions
+        self.zones = [dict() for _ in range(n_partitions)]
+        self.save()
+
+    def load(self):
+        with open(self.path) as f:
+            catalog = json.load(f)
+        if tuple(catalog['schema']) != self.schema:
+            raise ValueError(f"the partitioned table {self.path} has the schema {tuple(catalog['schema'])}")
+        self.col = catalog['col']
+        self.method = catalog['method']
+        self.bounds = catalog['bounds']
+        self.n_partitions = catalog['partitions']
+        self.page_size = catalog['page_size']
+        self.counts = catalog['counts']
+        self.zones = [{int(col): tuple(bounds) for col,bounds in zone.items()} for zone in catalog['zones']]
+
+    def save(self):
+        catalog = {'schema': list(self.schema),'col': self.col,'method': self.method,'bounds': self.bounds,
+                   'partitions': self.n_partitions,'page_size': self.page_size,'counts': self.counts,
+                   'zones': [{str(col): list(bounds) for col,bounds in zone.items()} for zone in self.zones]}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path,'w') as f:
+            json.dump(catalog,f)
+        os.replace(tmp_path,self.path)
+
+    def partition_path(self,partition:int) -> str:
+        return f"{os.path.splitext(self.path)[0]}_p{partition}.db"
+
+    def partition_of(self,value) -> int:
+        if self.method == 'range':
+            return bisect.bisect_right(self.bounds,value)
+        return hash64(value) % self.n_partitions
+
+    def partition(self,partition:int) -> DataBase:
+        db = self.dbs.get(partition)
+        if db is None:
+            db = DataBase(self.partition_path(partition),self.db_name,self.table_name,self.schema,page_size=self.page_size)
+            self.dbs[partition] = db
+        return db
+
+    def add_record(self,record:tuple,transaction = None):
+        if transaction is not None:
+            raise ValueError("partitioned tables are not transactional, insert the records without a transaction")
+        partition = self.partition_of(record[self.col])
+        self.partition(partition).add_record(record)
+        self.counts[partition] += 1
+        zone = self.zones[partition]
+        for i,dtype in enumerate(self.schema):
+            if dtype in FIXED_WIDTH and record[i] is not None:
+                low,high = zone.get(i,(record[i],record[i]))
+                zone[i] = (min(low,record[i]),max(high,record[i]))
+        self.dirty.add(partition)
+
+    def commit(self):
+        # the catalog is saved first, after a crash its statistics may cover more rows than the partitions hold
+        # but never less, so the pruning stays correct
+        self.save()
+        for partition in sorted(self.dirty):
+            self.dbs[partition].commit()
+        self.dirty = set()
+
+    def prune(self,predicate = None,params:tuple = ()) -> list:
+        """
+        Partitions that can hold rows matching the predicate, in partition order. Empty partitions are skipped,
+        an equality on the column of a hash partitioned table selects one partition and the other conditions
+        are checked against the min/max of each partition.
+        """
+        partitions = [i for i in range(self.n_partitions) if self.counts[i] > 0]
+        if not isinstance(predicate,Expr):
+            return partitions
+        if self.method == 'hash':
+            value = equality_value(predicate,self.col,params)
+            if value is not None and type(value) is PYTHON_TYPES[self.schema[self.col]]:
+                partitions = [i for i in partitions if i == self.partition_of(value)]
+        return [i for i in partitions if predicate.may_match(self.zones[i],params)]
+
+    def scan(self,predicate = None,columns:list = None,params:tuple = (),parallel = False,processes = False) -> "PartitionedScan":
+        return PartitionedScan(self,predicate,columns,params,parallel,processes)
+
+
+class PartitionedScan(object):
+    """
+    Scan the partitions that can hold rows matching the predicate, the predicate and the columns are pushed
+    into a FileScan per partition. The partitions are read one after the other, or with parallel=True by the
+    workers of a gather Exchange (threads, or processes with processes=True).
+    """
+    def __init__(self,table:PartitionedTable,predicate = None,columns:list = None,params:tuple = (),parallel = False,processes = False):
+        self.table = table
+        self.columns = columns
+        self.partitions = table.prune(predicate,params)
+        self.scans = [FileScan(table.partition_path(i),table.db_name,table.table_name,table.schema,predicate=predicate,columns=columns,params=params)
+                      for i in self.partitions]
+        self.exchange = Exchange(inputs=self.scans,processes=processes) if parallel and len(self.scans) > 1 else None
+        self.current = 0
+
+    def next(self):
+        if self.exchange is not None:
+            return self.exchange.next()
+        if self.has_next():
+            return self.scans[self.current].next()
+        return None
+
+    def has_next(self):
+        if self.exchange is not None:
+            return self.exchange.has_next()
+        while self.current < len(self.scans):
+            if self.scans[self.current].has_next():
+                return True
+            self.current += 1
+        return False
+
+    def reset(self):
+        if self.exchange is not None:
+            self.exchange.reset()
+        else:
+            for scan in self.scans:
+                scan.reset()
+        self.current = 0
+
+    def ordering(self):
+        # range partitions are read in the order of their bounds, if every partition is clustered on the
+        # partitioning column the whole scan is ordered on it
+        col = self.table.col
+        if self.exchange is not None or self.table.method != 'range' or len(self.scans) == 0:
+            return None
+        output_col = col if self.columns is None else (self.columns.index(col) if col in self.columns else None)
+        if output_col is None or any(scan.ordering() != output_col for scan in self.scans):
+            return None
+        return output_col
+
+    def add_runtime_filter(self,key,runtime_filter):
+        for scan in self.scans:
+            scan.add_runtime_filter(key,runtime_filter)
+
+    def explain_metrics(self) -> dict:
+        return {'table': self.table.table_name,'partitions_scanned': len(self.scans),
+                'partitions_skipped': self.table.n_partitions - len(self.scans),
+                'pages_read': sum(scan.pages_read for scan in self.scans),
+                'pages_skipped': sum(scan.pages_skipped for scan in self.scans)}
+
+
+class TestPartitionedTable:
+    schema = ('int','int','float','int')
+    ratings = [(i % 300,(i * 7919) % 2000,float(i % 10) / 2,1000000000 + i * 50000) for i in range(10000)]
+
+    def insert(self,table,records):
+        for _ in run(Q(Insert(table,list(records)))):
+            pass
+
+    def test_range_partitions_by_timestamp(self,tmp_path):
+        bounds = [1000000000 + i * 100000000 for i in range(1,5)]
+        table = PartitionedTable(str(tmp_path / 'ratings.parts'),'mydb','ratings',self.schema,col=3,method='range',bounds=bounds)
+        self.insert(table,self.ratings)
+        assert table.counts == [2000,2000,2000,2000,2000]
+        predicate = (Col(3) >= 1150000000) & (Col(3) < 1250000000)
+        scan = table.scan(predicate)
+        result = tuple(run(Q(scan)))
+        assert scan.partitions == [1,2]
+        assert scan.explain_metrics()['partitions_skipped'] == 3
+        assert result == tuple(x for x in self.ratings if 1150000000 <= x[3] < 1250000000)
+
+        reopened = PartitionedTable(str(tmp_path / 'ratings.parts'),'mydb','ratings',self.schema)
+        assert reopened.prune(Col(3) < Param(0),(1050000000,)) == [0]
+        assert reopened.prune(Col(0) > 1000) == []
+
+    def test_hash_partitions_equality_and_parallel_scan(self,tmp_path):
+        table = PartitionedTable(str(tmp_path / 'ratings.parts'),'mydb','ratings',self.schema,col=0,partitions=4)
+        self.insert(table,self.ratings)
+        assert sum(table.counts) == len(self.ratings) and min(table.counts) > 0
+        scan = table.scan((Col(0) == 42) & (Col(2) >= 2.0),columns=[1,2])
+        assert len(scan.partitions) == 1
+        assert sorted(run(Q(scan))) == sorted((x[1],x[2]) for x in self.ratings if x[0] == 42 and x[2] >= 2.0)
+        parallel = tuple(run(Q(table.scan(Col(2) > 4.0,parallel=True))))
+        assert sorted(parallel) == sorted(x for x in self.ratings if x[2] > 4.0)
+        try:
+            table.add_record(self.ratings[0],transaction=object())
+            assert False
+        except ValueError:
+            assert sum(table.counts) == len(self.ratings)
@@ -0,0 +1,213 @@
+"""
+Mergeable sketches used by the approximate aggregate functions. Each sketch keeps a bounded amount of memory
+no matter how many values are added, and two sketches of the same kind can be merged, so partial aggregates
+computed over partitions or by parallel workers are combined into the same result as a single pass.
+
+    HyperLogLog: approximate count of distinct values, standard error of about 1.04/sqrt(2**precision).
+    TDigest: approximate quantiles, more accurate close to the tails, its size is bounded by the compression.
+
+Values are hashed with blake2b instead of the builtin hash, which is randomized per process for strings, so
+sketches built in different processes can be merged.
+"""
+import hashlib
+import math
+import struct
+
+
+def hash64(value) -> int:
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'),digest_size=8).digest(),'little')
+
+
+class HyperLogLog:
+    """
+    Count distinct estimator with 2**precision one byte registers. When the precision is not given it is
+    derived from the target relative error.
+    """
+    def __init__(self,error:float = 0.02,precision:int = None):
+        if precision is None:
+            precision = math.ceil(math.log2((1.04 / error) ** 2))
+        self.precision = min(max(precision,4),16)
+        self.m = 1 << self.precision
+        self.registers = bytearray(self.m)
+
+    def add(self,value):
+        x = hash64(value)
+        index = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self,other:"HyperLogLog") -> "HyperLogLog":
+        if other.precision != self.precision:
+            raise ValueError(f"can not merge sketches with precision {self.precision} and {other.precision}")
+        self.registers = bytearray(max(a,b) for a,b in zip(self.registers,other.registers))
+        return self
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # small range correction, linear counting over the empty registers
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def size_bytes(self) -> int:
+        return self.m
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls,data:bytes) -> "HyperLogLog":
+        sketch = cls(precision=data[0])
+        sketch.registers = bytearray(data[1:])
+        return sketch
+
+
+class TDigest:
+    """
+    Merging t-digest. Values are buffered and merged into centroids whose size is limited by the k1 scale
+    function, so there are at most about `compression` centroids and the centroids near the tails are small.
+    """
+    centroid_format = struct.Struct("<dd")
+
+    def __init__(self,compression:int = 100):
+        self.compression = compression
+        self.centroids = []
+        self.buffer = []
+        self.buffer_size = 5 * compression
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self,value,weight:float = 1.0):
+        self.buffer.append((value,weight))
+        self.total += weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def merge(self,other:"TDigest") -> "TDigest":
+        other.compress()
+        self.buffer.extend(other.centroids)
+        self.total += other.total
+        self.min = min(self.min,other.min)
+        self.max = max(self.max,other.max)
+        self.compress()
+        return self
+
+    def k_scale(self,q:float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def k_inverse(self,k:float) -> float:
+        return (math.sin(min(k * 2 * math.pi / self.compression,math.pi / 2)) + 1) / 2
+
+    def compress(self):
+        if len(self.buffer) == 0:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+        merged = []
+        mean,weight = points[0]
+        weight_so_far = 0.0
+        limit = self.total * self.k_inverse(self.k_scale(0.0) + 1)
+        for point_mean,point_weight in points[1:]:
+            if weight_so_far + weight + point_weight <= limit:
+                mean += (point_mean - mean) * point_weight / (weight + point_weight)
+                weight += point_weight
+            else:
+                merged.append((mean,weight))
+                weight_so_far += weight
+                limit = self.total * self.k_inverse(self.k_scale(weight_so_far / self.total) + 1)
+                mean,weight = point_mean,point_weight
+        merged.append((mean,weight))
+        self.centroids = merged
+
+    def quantile(self,q:float):
+        """
+        Estimate the value at the given quantile (0 to 1), interpolating between the centroid centers.
+        """
+        self.compress()
+        if len(self.centroids) == 0:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.total
+        first_mean,first_weight = self.centroids[0]
+        if target <= first_weight / 2:
+            return self.min + (first_mean - self.min) * target / (first_weight / 2)
+        cumulative = 0.0
+        for (left_mean,left_weight),(right_mean,right_weight) in zip(self.centroids,self.centroids[1:]):
+            left_center = cumulative + left_weight / 2
+            right_center = cumulative + left_weight + right_weight / 2
+            if target <= right_center:
+                return left_mean + (right_mean - left_mean) * (target - left_center) / (right_center - left_center)
+            cumulative += left_weight
+        last_mean,last_weight = self.centroids[-1]
+        remaining = self.total - target
+        return self.max - (self.max - last_mean) * remaining / (last_weight / 2)
+
+    def size_bytes(self) -> int:
+        return (len(self.centroids) + len(self.buffer)) * self.centroid_format.size
+
+    def to_bytes(self) -> bytes:
+        self.compress()
+        header = struct.pack("<iddd",self.compression,self.total,self.min,self.max)
+        return header + b''.join(self.centroid_format.pack(mean,weight) for mean,weight in self.centroids)
+
+    @classmethod
+    def from_bytes(cls,data:bytes) -> "TDigest":
+        compression,total,low,high = struct.unpack_from("<iddd",data)
+        sketch = cls(compression)
+        sketch.total,sketch.min,sketch.max = total,low,high
+        sketch.centroids = list(cls.centroid_format.iter_unpack(data[struct.calcsize("<iddd"):]))
+        return sketch
+
+
+class TestHyperLogLog:
+
+    def test_count_distinct_error(self):
+        sketch = HyperLogLog(error=0.02)
+        for i in range(50000):
+            sketch.add(i % 20000)
+        assert abs(sketch.count() - 20000) / 20000 < 0.06
+        assert sketch.size_bytes() == 4096
+
+    def test_small_counts_and_merge(self):
+        left,right = HyperLogLog(),HyperLogLog()
+        for i in range(100):
+            left.add(f"user {i}")
+        for i in range(50,150):
+            right.add(f"user {i}")
+        assert left.count() == 100
+        merged = HyperLogLog.from_bytes(left.to_bytes()).merge(right)
+        assert merged.count() == 150
+
+
+class TestTDigest:
+    values = [(i * 7919) % 10007 / 100 for i in range(20000)]
+
+    def test_quantiles(self):
+        sketch = TDigest(100)
+        for value in self.values:
+            sketch.add(value)
+        ordered = sorted(self.values)
+        for q in (0.01,0.25,0.5,0.9,0.99):
+            assert abs(sketch.quantile(q) - ordered[int(q * len(ordered))]) < 1.0
+        assert len(sketch.centroids) <= 100
+        assert sketch.quantile(0) == min(self.values) and sketch.quantile(1) == max(self.values)
+
+    def test_merge_partitions(self):
+        partitions = [TDigest(100) for _ in range(4)]
+        for i,value in enumerate(self.values):
+            partitions[i % 4].add(value)
+        merged = TDigest.from_bytes(partitions[0].to_bytes())
+        for sketch in partitions[1:]:
+            merged.merge(sketch)
+        assert merged.total == len(self.values)
+        assert abs(merged.quantile(0.5) - sorted(self.values)[len(self.values) // 2]) < 1.0
@@ -0,0 +1,921 @@
+"""
+SQL front end for the executor. It parses a subset of SQL and plans it into the same executor trees that are
+built by hand with Q(...):
+
+    SELECT cols | aggregate FROM table [TABLESAMPLE SYSTEM|BERNOULLI (percent) [REPEATABLE (seed)]]
+        [JOIN table ON col = col] [WHERE expr [AND expr [NOT] IN (SELECT col ...)]]
+        [GROUP BY col] [ORDER BY col|position [ASC|DESC]] [LIMIT n [OFFSET m]]
+    INSERT INTO table VALUES (v, ...), (v, ...)
+    INSERT INTO table SELECT ...
+    CREATE TABLE table AS SELECT ...
+    CLUSTER table ON col
+
+The IN and NOT IN subqueries of the WHERE are planned as a SemiJoin and a null aware AntiJoin with the rows of
+the subquery, they must be conditions of the top level AND. Selected columns can be named with AS.
+INSERT ... SELECT and CREATE TABLE AS stream the selected rows into the pages of the table, CREATE TABLE AS
+creates the table file in the directory of the catalog with the names of the selected columns and the types
+inferred from the plan.
+
+Values can be replaced by ? placeholders. Statements are normalized (whitespace and keyword case) and the
+parsed and planned statement is kept in an LRU cache, so executing the same query text again only binds the
+parameters and builds the operator tree from the cached plan.
+"""
+import os
+import re
+from collections import OrderedDict
+
+from data_layout import DataBase
+from executor import Q, run, cluster_table, ordering, AntiJoin, SemiJoin, Aggregation, StreamAggregation, FileScan, SampleScan, HashJoin, Insert, Limit, MemoryScan, Projection, Selection, Sort
+from expressions import Expr, Col, Const, Param, Comparison, Arithmetic, And, Or, Not, compile_projection, constant_value
+
+KEYWORDS = {'SELECT','FROM','WHERE','GROUP','BY','ORDER','ASC','DESC','LIMIT','OFFSET','JOIN','INNER','ON',
+            'AND','OR','NOT','INSERT','INTO','VALUES','AS','NULL','TRUE','FALSE','CLUSTER','TABLESAMPLE','REPEATABLE',
+            'CREATE','TABLE','IN'}
+AGGREGATES = {'COUNT','SUM','AVG','MIN','MAX','APPROX_COUNT_DISTINCT','APPROX_PERCENTILE'}
+COMPARISON_OPS = {'=':'==','==':'==','!=':'!=','<>':'!=','<':'<','<=':'<=','>':'>','>=':'>='}
+
+TOKEN_RE = re.compile(r"\s*(?:(\d+\.\d*|\d+)|('(?:[^']|'')*')|([A-Za-z_][A-Za-z_0-9]*(?:\.[A-Za-z_][A-Za-z_0-9]*)?)"
+                      r"|(<=|>=|!=|<>|==|[=<>*+\-/(),?;]))")
+
+
+class SQLError(Exception):
+    pass
+
+
+class Table:
+    def __init__(self,name:str,columns:list,path:str = None,db_name:str = 'mydb',rows:list = None,partitioned = None):
+        self.name = name
+        self.column_names = [column for column,_ in columns]
+        self.schema = tuple(dtype for _,dtype in columns)
+        self.path = path
+        self.db_name = db_name
+        self.rows = rows
+        self.partitioned = partitioned
+
+    def scan(self,predicate:Expr = None,params:tuple = (),sample:tuple = None):
+        if self.rows is not None:
+            return MemoryScan(self.rows)
+        if self.partitioned is not None:
+            if sample is not None:
+                raise SQLError(f"TABLESAMPLE is not supported on the partitioned table {self.name}")
+            return self.partitioned.scan(predicate,params=params)
+        if sample is not None:
+            method,percent,seed = sample
+            if method == 'system':
+                return SampleScan(self.path,self.db_name,self.name,self.schema,percent / 100,seed=seed)
+            return SampleScan(self.path,self.db_name,self.name,self.schema,1.0,row_fraction=percent / 100,seed=seed)
+        return FileScan(self.path,self.db_name,self.name,self.schema,predicate=predicate,params=params)
+
+
+class Catalog:
+    """
+    Tables known by the SQL front end with the names and types of their columns. The tables created with
+    CREATE TABLE AS are stored in the given directory.
+    """
+    def __init__(self,directory:str = None):
+        self.tables = dict()
+        self.directory = directory
+
+    def register_table(self,name:str,path:str,columns:list,db_name:str = 'mydb'):
+        self.tables[name.lower()] = Table(name,columns,path=path,db_name=db_name)
+
+    def register_partitioned_table(self,name:str,table,columns:list):
+        """
+        Register a PartitionedTable (see partitions.py), the scans only read the partitions that can match the WHERE.
+        """
+        self.tables[name.lower()] = Table(name,columns,db_name=table.db_name,partitioned=table)
+
+    def register_memory_table(self,name:str,rows:list,columns:list):
+        self.tables[name.lower()] = Table(name,columns,rows=rows)
+
+    def get(self,name:str) -> Table:
+        table = self.tables.get(name.lower())
+        if table is None:
+            raise SQLError(f"table {name} does not exists")
+        return table
+
+
+def tokenize(sql:str) -> list:
+    tokens = []
+    position = 0
+    sql = sql.strip()
+    while position < len(sql):
+        match = TOKEN_RE.match(sql,position)
+        if match is None or match.end() == position:
+            raise SQLError(f"unexpected character at position {position}: {sql[position:position+10]!r}")
+        number,string,name,symbol = match.groups()
+        if number is not None:
+            tokens.append(('number',number))
+        elif string is not None:
+            tokens.append(('string',string))
+        elif name is not None:
+            tokens.append(('keyword',name.upper()) if name.upper() in KEYWORDS else ('name',name))
+        elif symbol != ';':
+            tokens.append(('symbol',symbol))
+        position = match.end()
+    return tokens
+
+
+def normalize(sql:str) -> str:
+    """
+    Text used as cache key, statements that only differ in whitespace or keyword case share the same plan.
+    """
+    return ' '.join(value for _,value in tokenize(sql))
+
+
+class Parser:
+    def __init__(self,tokens:list):
+        self.tokens = tokens
+        self.position = 0
+        self.n_params = 0
+
+    def peek(self,offset = 0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None,None)
+
+    def accept(self,value) -> bool:
+        if self.peek()[1] == value and self.peek()[0] in ('keyword','symbol'):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self,value):
+        if not self.accept(value):
+            raise SQLError(f"expected {value} but found {self.peek()[1]}")
+
+    def name(self) -> str:
+        kind,value = self.peek()
+        if kind != 'name':
+            raise SQLError(f"expected a name but found {value}")
+        self.position += 1
+        return value
+
+    def integer(self):
+        kind,value = self.peek()
+        self.position += 1
+        if kind == 'number' and value.isdigit():
+            return Const(int(value))
+        if (kind,value) == ('symbol','?'):
+            return self.param()
+        raise SQLError(f"expected an integer but found {value}")
+
+    def param(self) -> Param:
+        param = Param(self.n_params)
+        self.n_params += 1
+        return param
+
+    def statement(self) -> dict:
+        if self.accept('SELECT'):
+            statement = self.select()
+        elif self.accept('INSERT'):
+            statement = self.insert()
+        elif self.accept('CREATE'):
+            self.expect('TABLE')
+            statement = {'type': 'create_table_as','table': self.name()}
+            self.expect('AS')
+            self.expect('SELECT')
+            statement['select'] = self.select()
+        elif self.accept('CLUSTER'):
+            statement = {'type': 'cluster','table': self.name()}
+            self.expect('ON')
+            statement['column'] = self.name()
+        else:
+            raise SQLError(f"unsupported statement starting with {self.peek()[1]}")
+        if self.position < len(self.tokens):
+            raise SQLError(f"unexpected {self.peek()[1]} at the end of the statement")
+        statement['n_params'] = self.n_params
+        return statement
+
+    def select(self) -> dict:
+        statement = {'type': 'select','items': [],'names': [],'join': None,'where': None,'group_by': None,
+                     'order_by': None,'desc': False,'limit': None,'offset': None}
+        if self.accept('*'):
+            statement['items'] = None
+        else:
+            while True:
+                statement['items'].append(self.select_item())
+                statement['names'].append(self.name() if self.accept('AS') else None)
+                if not self.accept(','):
+                    break
+        self.expect('FROM')
+        statement['table'] = self.name()
+        statement['sample'] = self.sample() if self.accept('TABLESAMPLE') else None
+        if self.accept('INNER') or self.peek()[1] == 'JOIN':
+            self.expect('JOIN')
+            join_table = self.name()
+            self.expect('ON')
+            left = self.name()
+            if not (self.accept('=') or self.accept('==')):
+                raise SQLError("only equi joins are supported")
+            statement['join'] = (join_table,left,self.name())
+        if self.accept('WHERE'):
+            statement['where'] = self.or_expr()
+        if self.accept('GROUP'):
+            self.expect('BY')
+            statement['group_by'] = self.name()
+        if self.accept('ORDER'):
+            self.expect('BY')
+            statement['order_by'] = self.select_item()
+            if self.accept('DESC'):
+                statement['desc'] = True
+            else:
+                self.accept('ASC')
+        if self.accept('LIMIT'):
+            statement['limit'] = self.integer()
+            if self.accept('OFFSET'):
+                statement['offset'] = self.integer()
+        return statement
+
+    def sample(self) -> tuple:
+        method = self.name().lower()
+        if method not in ('system','bernoulli'):
+            raise SQLError(f"unknown sampling method {method}")
+        self.expect('(')
+        kind,percent = self.peek()
+        self.position += 1
+        if kind != 'number' or not 0 <= float(percent) <= 100:
+            raise SQLError(f"expected a sample percentage but found {percent}")
+        self.expect(')')
+        seed = None
+        if self.accept('REPEATABLE'):
+            self.expect('(')
+            kind,seed = self.peek()
+            self.position += 1
+            if kind != 'number' or not seed.isdigit():
+                raise SQLError(f"expected an integer seed but found {seed}")
+            seed = int(seed)
+            self.expect(')')
+        return (method,float(percent),seed)
+
+    def select_item(self):
+        kind,value = self.peek()
+        if kind == 'name' and value.upper() in AGGREGATES and self.peek(1)[1] == '(':
+            self.position += 2
+            argument = '*' if self.accept('*') else self.name()
+            options = {}
+            if value.upper() == 'APPROX_PERCENTILE':
+                self.expect(',')
+                kind,percentile = self.peek()
+                self.position += 1
+                if kind != 'number':
+                    raise SQLError(f"expected a percentile but found {percentile}")
+                options['percentile'] = float(percentile)
+            self.expect(')')
+            return ('aggregate',value.lower(),argument,options)
+        if kind == 'number' and value.isdigit():
+            self.position += 1
+            return ('position',int(value))
+        return ('expr',self.additive())
+
+    def insert(self) -> dict:
+        self.expect('INTO')
+        statement = {'type': 'insert','table': self.name(),'rows': [],'select': None}
+        if self.accept('SELECT'):
+            statement['select'] = self.select()
+            return statement
+        self.expect('VALUES')
+        while True:
+            self.expect('(')
+            row = [self.value()]
+            while self.accept(','):
+                row.append(self.value())
+            self.expect(')')
+            statement['rows'].append(row)
+            if not self.accept(','):
+                break
+        return statement
+
+    def value(self) -> Expr:
+        negative = self.accept('-')
+        value = self.factor()
+        if not isinstance(value,(Const,Param)):
+            raise SQLError("only constant values can be inserted")
+        return Arithmetic('*',value,-1) if negative else value
+
+    def or_expr(self):
+        items = [self.and_expr()]
+        while self.accept('OR'):
+            items.append(self.and_expr())
+        return items[0] if len(items) == 1 else Or(*items)
+
+    def and_expr(self):
+        items = [self.not_expr()]
+        while self.accept('AND'):
+            items.append(self.not_expr())
+        return items[0] if len(items) == 1 else And(*items)
+
+    def not_expr(self):
+        if self.accept('NOT'):
+            return Not(self.not_expr())
+        left = self.additive()
+        kind,value = self.peek()
+        if kind == 'symbol' and value in COMPARISON_OPS:
+            self.position += 1
+            return Comparison(COMPARISON_OPS[value],left,self.additive())
+        negated = (kind,value) == ('keyword','NOT') and self.peek(1) == ('keyword','IN')
+        if negated:
+            self.position += 1
+        if self.accept('IN'):
+            self.expect('(')
+            self.expect('SELECT')
+            select = self.select()
+            self.expect(')')
+            return InSubquery(left,select,negated)
+        return left
+
+    def additive(self):
+        expr = self.term()
+        while self.peek()[1] in ('+','-') and self.peek()[0] == 'symbol':
+            op = self.peek()[1]
+            self.position += 1
+            expr = Arithmetic(op,expr,self.term())
+        return expr
+
+    def term(self):
+        expr = self.factor()
+        while self.peek()[1] in ('*','/') and self.peek()[0] == 'symbol':
+            op = self.peek()[1]
+            self.position += 1
+            expr = Arithmetic(op,expr,self.factor())
+        return expr
+
+    def factor(self):
+        kind,value = self.peek()
+        self.position += 1
+        if kind == 'number':
+            return Const(float(value) if '.' in value else int(value))
+        if kind == 'string':
+            return Const(value[1:-1].replace("''","'"))
+        if kind == 'name':
+            return ColumnName(value)
+        if (kind,value) == ('symbol','?'):
+            return self.param()
+        if (kind,value) == ('symbol','('):
+            expr = self.or_expr()
+            self.expect(')')
+            return expr
+        if (kind,value) == ('symbol','-'):
+            return Arithmetic('-',Const(0),self.factor())
+        if kind == 'keyword' and value in ('NULL','TRUE','FALSE'):
+            return Const({'NULL': None,'TRUE': True,'FALSE': False}[value])
+        raise SQLError(f"unexpected {value} in expression")
+
+
+class ColumnName(Expr):
+    """
+    Column referenced by name, it is replaced by a Col with the column position when the statement is planned.
+    """
+    def __init__(self,name:str):
+        self.name = name
+
+    def source(self) -> str:
+        raise SQLError(f"column {self.name} has not been resolved")
+
+
+class InSubquery(Expr):
+    """
+    expr [NOT] IN (SELECT ...), it is taken out of the WHERE and planned as a join with the subquery rows.
+    """
+    def __init__(self,expr:Expr,select:dict,negated:bool):
+        self.expr = expr
+        self.select = select
+        self.negated = negated
+
+    def source(self) -> str:
+        raise SQLError("IN (SELECT ...) is only supported as a condition of the top level AND of the WHERE")
+
+
+def split_subqueries(where:Expr) -> tuple:
+    """
+    Split the WHERE in the conditions without subqueries and the IN subqueries of its top level AND.
+    """
+    if isinstance(where,InSubquery):
+        return None,[where]
+    if isinstance(where,Not) and isinstance(where.item,InSubquery):
+        return None,[InSubquery(where.item.expr,where.item.select,not where.item.negated)]
+    if isinstance(where,And):
+        conditions,subqueries = [],[]
+        for item in where.items:
+            condition,item_subqueries = split_subqueries(item)
+            subqueries.extend(item_subqueries)
+            if condition is not None:
+                conditions.append(condition)
+        if len(conditions) == 0:
+            return None,subqueries
+        return (conditions[0] if len(conditions) == 1 else And(*conditions)),subqueries
+    return where,[]
+
+
+class Scope:
+    """
+    Column names visible by a statement and their position in the rows, a join concatenates both tables.
+    """
+    def __init__(self,tables:list):
+        self.names = []
+        self.types = []
+        for table in tables:
+            for column in table.column_names:
+                self.names.append((table.name.lower(),column.lower()))
+            self.types.extend(table.schema)
+
+    def resolve(self,name:str) -> int:
+        parts = name.lower().split('.')
+        matches = [i for i,(table,column) in enumerate(self.names)
+                   if column == parts[-1] and (len(parts) == 1 or table == parts[0])]
+        if len(matches) == 0:
+            raise SQLError(f"column {name} does not exists")
+        if len(matches) > 1:
+            raise SQLError(f"column {name} is ambiguous")
+        return matches[0]
+
+    def bind(self,expr:Expr) -> Expr:
+        """
+        Return a copy of the expression with the column names replaced by their positions.
+        """
+        if isinstance(expr,ColumnName):
+            return Col(self.resolve(expr.name))
+        if isinstance(expr,Comparison):
+            return Comparison(expr.op,self.bind(expr.left),self.bind(expr.right))
+        if isinstance(expr,Arithmetic):
+            return Arithmetic(expr.op,self.bind(expr.left),self.bind(expr.right))
+        if isinstance(expr,And):
+            return And(*[self.bind(item) for item in expr.items])
+        if isinstance(expr,Or):
+            return Or(*[self.bind(item) for item in expr.items])
+        if isinstance(expr,Not):
+            return Not(self.bind(expr.item))
+        return expr
+
+
+def expression_type(expr:Expr,types:list) -> str:
+    """
+    Column type of the values of a bound expression, the types are the ones of the columns of the scope.
+    """
+    if isinstance(expr,Col):
+        return types[expr.index]
+    if isinstance(expr,Const):
+        if expr.value is None:
+            raise SQLError("can not infer the type of NULL")
+        return 'text' if isinstance(expr.value,str) else 'float' if isinstance(expr.value,float) else 'int'
+    if isinstance(expr,Arithmetic):
+        operands = (expression_type(expr.left,types),expression_type(expr.right,types))
+        if 'double' in operands:
+            return 'double'
+        return 'float' if expr.op == '/' or 'float' in operands else 'int'
+    if isinstance(expr,(Comparison,And,Or,Not)):
+        return 'int'
+    raise SQLError("can not infer the type of a parameter")
+
+
+class SelectPlan:
+    """
+    Planned SELECT statement. All the names are resolved and the expressions compiled, building the executor
+    tree for a given set of parameters only instantiates the operators.
+    """
+    def __init__(self,catalog:Catalog,statement:dict):
+        self.n_params = statement['n_params']
+        self.table = catalog.get(statement['table'])
+        tables = [self.table]
+        self.join = None
+        if statement['join'] is not None:
+            join_table,left,right = statement['join']
+            self.join = catalog.get(join_table)
+            tables.append(self.join)
+        scope = Scope(tables)
+        if self.join is not None:
+            left,right = scope.resolve(left),scope.resolve(right)
+            n_left = len(self.table.column_names)
+            if left >= n_left:
+                left,right = right,left
+            self.left_key = Col(left)
+            self.right_key = Col(right - n_left)
+        where,subqueries = split_subqueries(statement['where'])
+        self.where = scope.bind(where) if where is not None else None
+        self.subqueries = []
+        for subquery in subqueries:
+            plan = SelectPlan(catalog,dict(subquery.select,n_params=self.n_params))
+            if len(plan.columns) != 1:
+                raise SQLError("the subquery of IN must select one column")
+            self.subqueries.append((scope.bind(subquery.expr),plan,subquery.negated))
+        self.sample = statement['sample']
+        self.limit = statement['limit']
+        self.offset = statement['offset']
+        self.desc = statement['desc']
+        items = statement['items']
+        aggregates = [item for item in items or [] if item[0] == 'aggregate']
+        self.aggregate = None
+        self.group = None
+        self.order_key = None
+        self.output = None
+        self.columns = None
+        self.types = scope.types
+        if len(aggregates) > 0 or statement['group_by'] is not None:
+            self.plan_aggregate(scope,items,aggregates,statement)
+        else:
+            self.plan_rows(scope,items,statement)
+
+    def output_columns(self) -> list:
+        """
+        Names and types of the selected columns, e.g. to create a table with them.
+        """
+        names = [name for name,_ in self.columns]
+        for name in names:
+            if names.count(name) > 1:
+                raise SQLError(f"the selected column {name} is not unique, name the columns with AS")
+        # the type of a column is known when it is planned or inferred from its expression
+        return [(name,dtype if isinstance(dtype,str) else expression_type(dtype,self.types)) for name,dtype in self.columns]
+
+    def plan_aggregate(self,scope,items,aggregates,statement):
+        if items is None or len(aggregates) != 1:
+            raise SQLError("exactly one aggregate function is supported per query")
+        _,func_name,argument,self.aggregate_options = aggregates[0]
+        group = Col(scope.resolve(statement['group_by'])) if statement['group_by'] is not None else None
+        value = Const(1) if argument == '*' else Col(scope.resolve(argument))
+        self.group = group
+        self.aggregate = (group,value,func_name)
+        # Aggregation emits (group, value) tuples, the select list picks from them
+        output = []
+        self.columns = []
+        for item,name in zip(items,statement['names']):
+            if item[0] == 'aggregate':
+                output.append(Col(1))
+                dtype = 'int' if func_name in ('count','approx_count_distinct') else 'float' if func_name in ('avg','approx_percentile') \
+                    else expression_type(value,scope.types)
+                self.columns.append((name or func_name,dtype))
+            elif item[0] == 'expr' and isinstance(item[1],ColumnName) and group is not None \
+                    and scope.resolve(item[1].name) == group.index:
+                output.append(Col(0))
+                self.columns.append((name or item[1].name.split('.')[-1],scope.types[group.index]))
+            else:
+                raise SQLError("selected columns must appear in the GROUP BY clause")
+        self.output = output
+        order_by = statement['order_by']
+        if order_by is not None:
+            if order_by[0] == 'aggregate':
+                self.order_key = Col(1)
+            elif order_by[0] == 'position':
+                self.order_key = output[order_by[1]-1]
+            else:
+                self.order_key = Col(0)
+
+    def plan_rows(self,scope,items,statement):
+        if items is None:
+            self.columns = [(column,dtype) if [name for _,name in scope.names].count(column) == 1 else (f"{table}_{column}",dtype)
+                            for (table,column),dtype in zip(scope.names,scope.types)]
+        else:
+            self.output = [scope.bind(item[1]) for item in items]
+            self.columns = []
+            for i,(item,name,expr) in enumerate(zip(items,statement['names'],self.output)):
+                if name is None:
+                    name = item[1].name.split('.')[-1] if isinstance(item[1],ColumnName) else f"column{i + 1}"
+                self.columns.append((name,expr))
+        order_by = statement['order_by']
+        if order_by is not None:
+            if order_by[0] == 'position':
+                if self.output is None:
+                    self.order_key = Col(order_by[1]-1)
+                else:
+                    self.order_key = self.output[order_by[1]-1]
+            else:
+                self.order_key = scope.bind(order_by[1])
+
+    def build(self,params:tuple = ()):
+        nodes = []
+        if self.output is not None:
+            nodes.append(Projection(self.output,params))
+        if self.limit is not None:
+            offset = constant_value(self.offset,params) if self.offset is not None else 0
+            nodes.append(Limit(constant_value(self.limit,params),offset))
+        if self.order_key is not None:
+            nodes.append(Sort(self.order_key,self.desc))
+        source = self.build_source(params)
+        if self.aggregate is not None:
+            # when the rows already come ordered on the group column the groups are aggregated as they stream
+            if isinstance(self.group,Col) and ordering(source) == self.group.index and self.aggregate[2] in StreamAggregation.functions:
+                nodes.append(StreamAggregation(*self.aggregate))
+            else:
+                nodes.append(Aggregation(*self.aggregate,**self.aggregate_options))
+        nodes.append(source)
+        return Q(*nodes)
+
+    def build_source(self,params:tuple):
+        source = self.build_rows(params)
+        # NOT IN returns nothing when the subquery has a null, as in SQL
+        for key,plan,negated in self.subqueries:
+            if negated:
+                source = AntiJoin(Q(source),plan.build(params),key,Col(0),null_aware=True)
+            else:
+                source = SemiJoin(Q(source),plan.build(params),key,Col(0))
+        return source
+
+    def build_rows(self,params:tuple):
+        if self.join is not None:
+            nodes = []
+            if self.where is not None:
+                nodes.append(Selection(self.where,params))
+            nodes.append(HashJoin(Q(self.table.scan(sample=self.sample)),Q(self.join.scan()),self.left_key,self.right_key))
+            return Q(*nodes)
+        # without joins the predicate is pushed down into the scan
+        if self.where is not None and (self.table.rows is not None or self.sample is not None):
+            return Q(Selection(self.where,params),self.table.scan(sample=self.sample))
+        return self.table.scan(self.where,params,self.sample)
+
+    def execute(self,params:tuple = ()):
+        return run(self.build(params))
+
+
+def insert_rows(table:Table,records:list = None,source = None) -> int:
+    """
+    Insert the records, or the rows of the source operator which are streamed into the table pages, and return
+    the number of inserted rows.
+    """
+    if table.rows is not None:
+        rows = list(records) if records is not None else list(run(source))
+        table.rows.extend(rows)
+        return len(rows)
+    db = table.partitioned if table.partitioned is not None else DataBase(table.path,table.db_name,table.name,table.schema)
+    insert = Insert(db,records)
+    for _ in run(Q(insert,source) if source is not None else Q(insert)):
+        pass
+    if table.partitioned is None:
+        db.db.flush()
+    return insert.n
+
+
+class InsertPlan:
+    def __init__(self,catalog:Catalog,statement:dict):
+        self.n_params = statement['n_params']
+        self.table = catalog.get(statement['table'])
+        self.select = None
+        if statement['select'] is not None:
+            self.select = SelectPlan(catalog,dict(statement['select'],n_params=self.n_params))
+            n_columns = len(self.select.columns)
+            if n_columns != len(self.table.schema):
+                raise SQLError(f"table {self.table.name} has {len(self.table.schema)} columns but {n_columns} columns were selected")
+        for row in statement['rows']:
+            if len(row) != len(self.table.schema):
+                raise SQLError(f"table {self.table.name} has {len(self.table.schema)} columns but {len(row)} values were provided")
+        self.rows = statement['rows']
+        self.row_builders = [compile_projection(row) for row in self.rows]
+
+    def execute(self,params:tuple = ()) -> int:
+        if self.select is None:
+            return insert_rows(self.table,records=[builder((),params) for builder in self.row_builders])
+        source = self.select.build(params)
+        if self.table in (self.select.table,self.select.join):
+            # the scan would read the pages being appended, the selected rows are collected first
+            source = MemoryScan(list(run(source)))
+        return insert_rows(self.table,source=source)
+
+
+class CreateTableAsPlan:
+    def __init__(self,catalog:Catalog,statement:dict):
+        self.n_params = statement['n_params']
+        self.catalog = catalog
+        self.name = statement['table']
+        if catalog.directory is None:
+            raise SQLError("the catalog has no directory to create tables in")
+        self.select = SelectPlan(catalog,dict(statement['select'],n_params=self.n_params))
+        self.columns = self.select.output_columns()
+
+    def execute(self,params:tuple = ()) -> int:
+        path = os.path.join(self.catalog.directory,f"{self.name}.db")
+        if self.name.lower() in self.catalog.tables or os.path.exists(path):
+            raise SQLError(f"table {self.name} already exists")
+        self.catalog.register_table(self.name,path,self.columns,db_name=self.select.table.db_name)
+        return insert_rows(self.catalog.get(self.name),source=self.select.build(params))
+
+
+class ClusterPlan:
+    def __init__(self,catalog:Catalog,statement:dict):
+        self.n_params = 0
+        self.table = catalog.get(statement['table'])
+        if self.table.rows is not None or self.table.partitioned is not None:
+            raise SQLError(f"table {self.table.name} is not stored in a single file and can not be clustered")
+        self.col = Scope([self.table]).resolve(statement['column'])
+
+    def execute(self,params:tuple = ()) -> int:
+        return cluster_table(self.table.path,self.table.db_name,self.table.name,self.table.schema,self.col)
+
+
+PLANS = {'select': SelectPlan,'insert': InsertPlan,'create_table_as': CreateTableAsPlan,'cluster': ClusterPlan}
+
+
+class PreparedStatement:
+    def __init__(self,sql:str,plan):
+        self.sql = sql
+        self.plan = plan
+
+    def execute(self,params:tuple = ()):
+        """
+        Execute the statement with the given parameters. A SELECT returns the rows generator, an INSERT and a
+        CREATE TABLE AS the number of inserted rows.
+        """
+        params = tuple(params)
+        if len(params) != self.plan.n_params:
+            raise SQLError(f"statement expects {self.plan.n_params} parameters but {len(params)} were provided")
+        return self.plan.execute(params)
+
+
+class PlanCache:
+    """
+    LRU cache of prepared statements keyed by normalized query text.
+    """
+    def __init__(self,capacity:int = 128):
+        self.capacity = capacity
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key:str):
+        statement = self.statements.get(key)
+        if statement is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.statements.move_to_end(key)
+        return statement
+
+    def put(self,key:str,statement:PreparedStatement):
+        self.statements[key] = statement
+        self.statements.move_to_end(key)
+        if len(self.statements) > self.capacity:
+            self.statements.popitem(last=False)
+
+
+class SQLEngine:
+    def __init__(self,catalog:Catalog,cache_size:int = 128):
+        self.catalog = catalog
+        self.cache = PlanCache(cache_size)
+
+    def prepare(self,sql:str) -> PreparedStatement:
+        key = normalize(sql)
+        statement = self.cache.get(key)
+        if statement is None:
+            parsed = Parser(tokenize(sql)).statement()
+            plan = PLANS[parsed['type']](self.catalog,parsed)
+            statement = PreparedStatement(key,plan)
+            self.cache.put(key,statement)
+        return statement
+
+    def execute(self,sql:str,params:tuple = ()):
+        return self.prepare(sql).execute(params)
+
+
+class TestSQL:
+    birds = [
+        ('amerob', 'American Robin', 0.077, 1),
+        ('baleag', 'Bald Eagle', 4.74, 1),
+        ('eursta', 'European Starling', 0.082, 1),
+        ('barswa', 'Barn Swallow', 0.019, 1),
+        ('ostric1', 'Ostrich', 104.0, 0),
+        ('emppen1', 'Emperor Penguin', 23.0, 0),
+        ('rufhum', 'Rufous Hummingbird', 0.0034, 1),
+        ('comrav', 'Common Raven', 1.2, 1),
+        ('wanalb', 'Wandering Albatross', 8.5, 0),
+        ('norcar', 'Northern Cardinal', 0.045, 1)
+    ]
+    movies = [(1,'Toy Story (1995)','Animation|Comedy'),(2,'Jumanji (1995)','Adventure'),(3,'Heat (1995)','Action|Crime')]
+    ratings = [(1,1,4.0,0),(2,1,3.0,0),(1,3,5.0,0),(3,2,2.0,0),(3,1,5.0,0)]
+
+    def engine(self) -> SQLEngine:
+        catalog = Catalog()
+        catalog.register_memory_table('birds',list(self.birds),[('id','str'),('name','str'),('weight','float'),('in_us','int')])
+        catalog.register_memory_table('movies',list(self.movies),[('movieId','int'),('title','str'),('genres','str')])
+        catalog.register_memory_table('ratings',list(self.ratings),[('userId','int'),('movieId','int'),('rating','float'),('timestamp','int')])
+        return SQLEngine(catalog)
+
+    def test_select_where_order_limit(self):
+        engine = self.engine()
+        result = tuple(engine.execute("select id, weight from birds where weight > 1 order by weight desc limit 2 offset 1"))
+        assert result == (('emppen1',23.0),('wanalb',8.5))
+
+    def test_group_by(self):
+        engine = self.engine()
+        result = tuple(engine.execute("SELECT in_us, COUNT(*) FROM birds GROUP BY in_us ORDER BY in_us"))
+        assert result == ((0,3),(1,7))
+        result = tuple(engine.execute("SELECT SUM(weight) FROM birds WHERE in_us = 0"))
+        assert result == ((135.5,),)
+        result = tuple(engine.execute("SELECT in_us, APPROX_COUNT_DISTINCT(name) FROM birds GROUP BY in_us ORDER BY in_us"))
+        assert result == ((0,3),(1,7))
+        result = tuple(engine.execute("SELECT APPROX_PERCENTILE(weight, 0.5) FROM birds WHERE in_us = 1"))
+        assert len(result) == 1 and 0.077 <= result[0][0] <= 8.5
+
+    def test_join(self):
+        engine = self.engine()
+        result = tuple(engine.execute(
+            "SELECT title, AVG(rating) FROM movies JOIN ratings ON movies.movieId = ratings.movieId GROUP BY title ORDER BY 1"))
+        assert result == (('Heat (1995)',5.0),('Jumanji (1995)',2.0),('Toy Story (1995)',4.0))
+
+    def test_join_with_where(self):
+        engine = self.engine()
+        result = tuple(engine.execute(
+            "SELECT title, rating FROM movies JOIN ratings ON movies.movieId = ratings.movieId WHERE rating > 4 ORDER BY title"))
+        assert result == (('Heat (1995)',5.0),('Toy Story (1995)',5.0))
+
+    def test_where_and_join_with_limit(self):
+        engine = self.engine()
+        assert tuple(engine.execute("SELECT userId FROM ratings WHERE rating > 4.6 LIMIT 2")) == ((1,),(3,))
+        assert tuple(engine.execute("SELECT userId FROM ratings WHERE rating > 2.5 LIMIT 2 OFFSET 1")) == ((2,),(1,))
+        result = tuple(engine.execute("SELECT title, rating FROM movies JOIN ratings ON movies.movieId = ratings.movieId LIMIT 4"))
+        assert len(result) == 4
+
+    def test_global_aggregate_over_no_rows(self):
+        engine = self.engine()
+        assert tuple(engine.execute("SELECT COUNT(*) FROM ratings WHERE rating > 10")) == ((0,),)
+        assert tuple(engine.execute("SELECT SUM(rating) FROM ratings WHERE rating > 10")) == ((None,),)
+        assert tuple(engine.execute("SELECT userId, COUNT(*) FROM ratings WHERE rating > 10 GROUP BY userId")) == ()
+
+    def test_prepared_statements_use_the_plan_cache(self):
+        engine = self.engine()
+        statement = engine.prepare("SELECT id FROM birds WHERE weight >= ? AND in_us = ?")
+        assert tuple(statement.execute((1.0,1))) == (('baleag',),('comrav',))
+        assert tuple(engine.execute("select id  from birds where weight >= ? and in_us = ?",(10,0))) == (('ostric1',),('emppen1',))
+        assert engine.prepare("SELECT id FROM birds WHERE weight >= ? AND in_us = ?") is statement
+        assert (engine.cache.hits,engine.cache.misses) == (2,1)
+
+    def test_insert(self,tmp_path):
+        catalog = Catalog()
+        catalog.register_table('movies',str(tmp_path / 'movies.db'),[('movieId','int'),('title','str'),('genres','str')])
+        engine = SQLEngine(catalog)
+        assert engine.execute("INSERT INTO movies VALUES (1, 'Toy Story (1995)', 'Comedy'), (?, ?, 'Drama')",(2,'Heat (1995)')) == 2
+        result = tuple(engine.execute("SELECT title FROM movies WHERE movieId > 1"))
+        assert result == (('Heat (1995)',),)
+
+    def test_cluster(self,tmp_path):
+        catalog = Catalog()
+        catalog.register_table('movies',str(tmp_path / 'movies.db'),[('movieId','int'),('title','str'),('genres','str')])
+        engine = SQLEngine(catalog)
+        engine.execute("INSERT INTO movies VALUES (3, 'Heat (1995)', 'Action'), (1, 'Toy Story (1995)', 'Comedy'), (2, 'Jumanji (1995)', 'Adventure')")
+        assert engine.execute("CLUSTER movies ON movieId") == 3
+        assert tuple(engine.execute("SELECT movieId FROM movies")) == ((1,),(2,),(3,))
+        assert tuple(engine.execute("SELECT movieId FROM movies TABLESAMPLE SYSTEM (100) REPEATABLE (7) WHERE movieId > 1")) == ((2,),(3,))
+        assert tuple(engine.execute("SELECT movieId FROM movies TABLESAMPLE BERNOULLI (0)")) == ()
+        assert tuple(engine.execute("SELECT movieId, title FROM movies ORDER BY movieId LIMIT 1")) == ((1,'Toy Story (1995)'),)
+        query = engine.prepare("SELECT movieId, COUNT(*) FROM movies GROUP BY movieId ORDER BY movieId").plan.build()
+        sort = query.child
+        assert isinstance(sort.child,StreamAggregation)
+        assert tuple(run(query)) == ((1,1),(2,1),(3,1))
+        assert sort.presorted
+        count = engine.prepare("SELECT COUNT(*) FROM movies").plan.build()
+        assert tuple(run(count)) == ((3,),) and count.child.from_metadata
+        assert tuple(engine.execute("SELECT MIN(movieId) FROM movies")) == ((1,),)
+        assert tuple(engine.execute("SELECT MAX(movieId) FROM movies WHERE movieId < 3")) == ((2,),)
+
+    def test_insert_select_and_create_table_as(self,tmp_path):
+        catalog = Catalog(str(tmp_path))
+        catalog.register_memory_table('ratings',list(self.ratings),[('userId','int'),('movieId','int'),('rating','float'),('timestamp','int')])
+        catalog.register_table('top',str(tmp_path / 'top.db'),[('userId','int'),('movieId','int')])
+        engine = SQLEngine(catalog)
+        assert engine.execute("INSERT INTO top SELECT userId, movieId FROM ratings WHERE rating >= ?",(4.0,)) == 3
+        assert tuple(engine.execute("SELECT * FROM top")) == ((1,1),(1,3),(3,1))
+        assert engine.execute("CREATE TABLE movie_avg AS SELECT movieId, AVG(rating) AS score FROM ratings GROUP BY movieId") == 3
+        created = catalog.get('movie_avg')
+        assert created.column_names == ['movieId','score'] and created.schema == ('int','float')
+        assert tuple(engine.execute("SELECT movieId FROM movie_avg WHERE score > 3 ORDER BY movieId")) == ((1,),(3,))
+        assert engine.execute("CREATE TABLE scaled AS SELECT userId, rating * 2 AS double_rating, 'x' AS tag FROM ratings") == 5
+        assert catalog.get('scaled').schema == ('int','float','text')
+        assert engine.execute("INSERT INTO top SELECT * FROM top") == 3
+        assert len(tuple(engine.execute("SELECT * FROM top"))) == 6
+        for sql in ("CREATE TABLE top AS SELECT * FROM ratings","INSERT INTO top SELECT * FROM ratings"):
+            try:
+                engine.execute(sql)
+                assert False, f"expected {sql} to fail"
+            except SQLError:
+                pass
+
+    def test_in_and_not_in_subqueries(self):
+        engine = self.engine()
+        result = tuple(engine.execute("SELECT title FROM movies WHERE movieId IN (SELECT movieId FROM ratings WHERE rating >= ?)",(4.0,)))
+        assert result == (('Toy Story (1995)',),('Heat (1995)',))
+        result = tuple(engine.execute("SELECT title FROM movies WHERE movieId > 1 AND movieId NOT IN (SELECT movieId FROM ratings WHERE userId = 1)"))
+        assert result == (('Jumanji (1995)',),)
+        query = engine.prepare("SELECT COUNT(*) FROM movies WHERE NOT movieId IN (SELECT movieId FROM ratings)").plan.build()
+        assert tuple(run(query)) == ((0,),)
+        assert isinstance(query.child.child,AntiJoin)
+        try:
+            engine.execute("SELECT title FROM movies WHERE movieId = 1 OR movieId IN (SELECT movieId FROM ratings)")
+            assert False, "expected IN under OR to fail"
+        except SQLError:
+            pass
+
+    def test_partitioned_table(self,tmp_path):
+        from partitions import PartitionedTable
+        table = PartitionedTable(str(tmp_path / 'ratings.parts'),'mydb','ratings',('int','int','float','int'),col=3,method='range',bounds=[100,200])
+        catalog = Catalog()
+        catalog.register_partitioned_table('ratings',table,[('userId','int'),('movieId','int'),('rating','float'),('timestamp','int')])
+        engine = SQLEngine(catalog)
+        assert engine.execute("INSERT INTO ratings VALUES (1, 1, 4.0, 50), (2, 1, 3.0, 150), (1, 2, 5.0, 250), (3, 2, 1.0, 120)") == 4
+        query = engine.prepare("SELECT userId, rating FROM ratings WHERE timestamp >= ? AND timestamp < ?").plan.build((100,200))
+        assert sorted(run(query)) == [(2,3.0),(3,1.0)]
+        assert query.child.partitions == [1]
+        assert tuple(engine.execute("SELECT movieId, COUNT(*) FROM ratings GROUP BY movieId ORDER BY movieId")) == ((1,2),(2,2))
+
+    def test_errors(self):
+        engine = self.engine()
+        for sql in ("SELECT nope FROM birds","SELECT id FROM nope","DELETE FROM birds","SELECT id, COUNT(*) FROM birds GROUP BY in_us"):
+            try:
+                tuple(engine.execute(sql))
+                assert False, f"expected {sql} to fail"
+            except SQLError:
+                pass
@@ -0,0 +1,143 @@
+"""
+Multi version concurrency control for the tables created with mvcc=True. Every record of those tables carries
+two hidden int columns: xmin, the id of the transaction that inserted it, and xmax, the id of the transaction
+that deleted it (0 while it is alive). A transaction reads through the snapshot taken when it began, a record
+is visible when its xmin was committed before the snapshot and its xmax was not, so readers never wait for
+writers and writers only append records or set xmax.
+
+Records written without a transaction get FROZEN_XID and are visible to everyone. When a transaction aborts
+the xmin of the records it inserted and the xmax of the records it deleted are reset to INVALID_XID, so the
+table files never hold the ids of aborted transactions. There is no write ahead log, the records of a
+transaction that was running when the process crashed are seen as committed when the table is opened again.
+"""
+import os
+import threading
+
+INVALID_XID = 0
+FROZEN_XID = 1
+MVCC_COLUMNS = ('int','int')
+
+
+class WriteConflict(Exception):
+    pass
+
+
+class Snapshot:
+    """
+    Transactions whose changes are visible: the ones below xmax that were not active when it was taken, plus
+    the transaction that owns the snapshot.
+    """
+    def __init__(self,xmax:int,active:frozenset,own_xid:int = None):
+        self.xmax = xmax
+        self.active = active
+        self.own_xid = own_xid
+
+    def sees(self,xid:int) -> bool:
+        return xid == self.own_xid or (xid < self.xmax and xid not in self.active)
+
+    def is_visible(self,xmin:int,xmax:int) -> bool:
+        if xmin == INVALID_XID or not self.sees(xmin):
+            return False
+        return xmax == INVALID_XID or not self.sees(xmax)
+
+
+class Transaction:
+    def __init__(self,manager:"TransactionManager",xid:int,snapshot:Snapshot):
+        self.manager = manager
+        self.xid = xid
+        self.snapshot = snapshot
+        self.tables = []
+        self.undo = []
+        self.finished = False
+
+    def record_write(self,db,page_no:int,slot:int,field:int):
+        """
+        Remember a hidden field written by this transaction so it can be reset if the transaction aborts.
+        """
+        if db not in self.tables:
+            self.tables.append(db)
+        self.undo.append((db,page_no,slot,field))
+
+    def commit(self):
+        for db in self.tables:
+            db.commit()
+        self.manager.finish(self)
+
+    def abort(self):
+        for db,page_no,slot,field in reversed(self.undo):
+            db.set_record_field(page_no,slot,field,INVALID_XID)
+        for db in self.tables:
+            db.rollback()
+        self.manager.finish(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        if self.finished:
+            return False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+class TransactionManager:
+    """
+    Hands out transaction ids and snapshots for one table file. There is one manager per table file in the
+    process, shared by every DataBase opened on it, the next id is kept in the table header so the ids keep
+    growing when the table is opened again.
+    """
+    managers = dict()
+    managers_lock = threading.Lock()
+
+    def __init__(self,next_xid:int = FROZEN_XID + 1):
+        self.lock = threading.Lock()
+        self.next_xid = max(next_xid,FROZEN_XID + 1)
+        self.active = set()
+
+    @classmethod
+    def for_table(cls,path:str,next_xid:int = FROZEN_XID + 1) -> "TransactionManager":
+        key = os.path.realpath(path)
+        with cls.managers_lock:
+            manager = cls.managers.get(key)
+            if manager is None:
+                manager = cls(next_xid)
+                cls.managers[key] = manager
+            return manager
+
+    def begin(self) -> Transaction:
+        with self.lock:
+            xid = self.next_xid
+            self.next_xid += 1
+            snapshot = Snapshot(xid,frozenset(self.active),xid)
+            self.active.add(xid)
+        return Transaction(self,xid,snapshot)
+
+    def snapshot(self) -> Snapshot:
+        with self.lock:
+            return Snapshot(self.next_xid,frozenset(self.active))
+
+    def finish(self,transaction:Transaction):
+        with self.lock:
+            self.active.discard(transaction.xid)
+        transaction.finished = True
+
+
+class TestSnapshot:
+
+    def test_visibility(self):
+        manager = TransactionManager()
+        first = manager.begin()
+        second = manager.begin()
+        snapshot = manager.snapshot()
+        assert not snapshot.is_visible(first.xid,INVALID_XID)
+        assert snapshot.is_visible(FROZEN_XID,INVALID_XID)
+        assert first.snapshot.is_visible(first.xid,INVALID_XID)
+        assert not first.snapshot.is_visible(second.xid,INVALID_XID)
+        manager.finish(first)
+        assert manager.snapshot().is_visible(first.xid,INVALID_XID)
+        assert not manager.snapshot().is_visible(first.xid,first.xid)
+        assert snapshot.is_visible(FROZEN_XID,second.xid)
+        assert not snapshot.is_visible(INVALID_XID,INVALID_XID)
@@ -0,0 +1,229 @@
+"""
+Materialized views over a group by aggregate of one table. The view keeps a mergeable state per group
+(sum, count, min and max of the column) so every function is maintained from the new records only, the state
+is stored as its own small table file sorted by the group key and reading the view scans that file instead of
+aggregating the base table again.
+
+The view listens to the DataBase used to write the base table:
+
+    ratings = DataBase('ratings.db','mydb','ratings',('int','int','float','int'))
+    view = MaterializedView('avg_rating.db',ratings,group_col=1,col=2,func_name='avg')
+    run(Q(Insert(ratings,new_ratings)))
+    tuple(run(view.scan()))
+
+With mode='incremental' the state is updated and stored when the inserted records are committed. With
+mode='refresh_on_read' the committed records are only queued and applied when the view is read.
+
+The signature of the base table (see indexes.py) is stored next to the view, a view opened after the base
+table was written without it is recomputed.
+"""
+import os
+import struct
+
+from data_layout import DataBase, DBPage
+from executor import Q, run, FileScan, Insert, Projection, Aggregation, MemoryScan
+from indexes import table_signature
+
+SIGNATURE_FORMAT = struct.Struct("<qQ") # base table size and last page hash
+
+
+class MaterializedView:
+    functions = ('sum','count','avg','min','max')
+    modes = ('incremental','refresh_on_read')
+
+    def __init__(self,path:str,base:DataBase,group_col:int,col:int,func_name:str,mode:str = 'incremental',name:str = None):
+        self.func_name = func_name.lower()
+        if self.func_name not in self.functions:
+            raise NotImplementedError(f"the function {self.func_name} is not supported by materialized views")
+        if mode not in self.modes:
+            raise ValueError(f"unknown view mode {mode}, expected one of {self.modes}")
+        self.path = path
+        self.base = base
+        self.group_col = group_col
+        self.col = col
+        self.mode = mode
+        self.name = name if name is not None else os.path.splitext(os.path.basename(path))[0]
+        self.signature_path = f"{path}.signature"
+        self.schema = (base.schema[group_col],'double','int','double','double')
+        self.state = dict()
+        self.pending = []
+        self.committed_pending = []
+        if os.path.isfile(path):
+            self.load()
+        else:
+            self.refresh()
+        base.add_listener(self)
+
+    def record_added(self,record:tuple):
+        self.pending.append((record[self.group_col],record[self.col]))
+
+    def rolled_back(self):
+        self.pending = []
+
+    def committed(self):
+        if len(self.pending) == 0:
+            return
+        self.committed_pending.extend(self.pending)
+        self.pending = []
+        if self.mode == 'incremental':
+            self.apply_pending()
+
+    def apply_pending(self):
+        for key,value in self.committed_pending:
+            self.merge(key,value)
+        self.committed_pending = []
+        self.save()
+
+    def merge(self,key,value):
+        if value is None:
+            self.state.setdefault(key,[0.0,0,None,None])
+            return
+        state = self.state.get(key)
+        if state is None:
+            self.state[key] = [float(value),1,value,value]
+            return
+        state[0] += value
+        state[1] += 1
+        state[2] = value if state[2] is None or value < state[2] else state[2]
+        state[3] = value if state[3] is None or value > state[3] else state[3]
+
+    def refresh(self):
+        """
+        Recompute the view from the committed pages of the base table. On mvcc tables the columns come after
+        the hidden xmin and xmax and only the records visible in a new snapshot are counted.
+        """
+        self.state = dict()
+        self.committed_pending = []
+        schema = self.base.header.schema
+        hidden = self.base.hidden_columns
+        group_col,col = hidden + self.group_col,hidden + self.col
+        snapshot = self.base.transactions.snapshot() if self.base.mvcc else None
+        for page_no in range(self.base.page_count()):
+            page = DBPage()
+            page.decode(self.base.read_page(page_no),schema,{group_col,col} | set(range(hidden)))
+            for record in page.records:
+                if snapshot is not None and not snapshot.is_visible(record.record[0],record.record[1]):
+                    continue
+                self.merge(record.record[group_col],record.record[col])
+        self.save()
+
+    def load(self):
+        """
+        Read the state stored by save, or refresh the view if the base table changed since then.
+        """
+        signature = None
+        if os.path.isfile(self.signature_path):
+            with open(self.signature_path,'rb') as f:
+                content = f.read()
+            if len(content) == SIGNATURE_FORMAT.size:
+                signature = SIGNATURE_FORMAT.unpack(content)
+        if signature != table_signature(self.base):
+            self.refresh()
+            return
+        for key,total,count,low,high in run(Q(FileScan(self.path,'views',self.name,self.schema))):
+            self.state[key] = [total,count,low if count > 0 else None,high if count > 0 else None]
+
+    def save(self):
+        """
+        Rewrite the view table sorted by the group key, it has one small record per group.
+        """
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        db = DataBase(tmp_path,'views',self.name,self.schema)
+        records = [(key,total,count,low if low is not None else 0.0,high if high is not None else 0.0)
+                   for key,(total,count,low,high) in sorted(self.state.items())]
+        db.header.sort_col = 0
+        for _ in run(Q(Insert(db,records))):
+            pass
+        db.db.close()
+        db.db = None
+        os.replace(tmp_path,self.path)
+        with open(self.signature_path,'wb') as f:
+            f.write(SIGNATURE_FORMAT.pack(*table_signature(self.base)))
+
+    def result(self,record:tuple) -> tuple:
+        key,total,count,low,high = record
+        if self.func_name == 'sum':
+            return (key,total)
+        elif self.func_name == 'count':
+            return (key,count)
+        elif count == 0:
+            return (key,None)
+        elif self.func_name == 'avg':
+            return (key,round(total / count,2))
+        return (key,low if self.func_name == 'min' else high)
+
+    def scan(self):
+        """
+        Query tree returning the (group, value) rows of the view, ordered by group. In refresh_on_read mode
+        the committed records that have not been applied yet are applied first.
+        """
+        if len(self.committed_pending) > 0:
+            self.apply_pending()
+        return Q(Projection(self.result),FileScan(self.path,'views',self.name,self.schema))
+
+
+def create_ratings(path,records) -> DataBase:
+    db = DataBase(str(path),'mydb','ratings',('int','int','float','int'))
+    for _ in run(Q(Insert(db,list(records)))):
+        pass
+    return db
+
+
+class TestMaterializedView:
+    ratings = [(i % 97,i % 13,float(i % 5) + 0.5,1000 + i) for i in range(3000)]
+    new_ratings = [(i,i % 17,float(i % 3) + 1.0,5000 + i) for i in range(500)]
+
+    def expected(self,records,func_name):
+        return tuple(sorted(run(Q(Aggregation(lambda x: x[1],lambda x: x[2],func_name),MemoryScan(list(records))))))
+
+    def test_incremental_view(self,tmp_path):
+        db = create_ratings(tmp_path / 'ratings.db',self.ratings)
+        view = MaterializedView(str(tmp_path / 'avg_rating.db'),db,group_col=1,col=2,func_name='avg')
+        assert tuple(run(view.scan())) == self.expected(self.ratings,'avg')
+        for _ in run(Q(Insert(db,list(self.new_ratings)))):
+            pass
+        assert len(view.committed_pending) == 0
+        assert tuple(run(view.scan())) == self.expected(self.ratings + self.new_ratings,'avg')
+
+        reopened = MaterializedView(str(tmp_path / 'avg_rating.db'),db,group_col=1,col=2,func_name='sum')
+        result = dict(run(reopened.scan()))
+        assert all(abs(result[key] - value) < 1e-6 for key,value in self.expected(self.ratings + self.new_ratings,'sum'))
+
+    def test_refresh_on_read_only_sees_committed_records(self,tmp_path):
+        db = create_ratings(tmp_path / 'ratings.db',self.ratings)
+        view = MaterializedView(str(tmp_path / 'max_rating.db'),db,group_col=1,col=2,func_name='max',mode='refresh_on_read')
+        db.add_record((1,20,9.5,1))
+        assert dict(run(view.scan())).get(20) is None
+        db.commit()
+        assert len(view.committed_pending) == 1
+        assert dict(run(view.scan()))[20] == 9.5
+        expected = {key: max(x[2] for x in self.ratings if x[1] == key) for key in range(13)}
+        assert dict(tuple(run(view.scan()))[:-1]) == expected
+
+    def test_view_over_an_mvcc_table(self,tmp_path):
+        db = DataBase(str(tmp_path / 'ratings.db'),'mydb','ratings',('int','int','float','int'),mvcc=True)
+        records = [(i,i % 5,float(i % 4),1000 + i) for i in range(100)]
+        for _ in run(Q(Insert(db,records))):
+            pass
+        transaction = db.transactions.begin()
+        assert db.delete(lambda x: x[0] < 10,transaction) == 10
+        transaction.commit()
+        aborted = db.transactions.begin()
+        for _ in run(Q(Insert(db,[(i,7,1.0,1) for i in range(100,110)],aborted))):
+            pass
+        aborted.abort()
+        view = MaterializedView(str(tmp_path / 'count_rating.db'),db,group_col=1,col=2,func_name='count')
+        assert view.schema[0] == 'int'
+        assert tuple(run(view.scan())) == self.expected(records[10:],'count')
+
+    def test_view_is_refreshed_when_the_base_table_changed_without_it(self,tmp_path):
+        db = create_ratings(tmp_path / 'ratings.db',self.ratings)
+        view = MaterializedView(str(tmp_path / 'count_rating.db'),db,group_col=1,col=2,func_name='count')
+        assert os.path.isfile(view.signature_path)
+        other = DataBase(str(tmp_path / 'ratings.db'),'mydb','ratings',('int','int','float','int'))
+        for _ in run(Q(Insert(other,list(self.new_ratings)))):
+            pass
+        reopened = MaterializedView(str(tmp_path / 'count_rating.db'),other,group_col=1,col=2,func_name='count')
+        assert tuple(run(reopened.scan())) == self.expected(self.ratings + self.new_ratings,'count')